@@ -0,0 +1,311 @@
+import numpy
+
+import materials
+from utils import Vec
+
+# Flag bits kept for every block in a BlockBuffer.
+SET = 1
+HIDE = 2
+LOCK = 4
+SOFT = 8
+BLANK = 16
+
+# How far above the top of a dungeon the dense buffer reaches, for ruins and
+# entrances. Anything outside the dense buffer is still stored, just not as
+# cheaply.
+ruin_headroom = 40
+
+
+def _pack(hide, lock, soft, blank):
+    flags = SET
+    if hide:
+        flags |= HIDE
+    if lock:
+        flags |= LOCK
+    if soft:
+        flags |= SOFT
+    if blank:
+        flags |= BLANK
+    return flags
+
+
+def _flag(bit):
+    def get(self):
+        return bool(self.buf._flags(self) & bit)
+
+    def set(self, value):
+        self.buf._setflag(self, bit, value)
+    return property(get, set)
+
+
+def _materialNames():
+    '''Map the id of every material in the materials module to the name it
+    is kept under there.'''
+    names = {}
+    for name, obj in materials.__dict__.items():
+        if isinstance(obj, materials.Material):
+            names[id(obj)] = name
+    return names
+
+
+class BlockRef(object):
+
+    '''A view of one block in a BlockBuffer. It has the same attributes as
+    the Block objects dungeons used to keep, and writes to them go straight
+    to the buffer.'''
+
+    __slots__ = ('buf', 'loc', 'i')
+
+    def __init__(self, buf, loc, i):
+        self.buf = buf
+        self.loc = loc
+        self.i = i
+
+    def _getmaterial(self):
+        if self.i is None:
+            return self.buf.palette[self.buf.overflow[self.loc][0]]
+        return self.buf.palette[self.buf.mat[self.i]]
+
+    def _setmaterial(self, material):
+        m = self.buf.materialId(material)
+        if self.i is None:
+            self.buf.overflow[self.loc][0] = m
+        else:
+            self.buf.mat[self.i] = m
+
+    def _getdata(self):
+        if self.i is None:
+            return self.buf.overflow[self.loc][1]
+        return int(self.buf.data[self.i])
+
+    def _setdata(self, data):
+        if self.i is None:
+            self.buf.overflow[self.loc][1] = data
+        else:
+            self.buf.data[self.i] = data
+
+    material = property(_getmaterial, _setmaterial)
+    data = property(_getdata, _setdata)
+    hide = _flag(HIDE)
+    lock = _flag(LOCK)
+    soft = _flag(SOFT)
+    blank = _flag(BLANK)
+
+
+class BlockBuffer(object):
+
+    '''Dense storage for the blocks of a dungeon, in dungeon coordinates.
+    Blocks inside the volume live in flat arrays of material ids, data
+    values and flags. Materials are kept in a palette, since they are
+    compared by identity. Blocks outside the volume go in a small dict. It
+    can be used like the old dict of Vec -> Block, where each lookup returns
+    a BlockRef.'''
+
+    def __init__(self, width=0, height=0, length=0, headroom=0):
+        self.width = width
+        self.y0 = -headroom
+        self.height = height + headroom
+        self.length = length
+        size = self.width * self.height * self.length
+        self.mat = numpy.zeros(size, dtype=numpy.uint16)
+        self.data = numpy.zeros(size, dtype=numpy.uint8)
+        self.flags = numpy.zeros(size, dtype=numpy.uint8)
+        # Material 0 is None, for blocks that were never given one.
+        self.palette = [None]
+        self.palette_ids = {}
+        self.overflow = {}
+
+    def __getstate__(self):
+        # Materials are compared by identity, so a pickled buffer stores
+        # the names they have in the materials module, and gets the same
+        # objects back when it is loaded in another process. _wall and the
+        # rest are copies, so they are found by name too.
+        names = _materialNames()
+        state = self.__dict__.copy()
+        state['palette'] = [None] + [names.get(id(m), m)
+                                     for m in self.palette[1:]]
+        del state['palette_ids']
+        return state
+
+    def __setstate__(self, state):
+        palette = state.pop('palette')
+        self.__dict__.update(state)
+        self.palette = [None]
+        self.palette_ids = {}
+        remap = numpy.zeros(len(palette), dtype=numpy.uint16)
+        for i, m in enumerate(palette[1:], 1):
+            if isinstance(m, basestring):
+                m = getattr(materials, m)
+            remap[i] = self.materialId(m)
+        self.mat = remap[self.mat]
+        for entry in self.overflow.itervalues():
+            entry[0] = int(remap[entry[0]])
+
+    def materialId(self, material):
+        '''Return the palette id of a material, adding it if needed.'''
+        if material is None:
+            return 0
+        m = self.palette_ids.get(id(material))
+        if m is None:
+            m = len(self.palette)
+            self.palette.append(material)
+            self.palette_ids[id(material)] = m
+        return m
+
+    def index(self, loc):
+        '''Return the flat index of a location, or None if it lies outside
+        the dense buffer.'''
+        y = loc.y - self.y0
+        if (
+            0 <= loc.x < self.width and
+            0 <= y < self.height and
+            0 <= loc.z < self.length
+        ):
+            return (loc.x * self.height + y) * self.length + loc.z
+        return None
+
+    def location(self, i):
+        '''Return the location of a flat index.'''
+        (xy, z) = divmod(int(i), self.length)
+        (x, y) = divmod(xy, self.height)
+        return Vec(x, y + self.y0, z)
+
+    def _flags(self, ref):
+        if ref.i is None:
+            return self.overflow[ref.loc][2]
+        return self.flags[ref.i]
+
+    def _setflag(self, ref, bit, value):
+        if ref.i is None:
+            entry = self.overflow[ref.loc]
+            if value:
+                entry[2] |= bit
+            else:
+                entry[2] &= ~bit
+        elif value:
+            self.flags[ref.i] |= bit
+        else:
+            self.flags[ref.i] &= ~bit
+
+    def set(self, loc, material, data=0, hide=False, lock=False, soft=False,
+            blank=False):
+        '''Set a block, unless the existing block is locked and this one is
+        not.'''
+        flags = _pack(hide, lock, soft, blank)
+        i = self.index(loc)
+        if i is None:
+            entry = self.overflow.get(loc)
+            if entry is not None and entry[2] & LOCK and not lock:
+                return
+            self.overflow[loc] = [self.materialId(material), data, flags]
+            return
+        if self.flags[i] & LOCK and not lock:
+            return
+        self.mat[i] = self.materialId(material)
+        self.data[i] = data
+        self.flags[i] = flags
+
+    def _split(self, xs, ys, zs):
+        '''Split arrays of locations into flat indices of the ones inside
+        the dense buffer and a list of the ones outside it.'''
+        xs = numpy.asarray(xs, dtype=numpy.int64).ravel()
+        ys = numpy.asarray(ys, dtype=numpy.int64).ravel() - self.y0
+        zs = numpy.asarray(zs, dtype=numpy.int64).ravel()
+        inside = ((xs >= 0) & (xs < self.width) &
+                  (ys >= 0) & (ys < self.height) &
+                  (zs >= 0) & (zs < self.length))
+        idx = (xs[inside] * self.height + ys[inside]) * self.length + \
+            zs[inside]
+        outside = [Vec(x, y + self.y0, z) for (x, y, z) in
+                   zip(xs[~inside].tolist(),
+                       ys[~inside].tolist(),
+                       zs[~inside].tolist())]
+        return idx, outside
+
+    def setMany(self, xs, ys, zs, material, data=0, hide=False, lock=False,
+                soft=False, blank=False):
+        '''Set every block in arrays of locations to the same thing, with
+        the same locking rules as set().'''
+        (idx, outside) = self._split(xs, ys, zs)
+        flags = _pack(hide, lock, soft, blank)
+        if not lock:
+            idx = idx[self.flags[idx] & LOCK == 0]
+        self.mat[idx] = self.materialId(material)
+        self.data[idx] = data
+        self.flags[idx] = flags
+        for loc in outside:
+            self.set(loc, material, data, hide, lock, soft, blank)
+
+    def replace(self, xs, ys, zs, material, data=0):
+        '''Change the material and data of the blocks at arrays of
+        locations, keeping their flags. Every location must hold a block.'''
+        (idx, outside) = self._split(xs, ys, zs)
+        m = self.materialId(material)
+        self.mat[idx] = m
+        self.data[idx] = data
+        for loc in outside:
+            self.overflow[loc][0] = m
+            self.overflow[loc][1] = data
+
+    def deleteMany(self, xs, ys, zs):
+        '''Remove every block in arrays of locations. Locations with no
+        block are skipped.'''
+        (idx, outside) = self._split(xs, ys, zs)
+        self.mat[idx] = 0
+        self.data[idx] = 0
+        self.flags[idx] = 0
+        for loc in outside:
+            self.overflow.pop(loc, None)
+
+    def __contains__(self, loc):
+        i = self.index(loc)
+        if i is None:
+            return loc in self.overflow
+        return bool(self.flags[i] & SET)
+
+    def __getitem__(self, loc):
+        i = self.index(loc)
+        if i is None:
+            if loc not in self.overflow:
+                raise KeyError(loc)
+        elif not self.flags[i] & SET:
+            raise KeyError(loc)
+        return BlockRef(self, loc, i)
+
+    def __delitem__(self, loc):
+        i = self.index(loc)
+        if i is None:
+            del self.overflow[loc]
+        elif not self.flags[i] & SET:
+            raise KeyError(loc)
+        else:
+            self.mat[i] = 0
+            self.data[i] = 0
+            self.flags[i] = 0
+
+    def __len__(self):
+        return int(numpy.count_nonzero(self.flags & SET)) + len(self.overflow)
+
+    def arrays(self):
+        '''Return (xs, ys, zs, mat, data, flags) arrays for every block that
+        has been set, including the overflow. mat holds palette ids.'''
+        idx = numpy.flatnonzero(self.flags & SET)
+        (xs, ys, zs) = numpy.unravel_index(idx, (self.width,
+                                                 self.height,
+                                                 self.length))
+        locs = self.overflow.keys()
+        entries = [self.overflow[loc] for loc in locs]
+        xs = numpy.concatenate((xs, [loc.x for loc in locs]))
+        ys = numpy.concatenate((ys + self.y0, [loc.y for loc in locs]))
+        zs = numpy.concatenate((zs, [loc.z for loc in locs]))
+        mat = numpy.concatenate((self.mat[idx], [e[0] for e in entries]))
+        data = numpy.concatenate((self.data[idx], [e[1] for e in entries]))
+        flags = numpy.concatenate((self.flags[idx], [e[2] for e in entries]))
+        return (xs.astype(int), ys.astype(int), zs.astype(int),
+                mat.astype(int), data.astype(int), flags.astype(int))
+
+    def values(self):
+        refs = [BlockRef(self, self.location(i), i)
+                for i in numpy.flatnonzero(self.flags & SET).tolist()]
+        refs.extend(BlockRef(self, loc, None) for loc in self.overflow)
+        return refs
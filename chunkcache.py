@@ -0,0 +1,310 @@
+import cPickle
+import os
+import time
+
+import numpy
+
+# The chunk cache is a flat binary file. A small header is followed by a
+# sorted block of packed chunk keys, which group chunks by region, and then a
+# block of fixed width records in the same order. Lookups are a binary search
+# over the memory mapped keys, so nothing needs to be loaded up front.
+_magic = 'MCDC'
+_version = 2
+_header_dtype = numpy.dtype([('magic', 'S4'),
+                             ('version', '<u4'),
+                             ('count', '<u4'),
+                             ('max_dist', '<u4'),
+                             ('mtime', '<u4')])
+key_dtype = numpy.dtype('<i8')
+record_dtype = numpy.dtype([('result', 'S1'),
+                            ('biome', '<i2'),
+                            ('depth', '<i2'),
+                            ('stamp', '<u4')])
+
+# Checkpoints append these to a journal beside the cache file.
+journal_dtype = numpy.dtype([('key', '<i8'), ('deleted', 'u1')] +
+                            record_dtype.descr)
+
+# Region coordinates are offset so packed keys are always positive.
+_roff = 1 << 21
+# Chunks further than this many chunks beyond the largest max_dist this
+# cache has been used with are dropped when the cache is compacted.
+evict_margin = 64
+
+
+def packKeys(cxs, czs):
+    '''Pack chunk coordinates into integer keys that sort by region.'''
+    cxs = numpy.asarray(cxs, dtype=numpy.int64)
+    czs = numpy.asarray(czs, dtype=numpy.int64)
+    return ((((czs >> 5) + _roff) << 32) |
+            (((cxs >> 5) + _roff) << 10) |
+            ((czs & 31) << 5) |
+            (cxs & 31))
+
+
+def unpackKeys(keys):
+    '''Return the chunk coordinate arrays for an array of packed keys.'''
+    keys = numpy.asarray(keys, dtype=numpy.int64)
+    cxs = ((((keys >> 10) & 0x3fffff) - _roff) << 5) + (keys & 31)
+    czs = (((keys >> 32) - _roff) << 5) + ((keys >> 5) & 31)
+    return cxs, czs
+
+
+def packKey(key):
+    return int(packKeys(key[0], key[1]))
+
+
+class ChunkCache(object):
+
+    '''Chunk classifications keyed by (cx, cz). Values are
+    [result, biome, depth] lists, as they were in the old pickled dict.
+    Each record also keeps the region timestamp the chunk had when it was
+    classified, so it can be invalidated on its own. Changes are held in
+    memory until save() merges them into the file.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.pending = {}
+        self.deleted = set()
+        self.dirty = set()
+        self.max_dist = 0
+        # Regions untouched since this time hold no changed chunks.
+        self.mtime = 0
+        self.evict_from = None
+        self._open()
+
+    def _open(self):
+        self.keys = numpy.zeros(0, dtype=key_dtype)
+        self.records = numpy.zeros(0, dtype=record_dtype)
+        if not os.path.exists(self.path):
+            return
+        header = numpy.fromfile(self.path, dtype=_header_dtype, count=1)
+        if (
+            len(header) == 0 or
+            header['magic'][0] != _magic or
+            header['version'][0] != _version
+        ):
+            print 'Chunk cache is an unknown format. Resetting...'
+            self._replay()
+            return
+        self.max_dist = int(header['max_dist'][0])
+        self.mtime = int(header['mtime'][0])
+        count = int(header['count'][0])
+        if count > 0:
+            offset = _header_dtype.itemsize
+            self.keys = numpy.memmap(self.path,
+                                     dtype=key_dtype,
+                                     mode='r',
+                                     offset=offset,
+                                     shape=(count,))
+            offset += key_dtype.itemsize * count
+            self.records = numpy.memmap(self.path,
+                                        dtype=record_dtype,
+                                        mode='r',
+                                        offset=offset,
+                                        shape=(count,))
+        self._replay()
+
+    def _replay(self):
+        '''Recover checkpoints left in the journal by an interrupted run and
+        merge them into the cache.'''
+        if not os.path.exists(self.journal_path):
+            return
+        # A crash may have left a partial entry at the end.
+        count = os.path.getsize(self.journal_path) / journal_dtype.itemsize
+        entries = numpy.fromfile(self.journal_path,
+                                 dtype=journal_dtype,
+                                 count=count)
+        print 'Recovering %d chunks from the chunk cache journal...' % count
+        cxs, czs = unpackKeys(entries['key'])
+        for i, e in enumerate(entries):
+            key = (int(cxs[i]), int(czs[i]))
+            if e['deleted']:
+                self.pending.pop(key, None)
+                self.deleted.add(key)
+            else:
+                self.pending[key] = (e['result'], e['biome'],
+                                     e['depth'], e['stamp'])
+                self.deleted.discard(key)
+        self.save()
+
+    def _find(self, pkey):
+        i = numpy.searchsorted(self.keys, pkey)
+        if i < len(self.keys) and self.keys[i] == pkey:
+            return i
+        return None
+
+    def __contains__(self, key):
+        if key in self.pending:
+            return True
+        if key in self.deleted:
+            return False
+        return self._find(packKey(key)) is not None
+
+    def __getitem__(self, key):
+        if key in self.pending:
+            (result, biome, depth, stamp) = self.pending[key]
+        else:
+            i = None
+            if key not in self.deleted:
+                i = self._find(packKey(key))
+            if i is None:
+                raise KeyError(key)
+            r = self.records[i]
+            (result, biome, depth) = (r['result'], r['biome'], r['depth'])
+        biome = int(biome)
+        if biome == -1:
+            biome = None
+        return [str(result), biome, int(depth)]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def set(self, key, value, stamp=None):
+        '''Store [result, biome, depth] for a chunk, along with its region
+        timestamp when it was classified. Without one, the current time is
+        used, which is never older than the chunk.'''
+        (result, biome, depth) = value
+        if biome is None:
+            biome = -1
+        if stamp is None:
+            stamp = int(time.time())
+        self.pending[key] = (result, biome, depth, stamp)
+        self.deleted.discard(key)
+        self.dirty.add(key)
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.pending.pop(key, None)
+        self.deleted.add(key)
+        self.dirty.add(key)
+
+    def lookup(self, cxs, czs):
+        '''Vectorized lookup of the saved records for arrays of chunk
+        coordinates. Returns a mask of the chunks found and their records,
+        which are zeroed where nothing was found. Unsaved changes are not
+        included.'''
+        keys = packKeys(cxs, czs)
+        if len(self.keys) == 0:
+            return (numpy.zeros(len(keys), dtype=bool),
+                    numpy.zeros(len(keys), dtype=record_dtype))
+        i = numpy.searchsorted(self.keys, keys)
+        i = numpy.minimum(i, len(self.keys) - 1)
+        found = self.keys[i] == keys
+        records = numpy.array(self.records[i])
+        records[~found] = numpy.zeros(1, dtype=record_dtype)
+        return found, records
+
+    def evict(self, sx, sz, max_dist):
+        '''Mark chunks far outside any max_dist this cache has been used with
+        for removal on the next save.'''
+        self.max_dist = max(self.max_dist, int(max_dist))
+        self.evict_from = (sx, sz)
+
+    def checkpoint(self):
+        '''Append the changes made since the last checkpoint to the journal
+        and sync it to disk. This costs the size of the changes, not the
+        size of the cache, so it is cheap to call often during a scan.'''
+        if len(self.dirty) == 0:
+            return
+        dirty = list(self.dirty)
+        entries = numpy.zeros(len(dirty), dtype=journal_dtype)
+        entries['key'] = packKeys([k[0] for k in dirty],
+                                  [k[1] for k in dirty])
+        for i, key in enumerate(dirty):
+            if key in self.deleted:
+                entries['deleted'][i] = 1
+            else:
+                (entries['result'][i],
+                 entries['biome'][i],
+                 entries['depth'][i],
+                 entries['stamp'][i]) = self.pending[key]
+        FILE = open(self.journal_path, 'ab')
+        entries.tofile(FILE)
+        FILE.flush()
+        os.fsync(FILE.fileno())
+        FILE.close()
+        self.dirty = set()
+
+    def _merged(self):
+        keys = numpy.array(self.keys)
+        records = numpy.array(self.records)
+        if len(self.pending) > 0 or len(self.deleted) > 0:
+            changed = self.pending.keys() + list(self.deleted)
+            drop = packKeys([k[0] for k in changed], [k[1] for k in changed])
+            keep = ~numpy.in1d(keys, drop)
+            keys = keys[keep]
+            records = records[keep]
+            if len(self.pending) > 0:
+                new_keys = packKeys([k[0] for k in self.pending.keys()],
+                                    [k[1] for k in self.pending.keys()])
+                new_records = numpy.array(self.pending.values(),
+                                          dtype=record_dtype)
+                keys = numpy.concatenate((keys, new_keys))
+                records = numpy.concatenate((records, new_records))
+            order = numpy.argsort(keys, kind='mergesort')
+            keys = keys[order]
+            records = records[order]
+        if self.evict_from is not None and len(keys) > 0:
+            (sx, sz) = self.evict_from
+            cxs, czs = unpackKeys(keys)
+            dist = numpy.sqrt((cxs - sx) ** 2 + (czs - sz) ** 2)
+            keep = dist <= self.max_dist + evict_margin
+            keys = keys[keep]
+            records = records[keep]
+        return keys, records
+
+    def save(self):
+        '''Merge any changes and write the cache out. The new file is
+        written beside the old one and moved into place.'''
+        keys, records = self._merged()
+        header = numpy.zeros(1, dtype=_header_dtype)
+        header['magic'] = _magic
+        header['version'] = _version
+        header['count'] = len(keys)
+        header['max_dist'] = self.max_dist
+        header['mtime'] = self.mtime
+        tmp_path = self.path + '.tmp'
+        FILE = open(tmp_path, 'wb')
+        header.tofile(FILE)
+        keys.astype(key_dtype).tofile(FILE)
+        records.tofile(FILE)
+        FILE.close()
+        # Release the maps before replacing the file.
+        self.keys = numpy.zeros(0, dtype=key_dtype)
+        self.records = numpy.zeros(0, dtype=record_dtype)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmp_path, self.path)
+        # Everything in the journal is in the cache file now.
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self.pending = {}
+        self.deleted = set()
+        self.dirty = set()
+        self.evict_from = None
+        self._open()
+
+
+def convertPickle(pickle_path, path, stamp=0):
+    '''One time conversion of an old pickled chunk cache dict. The old cache
+    has no per chunk timestamps, so they all get the given stamp.'''
+    FILE = open(pickle_path, 'rb')
+    old_cache = cPickle.load(FILE)
+    FILE.close()
+    cache = ChunkCache(path)
+    for key, value in old_cache.iteritems():
+        (cx, cz) = [int(v) for v in key.split(',')]
+        cache.set((cx, cz), value, stamp=stamp)
+    cache.mtime = stamp
+    cache.save()
+    os.remove(pickle_path)
+    return cache
@@ -0,0 +1,195 @@
+import cPickle
+import os
+import time
+
+import utils
+from dungeonindex import dungeonFootprint, tHuntFootprint
+from pymclevel import nbt
+
+# Runs can write several dungeons to the world in memory and save them all
+# at once. Before a dungeon is written, its key and footprint are appended
+# to a journal beside the caches, and a save that makes everything written
+# so far permanent removes the journal. Any dungeon still in the journal
+# when a command that writes to the world starts was written by a run that
+# stopped before saving it, so it may be missing from the caches, or only
+# partly on disk, and its chunks are deleted just as the delete command
+# would. Dungeons that were being regenerated are left where they are, since
+# they were in the world before that run. They may be partly regenerated,
+# and can be regenerated again.
+
+
+class CommitJournal(object):
+
+    '''The dungeons and treasure hunts written to the world since the last
+    save, as an append only file of pickled (key, kind, rects) records.'''
+
+    def __init__(self, cache_path):
+        self.path = os.path.join(cache_path, 'commit_journal')
+
+    def applied(self, key, kind, rects):
+        '''Record a structure before any of it is written to the world.'''
+        FILE = open(self.path, 'ab')
+        cPickle.dump((key, kind, rects), FILE, -1)
+        FILE.flush()
+        os.fsync(FILE.fileno())
+        FILE.close()
+
+    def pending(self):
+        '''Return {key: (kind, rects)} for every structure written since the
+        last save.'''
+        entries = {}
+        if not os.path.exists(self.path):
+            return entries
+        FILE = open(self.path, 'rb')
+        while True:
+            try:
+                (key, kind, rects) = cPickle.load(FILE)
+            except Exception:
+                # The end of the file, or a record cut short when the run
+                # stopped. Nothing was written for that one yet.
+                break
+            entries[key] = (kind, rects)
+        FILE.close()
+        return entries
+
+    def clear(self):
+        '''Forget everything. Called once a save has made it permanent.'''
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def recover(world, cache_path, map_store=None):
+    '''Delete the chunks of any dungeon or treasure hunt a stopped run wrote
+    but never saved, and drop it from the caches and the index. Dungeons
+    that were being regenerated are kept.'''
+    journal = CommitJournal(cache_path)
+    pending = journal.pending()
+    regenerated = sorted(key for key, (kind, rects) in pending.iteritems()
+                         if kind == 'regenerate')
+    for key in regenerated:
+        print 'The dungeon at %s was being regenerated when a run ' \
+              'stopped.' % key
+        print 'It has been left in place, but may be partly regenerated. ' \
+              'Regenerate it again to repair it.'
+        del pending[key]
+    if len(pending) == 0:
+        journal.clear()
+        return
+    print 'An interrupted run left %d unsaved dungeons and treasure ' \
+          'hunts:' % len(pending)
+    for key, (kind, rects) in sorted(pending.iteritems()):
+        print '   %s at %s' % (
+            'dungeon' if kind == 'dungeon' else 'treasure hunt', key)
+    print 'Deleting their chunks and cache entries...'
+    dcache, dmtime = utils.loadDungeonCache(cache_path)
+    tcache, tmtime = utils.loadTHuntCache(cache_path)
+    ccache, cmtime = utils.loadChunkCache(cache_path)
+    dungeon_index = utils.loadDungeonIndex(cache_path)
+    chunks = set()
+    for key, (kind, rects) in pending.iteritems():
+        if map_store is not None:
+            map_store.delete_maps(key)
+        dcache.pop(key, None)
+        tcache.pop(key, None)
+        if key in dungeon_index:
+            dungeon_index.remove(key)
+        for (x0, z0, x1, z1) in rects:
+            for cx in xrange(x0, x1):
+                for cz in xrange(z0, z1):
+                    chunks.add((cx, cz))
+    print 'Deleting %d chunks...' % len(chunks)
+    for c in chunks:
+        if world.containsChunk(c[0], c[1]):
+            world.deleteChunk(c[0], c[1])
+        if c in ccache:
+            del ccache[c]
+    print "Saving..."
+    world.saveInPlace()
+    utils.saveDungeonCache(cache_path, dcache)
+    utils.saveTHuntCache(cache_path, tcache)
+    utils.saveChunkCache(cache_path, ccache)
+    utils.saveDungeonIndex(dungeon_index)
+    journal.clear()
+
+
+class Committer(object):
+
+    '''Saves the world, the caches and the dungeon index after every
+    `every` dungeons, or only at finish() if every is 0. caches is a list
+    of (save function, cache) pairs to save along with the world, such as
+    (utils.saveDungeonCache, dungeon_cache). If a relighter is given, its
+    queued chunks are relit before the last save.'''
+
+    def __init__(self, world, cache_path, caches, every=1, relighter=None):
+        self.world = world
+        self.cache_path = cache_path
+        self.caches = caches
+        self.every = every
+        self.relighter = relighter
+        self.journal = CommitJournal(cache_path)
+        self.pending = []
+        self.saves = 0
+        self.committed = 0
+        self.seconds = 0.0
+
+    def applying(self, key, kind, info):
+        '''Record a dungeon or treasure hunt in the journal. This must be
+        called before any of it is written to the world, including anything
+        drawn straight into chunks while it was built. kind is 'dungeon',
+        'regenerate' for a dungeon that was already in the world, or
+        'thunt'.'''
+        if kind in ('dungeon', 'regenerate'):
+            rects = dungeonFootprint(info)
+        else:
+            rects = tHuntFootprint(info)
+        self.journal.applied(key, kind, rects)
+
+    def add(self, key, kind, info):
+        '''Queue a dungeon or treasure hunt that has been written to the
+        world for saving. Returns True if it was saved now.'''
+        self.pending.append((key, kind, info))
+        if self.every > 0 and len(self.pending) >= self.every:
+            self.commit()
+            return True
+        return False
+
+    def commit(self):
+        '''Save the world and caches, and add everything queued to the
+        dungeon index.'''
+        print "Saving..."
+        start = time.time()
+        self.world.saveInPlace()
+        for (save, cache) in self.caches:
+            save(self.cache_path, cache)
+        if len(self.pending) > 0:
+            dungeon_index = utils.loadDungeonIndex(self.cache_path)
+            for (key, kind, info) in self.pending:
+                dungeon_index.add(key, kind, info)
+            utils.saveDungeonIndex(dungeon_index)
+        # make sure commandBlockOutput is false.
+        root_tag = nbt.load(self.world.filename)
+        root_tag['Data']['GameRules'][
+            'commandBlockOutput'].value = 'false'
+        root_tag.save(self.world.filename)
+        # Everything written so far is on disk now.
+        self.journal.clear()
+        elapsed = time.time() - start
+        if len(self.pending) > 1:
+            print 'Saved {0} structures in {1:.2f}s'.format(len(self.pending),
+                                                            elapsed)
+        self.committed += len(self.pending)
+        self.pending = []
+        self.saves += 1
+        self.seconds += elapsed
+
+    def finish(self):
+        '''Relight and save anything still queued at the end of a run, and
+        print the totals.'''
+        relit = self.relighter is not None and self.relighter.flush()
+        if len(self.pending) > 0 or relit:
+            self.commit()
+        if self.relighter is not None:
+            self.relighter.report()
+        if self.saves > 0:
+            print 'Saving: {0} saves for {1} structures, {2:.2f}s'.format(
+                self.saves, self.committed, self.seconds)
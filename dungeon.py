@@ -4,7 +4,6 @@ import operator
 from pprint import pprint
 import random
 from random import *
-import logging
 
 import cfg
 import loottable
@@ -20,26 +19,16 @@ import namegenerator
 import flaggenerator
 import inventory
 from utils import *
+from blockbuffer import BlockBuffer, ruin_headroom, SOFT
 from disjoint_set import DisjointSet
+from placement import PlacementGrid
+from dungeonindex import fill_caves_padding
+from relight import Relighter
+from commitlog import Committer
+from lighting import LightVolume
 from pymclevel import nbt
 
 
-class Block(object):
-
-    def __init__(self, loc):
-        self.loc = loc
-        self.material = None
-        self.data = 0
-        # Blank blocks are just drawn blank on the map
-        self.blank = False
-        # Hidden blocks are "see-though" on the map
-        self.hide = False
-        # Locked blocks cannot be overwritten later
-        self.lock = False
-        # Soft blocks are only rendered if the world block is air
-        self.soft = False
-
-
 class MazeCell(object):
     states = enum('BLANK', 'USED', 'CONNECTED', 'RESTRICTED')
 
@@ -49,26 +38,6 @@ class MazeCell(object):
         self.state = 0
 
 
-class RelightHandler(object):
-    _curr = 28
-    _count = 0
-
-    def __init__(self):
-        self.pm = pmeter.ProgressMeter()
-        self.pm.init(self._curr, label='Relighting chunks:')
-
-    def write(self, buff=''):
-        if 'Pass' in buff:
-            self._curr -= 1
-            self.pm.update_left(self._curr)
-
-    def flush(self):
-        pass
-
-    def done(self):
-        self.pm.set_complete()
-
-
 class Dungeon (object):
 
     def __init__(self,
@@ -77,22 +46,32 @@ class Dungeon (object):
                  chunk_cache,
                  dungeon_cache,
                  good_chunks,
-                 mapstore):
+                 mapstore,
+                 plan=None,
+                 relighter=None,
+                 committer=None):
 
         self.world = world
         self.chunk_cache = chunk_cache
         self.dungeon_cache = dungeon_cache
         self.good_chunks = good_chunks
+        self.plan = plan
+        if relighter is None:
+            relighter = Relighter(world)
+        self.relighter = relighter
+        self.committer = committer
+        self.write_seed = None
         self.mapstore = mapstore
         self.inventory = inventory.new(mapstore)
         self.pm = pmeter.ProgressMeter()
         self.rooms = {}
         self.halls = []
         self.hall_traps = []
-        self.blocks = {}
+        self.blocks = BlockBuffer()
         self.tile_ents = {}
         self.ents = []
         self.placed_items = []
+        self.chunk_edits = {}
         self.torches = {}
         self.doors = {}
         self.entrance = None
@@ -111,13 +90,21 @@ class Dungeon (object):
 
     def generate(self, cache_path, version):
         '''Generate a dungeon'''
+        if self.locate() is False:
+            return False
+        self.build(version)
+        self.write(cache_path)
+        return True
+
+    def locate(self):
+        '''Pick a size for the dungeon and find somewhere to put it.
+        Returns True if it was placed.'''
         # Pick a starting size.
         self.xsize = randint(cfg.min_x, cfg.max_x)
         self.zsize = randint(cfg.min_z, cfg.max_z)
         self.levels = randint(cfg.min_levels, cfg.max_levels)
 
         located = False
-        result = False
         # Find a location, if we can.
         # Manual location
         if cfg.offset is not '':
@@ -139,101 +126,14 @@ class Dungeon (object):
         else:
             print "Searching for a suitable location..."
             while (located is False):
+                # Go straight to the largest size that fits somewhere.
+                if self.solvesize() is False:
+                    print 'Unable to place any more dungeons.'
+                    break
                 located = self.findlocation()
                 if (located is False):
-                    # Scale. Start with the largest axis and work down.
-                    adjusted = False
-                    while (
-                        self.xsize > cfg.min_x or
-                        self.zsize > cfg.min_z or
-                        self.levels > cfg.min_levels
-                    ):
-                        # X Z L
-                        if (
-                            self.xsize >= self.zsize and
-                            self.zsize >= self.levels
-                        ):
-                            if self.xsize > cfg.min_x:
-                                self.xsize -= 1
-                                adjusted = True
-                            elif self.zsize > cfg.min_z:
-                                self.zsize -= 1
-                                adjusted = True
-                            elif self.levels > cfg.min_levels:
-                                self.levels -= 1
-                                adjusted = True
-                        # X L Z
-                        elif (
-                            self.xsize >= self.levels and
-                            self.levels >= self.zsize
-                        ):
-                            if self.xsize > cfg.min_x:
-                                self.xsize -= 1
-                                adjusted = True
-                            elif self.levels > cfg.min_levels:
-                                self.levels -= 1
-                                adjusted = True
-                            elif self.zsize > cfg.min_z:
-                                self.zsize -= 1
-                                adjusted = True
-                        # Z X L
-                        elif (
-                            self.zsize >= self.xsize and
-                            self.xsize >= self.levels
-                        ):
-                            if self.zsize > cfg.min_z:
-                                self.zsize -= 1
-                                adjusted = True
-                            elif self.xsize > cfg.min_x:
-                                self.xsize -= 1
-                                adjusted = True
-                            elif self.levels > cfg.min_levels:
-                                self.levels -= 1
-                                adjusted = True
-                        # Z L X
-                        elif (
-                            self.zsize >= self.levels and
-                            self.levels >= self.xsize
-                        ):
-                            if self.zsize > cfg.min_z:
-                                self.zsize -= 1
-                                adjusted = True
-                            elif self.levels > cfg.min_levels:
-                                self.levels -= 1
-                                adjusted = True
-                            elif self.xsize > cfg.min_x:
-                                self.xsize -= 1
-                                adjusted = True
-                        # L X Z
-                        elif (
-                            self.levels >= self.xsize and
-                            self.xsize >= self.zsize
-                        ):
-                            if self.levels > cfg.min_levels:
-                                self.levels -= 1
-                                adjusted = True
-                            elif self.xsize > cfg.min_x:
-                                self.xsize -= 1
-                                adjusted = True
-                            elif self.zsize > cfg.min_z:
-                                self.zsize -= 1
-                                adjusted = True
-                        # L Z X
-                        elif (
-                            self.levels >= self.zsize and
-                            self.zsize >= self.xsize
-                        ):
-                            if self.levels > cfg.min_levels:
-                                self.levels -= 1
-                                adjusted = True
-                            elif self.zsize > cfg.min_z:
-                                self.zsize -= 1
-                                adjusted = True
-                            elif self.xsize > cfg.min_x:
-                                self.xsize -= 1
-                                adjusted = True
-
-                    if (adjusted is False):
+                    # It fits, but could not be buried anywhere. Try smaller.
+                    if self.shrink() is False:
                         print 'Unable to place any more dungeons.'
                         break
                 else:
@@ -241,149 +141,191 @@ class Dungeon (object):
                                                                  self.zsize,
                                                                  self.levels)
                     print "Location: ", self.position
-        # Generate!
-        if (located is True):
-            # We have a final size, so let's initialize some things.
-            for x in xrange(self.xsize):
-                for y in xrange(self.levels):
-                    for z in xrange(self.zsize):
-                        self.maze[Vec(x, y, z)] = MazeCell(Vec(x, y, z))
-            self.halls = [[[[None, None, None, None] for z in
-                            xrange(self.zsize)] for y in
-                           xrange(self.levels)] for x in
-                          xrange(self.xsize)]
-
-            self.heightmap = numpy.zeros((self.xsize * self.room_size,
-                                          self.zsize * self.room_size))
-
-            # Set the seed if requested.
-            if (self.args.seed is not None):
-                seed(self.args.seed)
-                print 'Seed:', self.args.seed
-
-            # Now we know the biome, we can setup a name generator
-            self.namegen = namegenerator.namegenerator(self.biome)
-            print 'Theme:', self.namegen.theme
-            self.owner = self.namegen.genroyalname()
-            print 'Owner:', self.owner
-
-            # And generate a unique flag
-            self.flagdesign = flaggenerator.generateflag()
-            self.inventory.SetDungeonFlag(self.flagdesign)
-
-            # Pick a common door material for the dungeon
-            self.doormaterial = choice(
-                [
-                    materials.WoodenDoor,
-                    materials.SpruceDoor,
-                    materials.BirchDoor,
-                    materials.JungleDoor,
-                    materials.DarkOakDoor,
-                    materials.AcaciaDoor,
-                ]
-            )
-
-            print "Generating rooms..."
-            self.genrooms()
-            print "Generating halls..."
-            self.genhalls()
-            print "Generating floors..."
-            self.genfloors()
-            print "Generating features..."
-            self.genfeatures()
-            if self.args.command != 'regenerate':
-                print "Generating ruins..."
-                self.genruins()
-                self.setentrance()
-            else:
-                self.entrance.height = self.args.entrance_height
-            # Name this place
-            if self.owner.endswith("s"):
-                owners = self.owner + "'"
-            else:
-                owners = self.owner + "'s"
-            self.dungeon_name = self.dinfo['dungeon_name'].format(
-                owner=self.owner,
-                owners=owners)
-            self.dinfo['full_name'] = self.dungeon_name
-            print "Dungeon name:", self.dungeon_name
-            print "Finding secret rooms..."
-            self.findsecretrooms()
-            self.renderruins()
-            self.renderrooms()
-            self.renderhalls()
-            self.renderfloors()
-            self.renderfeatures()
-            print "Generating hall traps..."
-            self.genhalltraps()
-            self.renderhalltraps()
-            self.processBiomes()
-            print "Placing doors..."
-            self.placedoors(cfg.doors)
-            print "Placing torches..."
-            self.placetorches()
-            print "Placing chests..."
-            self.placechests()
-            print "Placing spawners..."
-            self.placespawners()
-
-            # Signature
-            self.setblock(Vec(0, 0, 0), materials.Chest, 0, hide=True)
-            self.tile_ents[Vec(0, 0, 0)] = encodeDungeonInfo(self,
-                                                             version)
-            # Add to the dungeon cache.
-            key = key = '%s,%s' % (
-                self.position.x,
-                self.position.z,
-            )
-            self.dungeon_cache[key] = encodeDungeonInfo(self, version)
-
-            # Generate maps
-            if (self.args.write and cfg.maps > 0):
-                print "Generating maps..."
-                self.generatemaps()
-            print "Placing special items..."
-            self.placeitems()
-
-            # copy results to the world
-            self.applychanges()
-
-            # Relight these chunks.
-            if (self.args.write is True and self.args.skiprelight is False):
-                # Super ugly, but does progress bars for lighting.
-                for handler in logging.root.handlers[:]:
-                    logging.root.removeHandler(handler)
-                h = RelightHandler()
-                logging.basicConfig(stream=h, level=logging.INFO)
-                self.world.generateLights()
-                h.done()
-                logging.getLogger().level = logging.CRITICAL
-                for handler in logging.root.handlers[:]:
-                    logging.root.removeHandler(handler)
-
-            # Saving here allows us to pick up where we left off if we stop.
-            if (self.args.write is True):
-                print "Saving..."
-                self.world.saveInPlace()
-                saveDungeonCache(cache_path, self.dungeon_cache)
-                saveChunkCache(cache_path, self.chunk_cache)
-                # make sure commandBlockOutput is false.
-                root_tag = nbt.load(self.world.filename)
-                root_tag['Data']['GameRules'][
-                    'commandBlockOutput'].value = 'false'
-                root_tag.save(self.world.filename)
-            else:
-                print "Skipping save! (--write disabled)"
-
-            if (self.args.html is not None):
-                self.outputhtml()
+        return located
+
+    def build(self, version):
+        '''Generate a located dungeon into its block buffer.'''
+        self.buildblocks(version)
+        self.finishbuild()
+
+    def buildblocks(self, version):
+        '''Generate the rooms, halls, features, ruins and loot of a located
+        dungeon into its block buffer. This only reads the chunks under the
+        dungeon, and never touches the map store except to add paintings,
+        so it can run in another process.'''
+        # We have a final size, so let's initialize some things.
+        self.blocks = BlockBuffer(self.xsize * self.room_size,
+                                  self.levels * self.room_height,
+                                  self.zsize * self.room_size,
+                                  ruin_headroom)
+        for x in xrange(self.xsize):
+            for y in xrange(self.levels):
+                for z in xrange(self.zsize):
+                    self.maze[Vec(x, y, z)] = MazeCell(Vec(x, y, z))
+        self.halls = [[[[None, None, None, None] for z in
+                        xrange(self.zsize)] for y in
+                       xrange(self.levels)] for x in
+                      xrange(self.xsize)]
+
+        self.heightmap = numpy.zeros((self.xsize * self.room_size,
+                                      self.zsize * self.room_size))
+
+        # Set the seed if requested.
+        if (self.args.seed is not None):
+            seed(self.args.seed)
+            print 'Seed:', self.args.seed
+
+        # Now we know the biome, we can setup a name generator
+        self.namegen = namegenerator.namegenerator(self.biome)
+        print 'Theme:', self.namegen.theme
+        self.owner = self.namegen.genroyalname()
+        print 'Owner:', self.owner
+
+        # And generate a unique flag
+        self.flagdesign = flaggenerator.generateflag()
+        self.inventory.SetDungeonFlag(self.flagdesign)
+
+        # Pick a common door material for the dungeon
+        self.doormaterial = choice(
+            [
+                materials.WoodenDoor,
+                materials.SpruceDoor,
+                materials.BirchDoor,
+                materials.JungleDoor,
+                materials.DarkOakDoor,
+                materials.AcaciaDoor,
+            ]
+        )
 
-            if (self.args.term is not None):
-                self.outputterminal()
+        print "Generating rooms..."
+        self.genrooms()
+        print "Generating halls..."
+        self.genhalls()
+        print "Generating floors..."
+        self.genfloors()
+        print "Generating features..."
+        self.genfeatures()
+        if self.args.command != 'regenerate':
+            print "Generating ruins..."
+            self.genruins()
+            self.setentrance()
+        else:
+            self.entrance.height = self.args.entrance_height
+        # Name this place
+        if self.owner.endswith("s"):
+            owners = self.owner + "'"
+        else:
+            owners = self.owner + "'s"
+        self.dungeon_name = self.dinfo['dungeon_name'].format(
+            owner=self.owner,
+            owners=owners)
+        self.dinfo['full_name'] = self.dungeon_name
+        print "Dungeon name:", self.dungeon_name
+        print "Finding secret rooms..."
+        self.findsecretrooms()
+        self.renderruins()
+        self.renderrooms()
+        self.renderhalls()
+        self.renderfloors()
+        self.renderfeatures()
+        print "Generating hall traps..."
+        self.genhalltraps()
+        self.renderhalltraps()
+        self.processBiomes()
+        print "Placing doors..."
+        self.placedoors(cfg.doors)
+        print "Placing torches..."
+        self.placetorches()
+        print "Placing chests..."
+        self.placechests()
+        print "Placing spawners..."
+        self.placespawners()
+
+        # Signature
+        self.setblock(Vec(0, 0, 0), materials.Chest, 0, hide=True)
+        self.tile_ents[Vec(0, 0, 0)] = encodeDungeonInfo(self,
+                                                         version)
+        # The dungeon cache entry. It is added to the cache when the dungeon
+        # is written.
+        self.key = '%s,%s' % (
+            self.position.x,
+            self.position.z,
+        )
+        self.cache_info = encodeDungeonInfo(self, version)
+
+    def finishbuild(self):
+        '''Add maps and special items to a dungeon built by buildblocks(),
+        and resolve its meta materials.'''
+        # Generate maps
+        if (self.args.write and cfg.maps > 0):
+            print "Generating maps..."
+            self.generatemaps()
+        print "Placing special items..."
+        self.placeitems()
+
+        # Settle everything random about writing the dungeon out now, so
+        # that a write in another thread doesn't draw from the shared
+        # random state while the next dungeon is being built.
+        self.resolvemeta()
+        self.write_seed = random.getrandbits(32)
+
+    def reservechunks(self):
+        '''Move the good chunks under a built dungeon, including the area
+        fill_caves clears, out of the shared good_chunks and into a copy of
+        its own. Writing the dungeon then only touches its own copy, and no
+        other dungeon can be placed on those chunks meanwhile.'''
+        pad = 0
+        if self.dinfo['fill_caves']:
+            pad = fill_caves_padding
+        cx = self.position.x >> 4
+        cz = self.position.z >> 4
+        reserved = {}
+        for x in xrange(cx - pad, cx + self.xsize + pad):
+            for z in xrange(cz - pad, cz + self.zsize + pad):
+                if (x, z) in self.good_chunks:
+                    reserved[(x, z)] = self.good_chunks.pop((x, z))
+        self.good_chunks = reserved
+
+    def write(self, cache_path):
+        '''Write a built dungeon to the world, relight it, and save it along
+        with its dungeon cache entry.'''
+        key = self.key
+        self.dungeon_cache[key] = self.cache_info
+        # copy results to the world. The journal has to know about it
+        # first, in case we stop before it is saved.
+        info = decodeDungeonInfo(self.cache_info)
+        if (self.args.write is True):
+            if self.committer is None:
+                self.committer = Committer(
+                    self.world,
+                    cache_path,
+                    [(saveDungeonCache, self.dungeon_cache),
+                     (saveChunkCache, self.chunk_cache)])
+            # Regenerated dungeons were already in the world, so the
+            # journal keeps them apart from new ones.
+            if self.args.command == 'regenerate':
+                self.committer.applying(key, 'regenerate', info)
+            else:
+                self.committer.applying(key, 'dungeon', info)
+        self.applychanges()
+
+        # Relight these chunks, or queue them to be relit along with
+        # the chunks of the next few dungeons.
+        if (self.args.write is True and self.args.skiprelight is False):
+            self.relighter.add(self.changed_chunks, self.light_volume)
+
+        # Saving here allows us to pick up where we left off if we stop.
+        # With a larger commit_every, several are saved together.
+        if (self.args.write is True):
+            self.committer.add(key, 'dungeon', info)
+        else:
+            print "Skipping save! (--write disabled)"
 
-            result = True
+        if (self.args.html is not None):
+            self.outputhtml()
 
-        return result
+        if (self.args.term is not None):
+            self.outputterminal()
 
     def printmaze(self, y, cursor=None):
         for z in xrange(self.zsize):
@@ -450,10 +392,6 @@ class Dungeon (object):
                 del(self.blocks[loc])
             return
 
-        # Build a block if we need to
-        if loc not in self.blocks:
-            self.blocks[loc] = Block(loc)
-
         if (loc.x >= 0 and
                 loc.z >= 0 and
                 loc.x < self.xsize * self.room_size and
@@ -461,31 +399,87 @@ class Dungeon (object):
             self.heightmap[loc.x][loc.z] = min(loc.y,
                                                self.heightmap[loc.x][loc.z])
 
-        # If the existing block is locked, abort
-        # Unless we are requesting a locked block
-        if self.blocks[loc].lock and lock == False:
-            return
-
-        # Setup the material
-        self.blocks[loc].material = material
-
         # Set the data value
         if (data == 0):
-            self.blocks[loc].data = material.data
-        else:
-            self.blocks[loc].data = data
+            data = material.data
 
-        # Hide this from the map generator if requested
-        self.blocks[loc].hide = hide
+        # If the existing block is locked, this does nothing, unless we are
+        # requesting a locked block.
+        # Hidden blocks are hidden from the map generator.
+        # Soft blocks are only drawn when the world block is air.
+        # Blank blocks alway show as an empty cell.
+        self.blocks.set(loc, material, data, hide, lock, soft, blank)
 
-        # Lock it
-        self.blocks[loc].lock = lock
+    def setblocks(
+            self,
+            xs,
+            ys,
+            zs,
+            material,
+            data=0,
+            hide=False,
+            lock=False,
+            soft=False,
+            blank=False):
+        '''setblock() for arrays of coordinates, all done in one go. Every
+        block gets the same material, data and flags.'''
+        if material is None:
+            self.blocks.deleteMany(xs, ys, zs)
+            return
 
-        # Soft blocks are only drawn when the world block is air
-        self.blocks[loc].soft = soft
+        xs = numpy.asarray(xs, dtype=int).ravel()
+        ys = numpy.asarray(ys, dtype=int).ravel()
+        zs = numpy.asarray(zs, dtype=int).ravel()
+        inside = ((xs >= 0) &
+                  (zs >= 0) &
+                  (xs < self.xsize * self.room_size) &
+                  (zs < self.zsize * self.room_size))
+        numpy.minimum.at(self.heightmap,
+                         (xs[inside], zs[inside]),
+                         ys[inside])
 
-        # Blank blocks alway show as an empty cell.
-        self.blocks[loc].blank = blank
+        if (data == 0):
+            data = material.data
+
+        self.blocks.setMany(xs, ys, zs, material, data, hide, lock, soft,
+                            blank)
+
+    def fillcube(self, p1, p2, material, data=0, hide=False, lock=False,
+                 soft=False, blank=False):
+        '''Set every block in the box between two corners, as
+        iterate_cube(p1, p2) would visit them.'''
+        (xs, ys, zs) = numpy.mgrid[min(p1.x, p2.x):max(p1.x, p2.x) + 1,
+                                   min(p1.y, p2.y):max(p1.y, p2.y) + 1,
+                                   min(p1.z, p2.z):max(p1.z, p2.z) + 1]
+        self.setblocks(xs, ys, zs, material, data, hide, lock, soft, blank)
+
+    def fillfourwalls(self, corner1, corner3, height, material, data=0,
+                      hide=False, lock=False, soft=False, blank=False):
+        '''Set the four walls iterate_four_walls() would visit.'''
+        corner2 = Vec(corner3.x, corner1.y, corner1.z)
+        corner4 = Vec(corner1.x, corner1.y, corner3.z)
+        walls = ((corner1, corner2), (corner2, corner3),
+                 (corner3, corner4), (corner4, corner1))
+        coords = [[], [], []]
+        for (a, b) in walls:
+            top = a.up(height)
+            grid = numpy.mgrid[min(a.x, b.x):max(a.x, b.x) + 1,
+                               min(a.y, b.y, top.y):max(a.y, b.y, top.y) + 1,
+                               min(a.z, b.z):max(a.z, b.z) + 1]
+            for i in xrange(3):
+                coords[i].append(grid[i].ravel())
+        self.setblocks(numpy.concatenate(coords[0]),
+                       numpy.concatenate(coords[1]),
+                       numpy.concatenate(coords[2]),
+                       material, data, hide, lock, soft, blank)
+
+    def fillmask(self, origin, mask, material, data=0, hide=False,
+                 lock=False, soft=False, blank=False):
+        '''Set the blocks where a boolean mask, indexed [x, y, z] from
+        origin, is True.'''
+        (xs, ys, zs) = numpy.nonzero(mask)
+        self.setblocks(xs + origin.x, ys + origin.y, zs + origin.z,
+                       material, data, hide, lock, soft, blank)
 
     def delblock(self, loc):
         if loc in self.blocks:
@@ -496,7 +490,78 @@ class Dungeon (object):
             return self.blocks[loc].material
         return False
 
+    def shrink(self):
+        '''Make the dungeon one step smaller. The largest dimension shrinks
+        first, with ties going to X, then Z, then levels. Returns False if
+        the dungeon is already as small as allowed.'''
+        sizes = [('xsize', cfg.min_x),
+                 ('zsize', cfg.min_z),
+                 ('levels', cfg.min_levels)]
+        sizes.sort(key=lambda s: getattr(self, s[0]), reverse=True)
+        for (name, minimum) in sizes:
+            if getattr(self, name) > minimum:
+                setattr(self, name, getattr(self, name) - 1)
+                return True
+        return False
+
+    def solvesize(self):
+        '''Shrink the dungeon until it fits somewhere in the good chunks.
+        The longest dungeon that fits for every width and number of levels
+        is worked out up front, so each step is a lookup. Returns False if
+        nothing fits.'''
+        offset = 0
+        if self.dinfo['fill_caves']:
+            offset = 10
+        if self.plan is not None:
+            grid = self.plan.grid
+        else:
+            grid = PlacementGrid(self.good_chunks)
+        lengths = grid.maxLengths(
+            range(cfg.min_x + offset, self.xsize + offset + 1),
+            [(l + 1) * self.room_height
+             for l in xrange(cfg.min_levels, self.levels + 1)],
+            cfg.min_z + offset)
+        while (
+            lengths[self.xsize - cfg.min_x, self.levels - cfg.min_levels] <
+            self.zsize + offset
+        ):
+            if self.shrink() is False:
+                return False
+        return True
+
+    def findplannedlocation(self):
+        '''findlocation() for runs that place more than one dungeon. The
+        candidates come from the shared placement plan, and the chosen
+        footprint is claimed from it.'''
+        offset = 0
+        if self.dinfo['fill_caves']:
+            offset = 10
+        depth = (self.levels + 1) * self.room_height
+        if self.args.debug:
+            print 'Selecting a planned location...'
+        for p in self.plan.candidates(self.xsize + offset,
+                                      self.zsize + offset,
+                                      depth):
+            self.position = Vec((p[0] + (offset / 2)) * self.room_size,
+                                0,
+                                (p[1] + (offset / 2)) * self.room_size)
+            if self.args.debug:
+                print 'Final: ', self.position
+            if self.bury():
+                self.plan.claim(p[0], p[1],
+                                self.xsize + offset,
+                                self.zsize + offset,
+                                (self.position.x >> 4, self.position.z >> 4))
+                positions = dict.fromkeys(self.plan.grid.corners(1, 1, depth))
+                self.worldmap(self.world, positions)
+                return True
+        if self.args.debug:
+            print 'No planned positions'
+        return False
+
     def findlocation(self):
+        if self.plan is not None:
+            return self.findplannedlocation()
         positions = {}
         sorted_p = []
         world = self.world
@@ -506,17 +571,19 @@ class Dungeon (object):
             if value >= (self.levels + 1) * self.room_height:
                 positions[key] = value
 
+        grid = PlacementGrid(self.good_chunks)
         if (cfg.maximize_distance and len(self.dungeon_cache) > 0):
             if self.args.debug:
                 print 'Marking distances...'
+            # Distance from every chunk to the nearest existing dungeon.
+            dungeons = []
+            for dungeon in self.dungeon_cache:
+                (x, z) = dungeon.split(",")
+                dungeons.append((int(x) >> 4, int(z) >> 4))
+            dist = grid.distances(dungeons)
             for key in positions.keys():
-                d = 2 ^ 64
-                chunk = Vec(key[0], 0, key[1])
-                for dungeon in self.dungeon_cache:
-                    (x, z) = dungeon.split(",")
-                    dpos = Vec(int(x) >> 4, 0, int(z) >> 4)
-                    d = min(d, (dpos - chunk).mag2d())
-                positions[key] = d
+                positions[key] = float(dist[key[0] - grid.x0,
+                                            key[1] - grid.z0])
 
             sorted_p = sorted(positions.iteritems(),
                               reverse=True,
@@ -527,19 +594,19 @@ class Dungeon (object):
 
         if self.args.debug:
             print 'Selecting a location...'
-        all_chunks = set(positions.keys())
         # Offset is fill caves. Expand the size of the dungeon if fill_caves is
         # set. When recording the position, we'll center the dungeon in this
         # area.
         offset = 0
         if self.dinfo['fill_caves']:
             offset = 10
+        # Every corner where the whole area is good and deep enough.
+        fits = grid.corners(
+            self.xsize + offset,
+            self.zsize + offset,
+            (self.levels + 1) * self.room_height)
         for p, d in sorted_p:
-            d_chunks = set()
-            for x in xrange(self.xsize + offset):
-                for z in xrange(self.zsize + offset):
-                    d_chunks.add((p[0] + x, p[1] + z))
-            if d_chunks.issubset(all_chunks):
+            if p in fits:
                 if self.args.debug:
                     print 'Found: ', p
                 self.position = Vec((p[0] + (offset / 2)) * self.room_size,
@@ -616,6 +683,22 @@ class Dungeon (object):
                     sys.stdout.write('``')
             print
 
+    def cachedchunk(self, chunk):
+        '''Return the dominant biome and depth recorded for a chunk in the
+        chunk cache when it was classified. Either is None if it was not
+        worked out then. River chunks record the river rather than the
+        dominant biome. Good chunks that are no longer in good_chunks have
+        been built on, so their depth is not trusted.'''
+        entry = self.chunk_cache.get(chunk)
+        if entry is None:
+            return None, None
+        (result, biome, depth) = entry
+        if result == 'R':
+            biome = None
+        if result not in ('H', 'L'):
+            depth = None
+        return biome, depth
+
     def bury(self, manual=False):
         if self.args.debug:
             print 'Burying dungeon...'
@@ -628,23 +711,29 @@ class Dungeon (object):
             for z in xrange(self.zsize):
                 d_chunks.add((p[0] + x, p[1] + z))
 
-        # Calaculate the biome
+        # Calaculate the biome. Most chunks had theirs worked out when they
+        # were classified, so only the rest need to be loaded.
         biomes = {}
         for chunk in d_chunks:
-            cdata = self.world.getChunk(chunk[0], chunk[1])
-            key = numpy.argmax(numpy.bincount((cdata.Biomes.flatten())))
+            (key, d1) = self.cachedchunk(chunk)
+            if key is None:
+                cdata = self.world.getChunk(chunk[0], chunk[1])
+                key = numpy.argmax(numpy.bincount((cdata.Biomes.flatten())))
             if key in biomes:
                 biomes[key] += 1
             else:
                 biomes[key] = 1
-            self.biome = max(biomes, key=lambda k: biomes[k])
+        self.biome = max(biomes, key=lambda k: biomes[k])
         if self.args.debug:
             print 'Biome: ', self.biome
 
         depth = self.world.Height
         for chunk in d_chunks:
             if (chunk not in self.good_chunks):
-                d1 = findChunkDepth(Vec(chunk[0], 0, chunk[1]), self.world)
+                (key, d1) = self.cachedchunk(chunk)
+                if d1 is None:
+                    d1 = findChunkDepth(Vec(chunk[0], 0, chunk[1]),
+                                        self.world)
                 self.good_chunks[chunk] = d1
             else:
                 d1 = self.good_chunks[chunk]
@@ -1036,6 +1125,19 @@ class Dungeon (object):
         root_tag = get_tile_entity_tags(eid="EndGateway",Pos=loc,ExitPos=exitloc,ExactTeleport=1)
         self.addtileentity(root_tag)
 
+    def editchunk(self, cx, cz):
+        '''Return a copy of a chunk for ruins to draw straight into. The
+        changes are written to the world along with the block buffer, once
+        the dungeon is in the commit journal. The blocks of the chunk are
+        kept as they were, so only the blocks the ruins changed are
+        written.'''
+        if (cx, cz) not in self.chunk_edits:
+            chunk = self.world.getChunk(cx, cz)
+            self.chunk_edits[(cx, cz)] = (ChunkCopy(chunk),
+                                          chunk.Blocks.copy(),
+                                          chunk.Data.copy())
+        return self.chunk_edits[(cx, cz)][0]
+
     def addentity(self, root_tag):
         self.ents.append(root_tag)
 
@@ -1880,9 +1982,35 @@ class Dungeon (object):
                 x.render()
         self.pm.set_complete()
 
+    def resolvemeta(self):
+        '''Turn every meta material block in the buffer into the material it
+        stands for. Each block is only resolved once, so the world and the
+        html and terminal output all agree.'''
+        (xs, ys, zs, mids, dats, flags) = self.blocks.arrays()
+        rand = None
+        for m, mat in enumerate(self.blocks.palette):
+            if (mat is None or mat._meta is False):
+                continue
+            sel = mids == m
+            if not sel.any():
+                continue
+            if rand is None:
+                rand = numpy.random.RandomState(random.getrandbits(32))
+            (bx, by, bz) = (xs[sel], ys[sel], zs[sel])
+            idx = mat.choose(bx, by, bz,
+                             self.xsize * self.room_size,
+                             self.levels * self.room_height,
+                             self.zsize * self.room_size,
+                             rand)
+            for i, choice in enumerate(mat.choices):
+                pick = idx == i
+                self.blocks.replace(bx[pick], by[pick], bz[pick],
+                                    choice, choice.data)
+
     def outputterminal(self):
         '''Print a slice (or layer) of the dungeon block buffer to the termial.
         We "look-through" any air blocks to blocks underneath'''
+        self.resolvemeta()
         floor = self.args.term
         layer = (floor - 1) * self.room_height
         for z in xrange(self.zsize * self.room_size):
@@ -1897,11 +2025,6 @@ class Dungeon (object):
                 if (Vec(x, y, z) in self.blocks and
                         self.blocks[Vec(x, y, z)].hide == False):
                     mat = self.blocks[Vec(x, y, z)].material
-                    if (mat._meta):
-                        mat.update(x, y, z,
-                                   self.xsize * self.room_size,
-                                   self.levels * self.room_height,
-                                   self.zsize * self.room_size)
                     sys.stdout.write(mat.c)
                 else:
                     sys.stdout.write(materials.NOBLOCK)
@@ -1914,6 +2037,7 @@ class Dungeon (object):
         dungeon_name  = re.sub(r'[^a-zA-Z0-9_]', "", dungeon_name)
         basename = self.args.html.replace('__DUNGEON__', dungeon_name)
         force = self.args.force
+        self.resolvemeta()
         # First search for existing files
         if (force == False):
             for floor in xrange(self.levels):
@@ -1973,12 +2097,6 @@ class Dungeon (object):
                         y += 1
                     if (Vec(x, y, z) in self.blocks):
                         mat = self.blocks[Vec(x, y, z)].material
-                        if (mat._meta):
-                            mat.update(x, y, z,
-                                       self.xsize * self.room_size,
-                                       self.levels * self.room_height,
-                                       self.zsize * self.room_size)
-                            self.blocks[Vec(x, y, z)].data = mat.data
                         dat = self.blocks[Vec(x, y, z)].data
 
                         # Doors are ... different
@@ -2107,22 +2225,22 @@ class Dungeon (object):
         if self.args.debug:
             print '   Base height:', baseheight
         chunk = self.world.getChunk(wcoord.x >> 4, wcoord.z >> 4)
-        for x in xrange(wcoord.x + 4, wcoord.x + 12):
-            for z in xrange(wcoord.z + 4, wcoord.z + 12):
-                xInChunk = x & 0xf
-                zInChunk = z & 0xf
-                # Heightmap is a good starting place, but I need to look
-                # down through foliage.
-                y = chunk.HeightMap[zInChunk, xInChunk] - 1
-                while (
-                    chunk.Blocks[xInChunk, zInChunk, y] not in materials.heightmap_solids
-                ):
-                    y -= 1
-                if (chunk.Blocks[xInChunk, zInChunk, y] == 9 or
-                        chunk.Blocks[xInChunk, zInChunk, y] == 79):
-                    self.entrance.inwater = True
-                high_height = max(y, high_height)
-                low_height = min(y, low_height)
+        xInChunk = (wcoord.x + 4) & 0xf
+        zInChunk = (wcoord.z + 4) & 0xf
+        blocks = chunk.Blocks[xInChunk:xInChunk + 8, zInChunk:zInChunk + 8]
+        # Heightmap is a good starting place, but I need to look
+        # down through foliage.
+        heights = findSurfaceHeights(
+            blocks,
+            chunk.HeightMap[zInChunk:zInChunk + 8,
+                            xInChunk:xInChunk + 8].T.astype(int) - 1
+        )
+        ix, iz = numpy.indices(heights.shape)
+        surface = blocks[ix, iz, heights]
+        if ((surface == 9) | (surface == 79)).any():
+            self.entrance.inwater = True
+        high_height = max(int(heights.max()), high_height)
+        low_height = min(int(heights.min()), low_height)
         if self.args.debug:
             print "    Low height:", low_height
             print "   High height:", high_height
@@ -2168,7 +2286,6 @@ class Dungeon (object):
         '''Write the block buffer to the specified world'''
         world = self.world
         changed_chunks = set()
-        num_blocks = len(self.blocks)
         # Fill caves
         if (self.dinfo['fill_caves'] is True):
             num = (self.zsize + 10) * (self.xsize + 10)
@@ -2243,89 +2360,122 @@ class Dungeon (object):
                                60, materials.Bedrock)
             pm.set_complete()
         # Blocks
+        self.resolvemeta()
+        # The buffer is written a chunk at a time. Each rule below is a mask
+        # over the blocks in one chunk, and the survivors are written with
+        # one assignment.
+        (xs, ys, zs, mids, dats, flags) = self.blocks.arrays()
+        palette = self.blocks.palette
+        # Per material lookups, indexed by palette id.
+        pal_val = numpy.array([0] + [m.val for m in palette[1:]])
+        pal_sandbar = numpy.array([m is materials._sandbar
+                                   for m in palette])
+        pal_natural = numpy.array([m is materials._natural
+                                   for m in palette])
+        water = (materials.Water.val,
+                 materials.StillWater.val,
+                 materials.Ice.val)
+        # Mysteriously, these blocks contain no material.
+        keep = mids > 0
+        # Translate block coords to world coords
+        wxs = xs + self.position.x
+        wys = self.position.y - ys
+        wzs = zs + self.position.z
+        # Due to bad planning, sometimes we try to draw outside the bounds
+        outside = keep & ((wys < 0) | (wys >= world.Height))
+        for y in wys[outside]:
+            print 'WARN: Block outside height bounds. y =', y
+        keep &= ~outside
+        # Group the blocks by chunk.
+        cxs = wxs >> 4
+        czs = wzs >> 4
+        sel = numpy.flatnonzero(keep)
+        sel = sel[numpy.lexsort((czs[sel], cxs[sel]))]
+        bounds = numpy.flatnonzero((numpy.diff(cxs[sel]) != 0) |
+                                   (numpy.diff(czs[sel]) != 0)) + 1
+        groups = numpy.split(sel, bounds) if len(sel) > 0 else []
+        if cfg.silverfish > 0:
+            if self.write_seed is None:
+                self.write_seed = random.getrandbits(32)
+            rand = numpy.random.RandomState(self.write_seed)
+        volume = LightVolume()
+        # Anything ruins drew straight into chunks goes in first, with the
+        # block buffer on top, as if they had drawn into the world. Only the
+        # blocks they changed are copied, so the caves filled above stay
+        # filled.
+        for (chunk_x, chunk_z), edits in self.chunk_edits.iteritems():
+            (edit, blocks, data) = edits
+            changed = (edit.Blocks != blocks) | (edit.Data != data)
+            if not changed.any():
+                continue
+            chunk = world.getChunk(chunk_x, chunk_z)
+            chunk.Blocks[changed] = edit.Blocks[changed]
+            chunk.Data[changed] = edit.Data[changed]
+            (xs, zs, ys) = numpy.nonzero(changed)
+            volume.add(xs + (chunk_x << 4), ys, zs + (chunk_z << 4))
+            changed_chunks.add(chunk)
+        num_chunks = len(groups)
         pm = pmeter.ProgressMeter()
-        pm.init(num_blocks, label='Writing block buffer:')
-        for block in self.blocks.values():
+        pm.init(num_chunks, label='Writing block buffer:')
+        for g in groups:
             # Progress
-            pm.update_left(num_blocks)
-            num_blocks -= 1
-            # Mysteriously, this block contains no material.
-            if block.material is None:
-                continue
-            # Translate block coords to world coords
-            x = block.loc.x + self.position.x
-            y = self.position.y - block.loc.y
-            z = block.loc.z + self.position.z
-            # Due to bad planning, sometimes we try to draw outside the bounds
-            if (y < 0 or y >= world.Height):
-                print 'WARN: Block outside height bounds. y =', y
-                continue
-            # Figure out the chunk and chunk offset
-            chunk_z = z >> 4
-            chunk_x = x >> 4
-            xInChunk = x & 0xf
-            zInChunk = z & 0xf
+            pm.update_left(num_chunks)
+            num_chunks -= 1
+            chunk_x = int(cxs[g[0]])
+            chunk_z = int(czs[g[0]])
+            mid = mids[g]
             # get the chunk
             if (world.containsChunk(chunk_x, chunk_z)):
                 chunk = world.getChunk(chunk_x, chunk_z)
             else:
-                if (block.material != materials._sandbar):
+                for i in g[~pal_sandbar[mid]]:
                     print 'Whoops! Block in nonexistent chunk!',
                     print 'crd: (%d, %d) chk: (%d, %d) mat: %s' % \
-                        (x, z, chunk_x, chunk_z, block.material.name)
+                        (wxs[i], wzs[i], chunk_x, chunk_z,
+                         palette[mids[i]].name)
                 continue
+            xInChunk = wxs[g] & 0xf
+            zInChunk = wzs[g] & 0xf
+            y = wys[g]
+            existing = chunk.Blocks[xInChunk, zInChunk, y]
             # Don't render soft blocks if there is something there already
-            if (block.soft is True and
-                    chunk.Blocks[xInChunk, zInChunk, y] > 0):
-                continue
-            mat = block.material
-            dat = block.data
-            # Update meta materials
-            if (mat._meta):
-                mat.update(block.loc.x, block.loc.y, block.loc.z,
-                           self.xsize * self.room_size,
-                           self.levels * self.room_height,
-                           self.zsize * self.room_size)
-                dat = mat.data
+            write = ~(((flags[g] & SOFT) > 0) & (existing > 0))
             # Sandbars only render over water
-            if (mat == materials._sandbar and
-                    chunk.Blocks[xInChunk, zInChunk, y] != materials.Water.val and
-                    chunk.Blocks[xInChunk, zInChunk, y] != materials.StillWater.val and
-                    chunk.Blocks[xInChunk, zInChunk, y] != materials.Ice.val):
-                continue
+            write &= ~pal_sandbar[mid] | numpy.in1d(existing, water)
             # Natural just looks like the existing world block
-            if (mat == materials._natural):
+            write &= ~pal_natural[mid]
+            if not write.any():
                 continue
-
-            val = mat.val
+            val = pal_val[mid]
+            dat = dats[g]
             # Silverfish egg pass
-            # Look for cobblestone, stone (normal variant only) and all stone bricks
-            if (cfg.silverfish > 0 and
-                    ((val == 1 and dat == 0) or val == 4 or val == 98) and
-                    random.randint(1, 100) <= cfg.silverfish):
-                if (val == 4):
-                    dat = 1  # Cobblestone
-                elif (val == 1):
-                    dat = 0  # Smooth Stone
-                elif (val == 98):
-                    if (dat == 0):
-                        dat = 2  # Bricks
-                    elif (dat == 1):
-                        dat = 3  # Mossy Bricks
-                    elif (dat == 2):
-                        dat = 4  # Cracked Bricks
-                    elif (dat == 3):
-                        dat = 5  # Chiseled Bricks
-                val = 97    # Switch to egg brick
-
-            # Write the block.
-            chunk.Blocks[xInChunk, zInChunk, y] = val
-            chunk.Data[xInChunk, zInChunk, y] = dat
+            # Look for cobblestone, stone (normal variant only) and all
+            # stone bricks
+            if (cfg.silverfish > 0):
+                egg = write & (((val == 1) & (dat == 0)) |
+                               (val == 4) |
+                               (val == 98))
+                egg &= rand.randint(1, 101, len(val)) <= cfg.silverfish
+                # Cobblestone
+                dat[egg & (val == 4)] = 1
+                # Smooth Stone stays 0. Bricks, Mossy Bricks, Cracked
+                # Bricks and Chiseled Bricks are 2 - 5.
+                dat[egg & (val == 98) & (dat <= 3)] += 2
+                val[egg] = 97    # Switch to egg brick
+
+            # Note where the light needs to be redone.
+            volume.add(wxs[g][write], y[write], wzs[g][write])
+
+            # Write the blocks.
+            chunk.Blocks[xInChunk[write], zInChunk[write], y[write]] = \
+                val[write]
+            chunk.Data[xInChunk[write], zInChunk[write], y[write]] = \
+                dat[write]
             # Add this to the list we want to relight later.
             changed_chunks.add(chunk)
             # Make sure we don't overwrite this chunk in the future.
             if ((chunk_x, chunk_z) in self.good_chunks and
-                    mat != materials._sandbar):
+                    (write & ~pal_sandbar[mid]).any()):
                 del(self.good_chunks[(chunk_x, chunk_z)])
         pm.set_complete()
 
@@ -2389,6 +2539,9 @@ class Dungeon (object):
             spin(num)
             num -= 1
             chunk.chunkChanged()
+        self.changed_chunks = set(chunk.chunkPosition
+                                  for chunk in changed_chunks)
+        self.light_volume = volume
 
     def keyName(self):
         ''' Generate a random name for a key 
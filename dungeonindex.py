@@ -0,0 +1,164 @@
+import cPickle
+import os
+
+# The index is a small pickled dict beside the other caches. Footprints are
+# kept as chunk rectangles and bucketed by region in memory, so point and
+# overlap queries only look at the structures near them.
+_version = 1
+_bucket_shift = 5
+
+# fill_caves clears this many chunks around a dungeon.
+fill_caves_padding = 5
+
+
+def dungeonFootprint(info):
+    '''Return the chunk rectangles covered by a dungeon, including the area
+    cleared by fill_caves. Rectangles are (cx0, cz0, cx1, cz1), with the far
+    edges excluded.'''
+    cx = info['position'].x >> 4
+    cz = info['position'].z >> 4
+    pad = 0
+    if info.get('fill_caves'):
+        pad = fill_caves_padding
+    return [(cx - pad,
+             cz - pad,
+             cx + info['xsize'] + pad,
+             cz + info['zsize'] + pad)]
+
+
+def tHuntFootprint(info):
+    '''Return the chunk rectangles covered by a treasure hunt. That is the
+    chunk holding its data library and one chunk for each landmark.'''
+    rects = set()
+    for p in [info['position']] + list(info.get('landmarks', [])):
+        rects.add((p.x >> 4, p.z >> 4, (p.x >> 4) + 1, (p.z >> 4) + 1))
+    return sorted(rects)
+
+
+def _buckets(rect):
+    (x0, z0, x1, z1) = rect
+    for bx in xrange(x0 >> _bucket_shift, ((x1 - 1) >> _bucket_shift) + 1):
+        for bz in xrange(z0 >> _bucket_shift,
+                         ((z1 - 1) >> _bucket_shift) + 1):
+            yield (bx, bz)
+
+
+class DungeonIndex(object):
+
+    '''Every dungeon and treasure hunt known to be on a map, keyed by the
+    same 'x,z' keys as the dungeon and treasure hunt caches. Each entry keeps
+    its kind ('dungeon' or 'thunt'), the decoded data library and its
+    footprint. mtime is the time of the last world scan the index agrees
+    with. Changes are held in memory until save().'''
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = 0
+        self.entries = {}
+        self.buckets = {}
+        if os.path.exists(path):
+            FILE = open(path, 'rb')
+            data = cPickle.load(FILE)
+            FILE.close()
+            if data.get('version') != _version:
+                print 'Dungeon index is an unknown format. Resetting...'
+                return
+            self.mtime = data['mtime']
+            for key, (kind, info, rects) in data['entries'].iteritems():
+                self._insert(key, kind, info, rects)
+
+    def _insert(self, key, kind, info, rects):
+        self.entries[key] = (kind, info, rects)
+        for rect in rects:
+            for b in _buckets(rect):
+                self.buckets.setdefault(b, set()).add(key)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, key, kind, info):
+        '''Add or replace a structure given its decoded data library.'''
+        if key in self.entries:
+            self.remove(key)
+        if kind == 'dungeon':
+            rects = dungeonFootprint(info)
+        else:
+            rects = tHuntFootprint(info)
+        self._insert(key, kind, info, rects)
+
+    def remove(self, key):
+        (kind, info, rects) = self.entries.pop(key)
+        for rect in rects:
+            for b in _buckets(rect):
+                bucket = self.buckets[b]
+                bucket.discard(key)
+                if len(bucket) == 0:
+                    del self.buckets[b]
+
+    def kind(self, key):
+        return self.entries[key][0]
+
+    def info(self, key):
+        return self.entries[key][1]
+
+    def footprint(self, key):
+        return self.entries[key][2]
+
+    def items(self, kind=None):
+        '''Return (key, info) pairs, optionally only for one kind.'''
+        return [(key, e[1]) for key, e in self.entries.iteritems()
+                if kind is None or e[0] == kind]
+
+    def footprintChunks(self, key):
+        '''Return the set of chunks covered by a structure.'''
+        chunks = set()
+        for (x0, z0, x1, z1) in self.footprint(key):
+            for cx in xrange(x0, x1):
+                for cz in xrange(z0, z1):
+                    chunks.add((cx, cz))
+        return chunks
+
+    def at(self, cx, cz):
+        '''Return the keys of the structures covering a chunk.'''
+        keys = []
+        b = (cx >> _bucket_shift, cz >> _bucket_shift)
+        for key in self.buckets.get(b, ()):
+            for (x0, z0, x1, z1) in self.entries[key][2]:
+                if x0 <= cx < x1 and z0 <= cz < z1:
+                    keys.append(key)
+                    break
+        return keys
+
+    def overlapping(self, rect):
+        '''Return the keys of the structures overlapping a chunk
+        rectangle.'''
+        (x0, z0, x1, z1) = rect
+        candidates = set()
+        for b in _buckets(rect):
+            candidates.update(self.buckets.get(b, ()))
+        keys = []
+        for key in candidates:
+            for (ex0, ez0, ex1, ez1) in self.entries[key][2]:
+                if ex0 < x1 and x0 < ex1 and ez0 < z1 and z0 < ez1:
+                    keys.append(key)
+                    break
+        return keys
+
+    def save(self):
+        '''Write the index out. The new file is written beside the old one
+        and moved into place, so a crash leaves one or the other.'''
+        data = {
+            'version': _version,
+            'mtime': self.mtime,
+            'entries': self.entries,
+        }
+        tmp_path = self.path + '.tmp'
+        FILE = open(tmp_path, 'wb')
+        cPickle.dump(data, FILE, -1)
+        FILE.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmp_path, self.path)
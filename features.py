@@ -6,6 +6,7 @@ import loottable
 import items
 import shop
 from utils import *
+import numpy
 import perlin
 from pymclevel import nbt
 
@@ -252,8 +253,8 @@ class TowerWithLadder(Blank):
                        mats[top[z][x]][1])
 
         # finish ladder
-        for x in iterate_cube(start.trans(2, 0, 1), start.trans(3, 2, 1)):
-            sb(x, materials.Ladder, 3)
+        self.parent.parent.fillcube(start.trans(2, 0, 1), start.trans(3, 2, 1),
+                                    materials.Ladder, 3)
 
 
 class Scaffolding(Blank):
@@ -533,8 +534,12 @@ class Mushrooms(Blank):
         if mode == 'perlin':
             pn = perlin.SimplexNoise(256)
             r = random.randint(1, 1000)
-            for p in iterate_points_inside_flat_poly(*self.parent.canvas):
-                if (pn.noise3(p.x / 4.0, r / 4.0, p.z / 4.0) > .8):
+            points = list(iterate_points_inside_flat_poly(*self.parent.canvas))
+            xs = numpy.array([p.x for p in points])
+            zs = numpy.array([p.z for p in points])
+            noise = pn.noise3array(xs / 4.0, r / 4.0, zs / 4.0)
+            for (p, n) in zip(points, noise):
+                if (n > .8):
                     q = p + self.parent.loc
                     sb(q.trans(1, -1, 0))
                     sb(q.trans(-1, -1, 0))
@@ -673,16 +678,22 @@ class SecretRoom(Blank):
         sb = self.parent.parent.setblock
 
         # Reform the basic room shape.
-        for p in iterate_cube(self.parent.loc,
-                              self.parent.loc + Vec(self.parent.parent.room_size - 1,
-                                                    self.parent.parent.room_height - 2,
-                                                    self.parent.parent.room_size - 1)):
-            # Remove all blocks.
-            sb(p, None)
-            # Clear out any doors or extra torches.
-            if p in self.parent.parent.doors:
+        box = Box(self.parent.loc,
+                  self.parent.parent.room_size,
+                  self.parent.parent.room_height - 1,
+                  self.parent.parent.room_size)
+        # Remove all blocks.
+        self.parent.parent.fillcube(box.loc,
+                                    box.loc + Vec(box.w - 1,
+                                                  box.h - 1,
+                                                  box.d - 1),
+                                    None)
+        # Clear out any doors or extra torches.
+        for p in self.parent.parent.doors.keys():
+            if box.containsPoint(p):
                 del(self.parent.parent.doors[p])
-            if p in self.parent.parent.torches:
+        for p in self.parent.parent.torches.keys():
+            if box.containsPoint(p):
                 del(self.parent.parent.torches[p])
 
         self.c1 = self.parent.loc + Vec(3,
@@ -692,14 +703,14 @@ class SecretRoom(Blank):
                                         self.parent.parent.room_height - 2,
                                         self.parent.parent.room_size - 4)
 
-        for q in iterate_cube(self.c1.up(1), self.c3.up(3)):
-            sb(q, materials.Air)
-        for q in iterate_cube(self.c1.up(4), self.c3.up(4)):
-            sb(q, materials._ceiling)
-        for q in iterate_cube(self.c1, self.c3):
-            sb(q, materials._floor)
-        for q in iterate_four_walls(self.c1, self.c3, self.parent.parent.room_height - 2):
-            sb(q, materials._wall)
+        self.parent.parent.fillcube(self.c1.up(1), self.c3.up(3),
+                                    materials.Air)
+        self.parent.parent.fillcube(self.c1.up(4), self.c3.up(4),
+                                    materials._ceiling)
+        self.parent.parent.fillcube(self.c1, self.c3, materials._floor)
+        self.parent.parent.fillfourwalls(self.c1, self.c3,
+                                         self.parent.parent.room_height - 2,
+                                         materials._wall)
 
         # Fix the hallway and create the secret door mechansm.
         # Find the direction, room, and connecting room.
@@ -1190,8 +1201,9 @@ class SecretSepulchure(SecretRoom):
             gems = ('S', 'N')
 
         # Different walls
-        for q in iterate_four_walls(self.c1, self.c3, self.parent.parent.room_height - 2):
-            sb(q, materials.meta_mossystonebrick)
+        dungeon.fillfourwalls(self.c1, self.c3,
+                              self.parent.parent.room_height - 2,
+                              materials.meta_mossystonebrick)
 
         # Loot for the sarcophagus.
         loota = []
@@ -1403,12 +1415,10 @@ class SecretShop(SecretRoom):
             banner_cols = [15,0]
 
         # Floor
-        for q in iterate_cube(self.c1, self.c3):
-            sb(q, floor)
+        dungeon.fillcube(self.c1, self.c3, floor)
 
         # Ceiling
-        for q in iterate_cube(self.c1.up(4), self.c3.up(4)):
-            sb(q, floor)
+        dungeon.fillcube(self.c1.up(4), self.c3.up(4), floor)
 
         # Pillers
         pillers_loc = [bl+(rt*5)+(fw*5),bl+rt+(fw*5),bl+(rt*5)+fw]
@@ -1436,10 +1446,8 @@ class SecretShop(SecretRoom):
             dungeon.adddungeonbanner(b[0])
 
         # Desks
-        for q in iterate_cube(bl.up(1)+rt+(fw*6), bl.up(1)+rt+(fw*8)):
-            sb(q, upperslab)
-        for q in iterate_cube(bl.up(1)+(rt*6)+fw, bl.up(1)+(rt*8)+fw):
-            sb(q, upperslab)
+        dungeon.fillcube(bl.up(1)+rt+(fw*6), bl.up(1)+rt+(fw*8), upperslab)
+        dungeon.fillcube(bl.up(1)+(rt*6)+fw, bl.up(1)+(rt*8)+fw, upperslab)
         # Ender chest
         p = bl.up(2)+rt+(fw*7)
         sb(p, materials.EnderChest, orient['U'])
@@ -1462,15 +1470,15 @@ class SecretShop(SecretRoom):
         sb(bl.up(1)+(rt*1)+(fw*2), materials.CraftingTable)
 
         # Top of booth
-        for q in iterate_cube(bl.up(3)+(rt*5)+(fw*4), bl.up(3)+(rt*5)+(fw*2)):
-            sb(q, upperslab)
-        for q in iterate_cube(bl.up(3)+(rt*4)+(fw*5), bl.up(3)+(rt*2)+(fw*5)):
-            sb(q, upperslab)
+        dungeon.fillcube(bl.up(3)+(rt*5)+(fw*4), bl.up(3)+(rt*5)+(fw*2),
+                         upperslab)
+        dungeon.fillcube(bl.up(3)+(rt*4)+(fw*5), bl.up(3)+(rt*2)+(fw*5),
+                         upperslab)
         # Bottom of booth
-        for q in iterate_cube(bl.up(1)+(rt*5)+(fw*4), bl.up(1)+(rt*5)+(fw*2)):
-            sb(q, upperslab)
-        for q in iterate_cube(bl.up(1)+(rt*4)+(fw*5), bl.up(1)+(rt*2)+(fw*5)):
-            sb(q, upperslab)
+        dungeon.fillcube(bl.up(1)+(rt*5)+(fw*4), bl.up(1)+(rt*5)+(fw*2),
+                         upperslab)
+        dungeon.fillcube(bl.up(1)+(rt*4)+(fw*5), bl.up(1)+(rt*2)+(fw*5),
+                         upperslab)
 
         # Desk plant
         sb(bl.up(2)+(rt*2)+(fw*5), materials.FlowerPot, random.randrange(1, 12))
@@ -1582,14 +1590,14 @@ class SecretArmory(SecretRoom):
         blocks = dungeon.blocks
 
         # Different ceiling
-        for q in iterate_cube(self.c1.up(4), self.c3.up(4)):
-            sb(q, materials.StoneBrickSlab, 13, hide=True)
+        dungeon.fillcube(self.c1.up(4), self.c3.up(4),
+                         materials.StoneBrickSlab, 13, hide=True)
         # Differnt floor
-        for q in iterate_cube(self.c1, self.c3):
-            sb(q, materials.meta_mossystonebrick)
+        dungeon.fillcube(self.c1, self.c3, materials.meta_mossystonebrick)
         # Different walls
-        for q in iterate_four_walls(self.c1, self.c3, self.parent.parent.room_height - 2):
-            sb(q, materials.meta_mossystonebrick)
+        dungeon.fillfourwalls(self.c1, self.c3,
+                              self.parent.parent.room_height - 2,
+                              materials.meta_mossystonebrick)
 
         # Fancy wall coverings
         for p in iterate_four_walls(Vec(1, -1, 1), Vec(8, -1, 8), 3):
@@ -1908,14 +1916,13 @@ class SecretEnchantingLibrary(SecretRoom):
             chests = (3, 4, 2)
 
         # Reform the room (again)
-        for q in iterate_cube(self.c1.up(1), self.c3.up(3)):
-            sb(q, materials.Air)
-        for q in iterate_cube(self.c1.up(4), self.c3.up(4)):
-            sb(q, materials.StoneBrickSlab, 13, hide=True)
-        for q in iterate_cube(self.c1, self.c3):
-            sb(q, materials.ChiseledStoneBrick)
-        for q in iterate_four_walls(self.c1, self.c3, self.parent.parent.room_height - 2):
-            sb(q, materials.meta_mossystonebrick)
+        dungeon.fillcube(self.c1.up(1), self.c3.up(3), materials.Air)
+        dungeon.fillcube(self.c1.up(4), self.c3.up(4),
+                         materials.StoneBrickSlab, 13, hide=True)
+        dungeon.fillcube(self.c1, self.c3, materials.ChiseledStoneBrick)
+        dungeon.fillfourwalls(self.c1, self.c3,
+                              self.parent.parent.room_height - 2,
+                              materials.meta_mossystonebrick)
 
         # Fancy carpet
         mats = [
@@ -2634,12 +2641,18 @@ class ConstructionArea(Blank):
         loc = self.parent.loc + Vec(0, -1, 0)
 
         # Replace some wall sections with wooden "rebar"
-        for x in xrange(self.parent.parent.room_size * self.parent.size.x):
-            for z in xrange(self.parent.parent.room_size * self.parent.size.z):
-                for y in xrange(self.parent.parent.room_height * self.parent.size.y - 3):
+        sx = self.parent.parent.room_size * self.parent.size.x
+        sz = self.parent.parent.room_size * self.parent.size.z
+        sy = self.parent.parent.room_height * self.parent.size.y - 3
+        (xs, ys, zs) = numpy.mgrid[0:sx, 0:sy, 0:sz]
+        noise = pn.noise3array((xs + self.parent.loc.x) / 4.0,
+                               (ys + self.parent.loc.y + 1338) / 4.0,
+                               (zs + self.parent.loc.z) / 4.0)
+        for x in xrange(sx):
+            for z in xrange(sz):
+                for y in xrange(sy):
                     p = self.parent.loc.trans(x, y, z) + Vec(0, 1, 0)
-                    if (gb(p) == materials._wall and
-                            pn.noise3(p.x / 4.0, (p.y + 1337) / 4.0, p.z / 4.0) < 0):
+                    if (gb(p) == materials._wall and noise[x, y, z] < 0):
                         sb(p, materials.Fence)
                     elif (gb(p) == materials.Torch):
                         sb(p, materials.Air)
@@ -1,6 +1,8 @@
 import sys
 import inspect
 
+import numpy
+
 import materials
 import random
 import perlin
@@ -17,6 +19,18 @@ class Blank(object):
     def render(self):
         pass
 
+    def canvasnoise(self, pn, r):
+        '''Return (point, noise) pairs for the points inside the canvas. The
+        noise for the whole canvas comes from one call, and is scaled to
+        0 - 1.'''
+        points = list(utils.iterate_points_inside_flat_poly(
+            *self.parent.canvas))
+        xs = numpy.array([x.x for x in points]) + self.parent.loc.x
+        zs = numpy.array([x.z for x in points]) + self.parent.loc.z
+        y = self.parent.canvasHeight()
+        n = (pn.noise3array((xs + r) / 4.0, y / 4.0, zs / 4.0) + 1.0) / 2.0
+        return zip(points, n)
+
 
 class Cobble(Blank):
     _name = 'cobble'
@@ -32,14 +46,12 @@ class Cobble(Blank):
         if (self.ruin is False):
             return
         c = self.parent.canvasCenter()
-        y = self.parent.canvasHeight()
         r = random.randint(1, 1000)
         maxd = max(1, self.parent.canvasWidth(), self.parent.canvasLength())
         pn = perlin.SimplexNoise(256)
-        for x in utils.iterate_points_inside_flat_poly(*self.parent.canvas):
+        for (x, n) in self.canvasnoise(pn, r):
             p = x + self.parent.loc
             d = ((Vec2f(x.x, x.z) - c).mag()) / maxd
-            n = (pn.noise3((p.x + r) / 4.0, y / 4.0, p.z / 4.0) + 1.0) / 2.0
             if (n < d):
                 self.parent.parent.setblock(p, materials._floor)
                 self.parent.parent.blocks[p].data = 0
@@ -86,14 +98,12 @@ class StoneTile(Blank):
         if (self.ruin is False):
             return
         c = self.parent.canvasCenter()
-        y = self.parent.canvasHeight()
         r = random.randint(1, 1000)
         maxd = max(1, self.parent.canvasWidth(), self.parent.canvasLength())
         pn = perlin.SimplexNoise(256)
-        for x in utils.iterate_points_inside_flat_poly(*self.parent.canvas):
+        for (x, n) in self.canvasnoise(pn, r):
             p = x + self.parent.loc
             d = ((Vec2f(x.x, x.z) - c).mag()) / maxd
-            n = (pn.noise3((p.x + r) / 4.0, y / 4.0, p.z / 4.0) + 1.0) / 2.0
             if (n < d):
                 self.parent.parent.setblock(p, materials._floor)
                 self.parent.parent.blocks[p].data = 0
@@ -241,13 +251,11 @@ class RadialRug(Blank):
         # this chunk of code is copied from CheckerRug's render() method
         pn = perlin.SimplexNoise(256)
         c = self.parent.canvasCenter()
-        y = self.parent.canvasHeight()
         r = random.randint(1, 1000)
         maxd = max(1, self.parent.canvasWidth(), self.parent.canvasLength())
-        for x in utils.iterate_points_inside_flat_poly(*self.parent.canvas):
+        for (x, n) in self.canvasnoise(pn, r):
             p = x + self.parent.loc
             d = ((Vec2f(x.x, x.z) - c).mag()) / maxd
-            n = (pn.noise3((p.x + r) / 4.0, y / 4.0, p.z / 4.0) + 1.0) / 2.0
             if (n < d):
                 self.parent.parent.setblock(p, materials._floor)
                 self.parent.parent.blocks[p].data = 0
@@ -302,13 +310,11 @@ class CheckerRug(Blank):
             return
         pn = perlin.SimplexNoise(256)
         c = self.parent.canvasCenter()
-        y = self.parent.canvasHeight()
         r = random.randint(1, 1000)
         maxd = max(1, self.parent.canvasWidth(), self.parent.canvasLength())
-        for x in utils.iterate_points_inside_flat_poly(*self.parent.canvas):
+        for (x, n) in self.canvasnoise(pn, r):
             p = x + self.parent.loc
             d = ((Vec2f(x.x, x.z) - c).mag()) / maxd
-            n = (pn.noise3((p.x + r) / 4.0, y / 4.0, p.z / 4.0) + 1.0) / 2.0
             if (n < d):
                 self.parent.parent.setblock(p, materials._floor)
                 self.parent.parent.blocks[p].data = 0
@@ -345,13 +351,11 @@ class DoubleSlab(Blank):
         if (self.ruin is False):
             return
         c = self.parent.canvasCenter()
-        y = self.parent.canvasHeight()
         r = random.randint(1, 1000)
         maxd = max(1, self.parent.canvasWidth(), self.parent.canvasLength())
-        for x in utils.iterate_points_inside_flat_poly(*self.parent.canvas):
+        for (x, n) in self.canvasnoise(pn, r):
             p = x + self.parent.loc
             d = ((Vec2f(x.x, x.z) - c).mag()) / maxd
-            n = (pn.noise3((p.x + r) / 4.0, y / 4.0, p.z / 4.0) + 1.0) / 2.0
             if (n < d):
                 self.parent.parent.setblock(p, materials._floor)
                 self.parent.parent.blocks[p].data = 0
@@ -370,13 +374,11 @@ class Mud(Blank):
         if (utils.sum_points_inside_flat_poly(*self.parent.canvas) <= 4):
             return
         c = self.parent.canvasCenter()
-        y = self.parent.canvasHeight()
         r = random.randint(1, 1000)
         maxd = max(1, self.parent.canvasWidth(), self.parent.canvasLength())
-        for x in utils.iterate_points_inside_flat_poly(*self.parent.canvas):
+        for (x, n) in self.canvasnoise(pn, r):
             p = x + self.parent.loc
             d = ((Vec2f(x.x, x.z) - c).mag()) / maxd
-            n = (pn.noise3((p.x + r) / 4.0, y / 4.0, p.z / 4.0) + 1.0) / 2.0
             if (n >= d + .50):
                 self.parent.parent.setblock(p, materials.Water)
             elif (n >= d + .30):
@@ -399,13 +401,11 @@ class Sand(Blank):
         if (utils.sum_points_inside_flat_poly(*self.parent.canvas) <= 4):
             return
         c = self.parent.canvasCenter()
-        y = self.parent.canvasHeight()
         r = random.randint(1, 1000)
         maxd = max(1, self.parent.canvasWidth(), self.parent.canvasLength())
-        for x in utils.iterate_points_inside_flat_poly(*self.parent.canvas):
+        for (x, n) in self.canvasnoise(pn, r):
             p = x + self.parent.loc
             d = ((Vec2f(x.x, x.z) - c).mag()) / maxd
-            n = (pn.noise3((p.x + r) / 4.0, y / 4.0, p.z / 4.0) + 1.0) / 2.0
             if (n >= d + .20):
                 self.parent.parent.setblock(p, materials.Sand)
             elif (n >= d + .10):
@@ -502,16 +502,9 @@ class Bridges(Blank):
             maxd = max(1,
                        self.parent.canvasWidth(),
                        self.parent.canvasLength())
-            for x in utils.iterate_points_inside_flat_poly(
-                *self.parent.canvas
-            ):
+            for (x, n) in self.canvasnoise(pn, r):
                 p = x + self.parent.loc
                 d = ((Vec2f(x.x, x.z) - c).mag()) / maxd
-                n = (
-                    pn.noise3(
-                        (p.x + r) / 4.0,
-                        y / 4.0,
-                        p.z / 4.0) + 1.0) / 2.0
                 if (n >= d + .10):
                     self.parent.parent.setblock(p, materials.Sand)
                 elif (n >= d):
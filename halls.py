@@ -96,24 +96,28 @@ def drawHall(hall):
         dd1 = 3
         dd2 = 2
         torch_dat = 1
-    for j in xrange(length):
-        pen = start + stepl * j
-        # First wall
-        for k in xrange(hall.parent.parent.room_height - 1):
-            hall.parent.parent.setblock(pen.down(k), materials._wall)
+    # The hall is drawn as boxes running its whole length. end is the far
+    # end of the first wall, and width is the offset of the second.
+    dungeon = hall.parent.parent
+    if length > 0:
+        end = start + stepl * (length - 1)
+        width = stepw * (max(hall.size - 2, 0) + 1)
+        wall = dungeon.room_height - 2
+        # Walls
+        dungeon.fillcube(start, end.down(wall), materials._wall)
+        dungeon.fillcube(start + width, end.down(wall) + width,
+                         materials._wall)
         # hallway (ceiling and floor)
-        for x in xrange(hall.size - 2):
-            pen += stepw
-            hall.parent.parent.setblock(pen, materials._ceiling)
-            for k in xrange(1, hall.parent.parent.room_height - 2):
-                hall.parent.parent.setblock(pen.down(k), materials.Air)
-            hall.parent.parent.setblock(
-                pen.down(hall.parent.parent.room_height - 2),
-                materials._floor)
-        # Second wall
-        pen += stepw
-        for k in xrange(hall.parent.parent.room_height - 1):
-            hall.parent.parent.setblock(pen.down(k), materials._wall)
+        if hall.size > 2:
+            inner = stepw * (hall.size - 2)
+            dungeon.fillcube(start + stepw, end + inner, materials._ceiling)
+            if wall > 1:
+                dungeon.fillcube(start.down(1) + stepw,
+                                 end.down(wall - 1) + inner,
+                                 materials.Air)
+            dungeon.fillcube(start.down(wall) + stepw,
+                             end.down(wall) + inner,
+                             materials._floor)
 
     # Possible torches.
     pen = start + stepl * length
@@ -0,0 +1,175 @@
+import numpy
+
+# Light falls by at least one level for every block it travels, so a block
+# more than this far from anything that changed keeps its light. Light is
+# recomputed inside a box this far around the changed blocks, and the layer
+# of blocks just outside that is held at its current light.
+_reach = 15
+
+
+class LightVolume(object):
+
+    '''The blocks a dungeon wrote to a world, for relighting. lo and hi are
+    opposite corners of the box around them, in world coordinates.'''
+
+    def __init__(self):
+        self.lo = None
+        self.hi = None
+
+    def add(self, xs, ys, zs):
+        '''Add arrays of written block locations.'''
+        if len(xs) == 0:
+            return
+        lo = (int(xs.min()), int(ys.min()), int(zs.min()))
+        hi = (int(xs.max()), int(ys.max()), int(zs.max()))
+        if self.lo is None:
+            self.lo = lo
+            self.hi = hi
+        else:
+            self.lo = tuple(map(min, self.lo, lo))
+            self.hi = tuple(map(max, self.hi, hi))
+
+
+def _box(lo, hi, height):
+    '''Return (x0, z0, y0, x1, z1, y1), the half open box reaching one
+    block past _reach around the corners lo and hi, clipped to the world
+    height.'''
+    r = _reach + 1
+    return (lo[0] - r, lo[2] - r, max(lo[1] - r, 0),
+            hi[0] + r + 1, hi[2] + r + 1, min(hi[1] + r + 1, height))
+
+
+def _chunkSlices(box):
+    '''Yield (cx, cz, chunk slice x, chunk slice z, box slice x, box slice
+    z) for every chunk a box overlaps.'''
+    (x0, z0, y0, x1, z1, y1) = box
+    for cx in xrange(x0 >> 4, ((x1 - 1) >> 4) + 1):
+        ax = max(x0, cx << 4)
+        bx = min(x1, (cx << 4) + 16)
+        for cz in xrange(z0 >> 4, ((z1 - 1) >> 4) + 1):
+            az = max(z0, cz << 4)
+            bz = min(z1, (cz << 4) + 16)
+            yield (cx, cz,
+                   slice(ax - (cx << 4), bx - (cx << 4)),
+                   slice(az - (cz << 4), bz - (cz << 4)),
+                   slice(ax - x0, bx - x0),
+                   slice(az - z0, bz - z0))
+
+
+def _gather(world, box, name):
+    '''Copy the blocks and one light array of every chunk in a box into
+    dense [x, z, y] arrays. Returns (blocks, light, present), where present
+    marks the blocks that are in a chunk that exists.'''
+    (x0, z0, y0, x1, z1, y1) = box
+    shape = (x1 - x0, z1 - z0, y1 - y0)
+    blocks = numpy.zeros(shape, dtype=numpy.uint16)
+    light = numpy.zeros(shape, dtype=numpy.int16)
+    present = numpy.zeros(shape, dtype=bool)
+    for (cx, cz, sx, sz, bx, bz) in _chunkSlices(box):
+        if not world.containsChunk(cx, cz):
+            continue
+        chunk = world.getChunk(cx, cz)
+        blocks[bx, bz] = chunk.Blocks[sx, sz, y0:y1]
+        light[bx, bz] = getattr(chunk, name)[sx, sz, y0:y1]
+        present[bx, bz] = True
+    return (blocks, light, present)
+
+
+def _scatter(world, box, name, light):
+    '''Copy a dense light array back into the chunks of a box. Chunks whose
+    light changed are marked dirty, so they are saved, but not as needing
+    lighting, since their light is already right.'''
+    (x0, z0, y0, x1, z1, y1) = box
+    for (cx, cz, sx, sz, bx, bz) in _chunkSlices(box):
+        if not world.containsChunk(cx, cz):
+            continue
+        chunk = world.getChunk(cx, cz)
+        old = getattr(chunk, name)[sx, sz, y0:y1]
+        if (old == light[bx, bz]).all():
+            continue
+        old[:] = light[bx, bz]
+        chunk.chunkChanged(False)
+
+
+def _shell(box, height):
+    '''Return a mask of the outside layer of a box, where light is held at
+    its current value. Faces that lie on the top or bottom of the world are
+    left out, since there is nothing past them.'''
+    (x0, z0, y0, x1, z1, y1) = box
+    shell = numpy.zeros((x1 - x0, z1 - z0, y1 - y0), dtype=bool)
+    shell[0] = shell[-1] = True
+    shell[:, 0] = shell[:, -1] = True
+    if y0 > 0:
+        shell[:, :, 0] = True
+    if y1 < height:
+        shell[:, :, -1] = True
+    return shell
+
+
+def _spread(light, absorb, fixed):
+    '''Flood light through a box in place, a block per pass, until nothing
+    changes. Each block takes the brightest of its six neighbours, less its
+    own absorption, if that is brighter than it already is. Blocks in fixed
+    keep their light. Light falls by at least one level a block, so this
+    takes at most 14 passes.'''
+    free = ~fixed
+    best = numpy.empty_like(light)
+    for i in xrange(14):
+        best[:] = 0
+        best[1:] = light[:-1]
+        numpy.maximum(best[:-1], light[1:], out=best[:-1])
+        numpy.maximum(best[:, 1:], light[:, :-1], out=best[:, 1:])
+        numpy.maximum(best[:, :-1], light[:, 1:], out=best[:, :-1])
+        numpy.maximum(best[:, :, 1:], light[:, :, :-1], out=best[:, :, 1:])
+        numpy.maximum(best[:, :, :-1], light[:, :, 1:], out=best[:, :, :-1])
+        best -= absorb
+        grow = free & (best > light)
+        if not grow.any():
+            break
+        light[grow] = best[grow]
+
+
+def relightVolume(world, volume, progress=None):
+    '''Recompute the light around the blocks a dungeon wrote, rather than
+    for every block of every chunk it touched. Block light is spread from
+    the emitters in a box around the changed blocks. Skylight is redone in
+    the same box, carried up to the top of the world so the light coming
+    straight down each column can be worked out. progress, if given, is
+    called with (done, total) as each part finishes. Returns the number of
+    blocks lit.'''
+    if volume.lo is None:
+        return 0
+    height = world.Height
+    emission = numpy.asarray(world.materials.lightEmission, dtype=numpy.int16)
+    absorption = numpy.asarray(world.materials.lightAbsorption,
+                               dtype=numpy.int16)
+    count = 0
+
+    # Block light. Everything inside the box starts at the light it gives
+    # off, and the shell and any missing chunks keep what they have.
+    box = _box(volume.lo, volume.hi, height)
+    (blocks, light, present) = _gather(world, box, 'BlockLight')
+    fixed = _shell(box, height) | ~present
+    light = numpy.where(fixed, light, emission[blocks])
+    _spread(light, numpy.maximum(absorption[blocks], 1), fixed)
+    _scatter(world, box, 'BlockLight', light)
+    count += light.size
+    if progress is not None:
+        progress(1, 2)
+
+    # Skylight. Direct light comes down each column at full strength until
+    # something absorbs it, then spreads sideways like block light, so it
+    # also reaches blocks that were dark before, such as a tunnel dug out
+    # from the side of a pit open to the sky.
+    box = _box(volume.lo, (volume.hi[0], height - 1, volume.hi[2]), height)
+    (blocks, light, present) = _gather(world, box, 'SkyLight')
+    fixed = _shell(box, height) | ~present
+    absorb = absorption[blocks]
+    direct = 15 - numpy.cumsum(absorb[:, :, ::-1], axis=2)[:, :, ::-1]
+    light = numpy.where(fixed, light, numpy.maximum(direct, 0))
+    _spread(light, numpy.maximum(absorb, 1), fixed)
+    _scatter(world, box, 'SkyLight', light)
+    count += light.size
+    if progress is not None:
+        progress(2, 2)
+    return count
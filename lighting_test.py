@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# Check lighting.relightVolume() against lighting a whole world from scratch,
+# on small made up worlds. Each scene is lit in full and saved, then has some
+# blocks changed, which are relit the way --lighting dungeon does it, through
+# a Relighter that waits for the end of the run. The world is saved before
+# and after the relight, as the commit journal does, and only dirty chunks
+# are saved, so light that never reaches the save is caught as well.
+import sys
+
+import numpy
+
+import lighting
+from relight import Relighter
+
+height = 64
+
+Stone = 1
+Water = 9
+Leaves = 18
+Torch = 50
+Glowstone = 89
+
+
+class Materials(object):
+
+    '''Just the light tables of the materials.'''
+
+    def __init__(self):
+        self.lightEmission = numpy.zeros(4096, dtype=numpy.uint8)
+        self.lightAbsorption = numpy.zeros(4096, dtype=numpy.uint8)
+        self.lightEmission[Torch] = 14
+        self.lightEmission[Glowstone] = 15
+        self.lightAbsorption[Stone] = 15
+        self.lightAbsorption[Water] = 3
+        self.lightAbsorption[Leaves] = 1
+        self.lightAbsorption[Glowstone] = 15
+
+
+class Chunk(object):
+
+    '''A chunk that keeps a copy of its light as it was last saved.'''
+
+    def __init__(self, cx, cz):
+        self.chunkPosition = (cx, cz)
+        self.Blocks = numpy.zeros((16, 16, height), dtype=numpy.uint16)
+        self.BlockLight = numpy.zeros((16, 16, height), dtype=numpy.uint8)
+        self.SkyLight = numpy.zeros((16, 16, height), dtype=numpy.uint8)
+        self.dirty = False
+        self.save()
+
+    def chunkChanged(self, needsLighting=True):
+        self.dirty = True
+
+    def save(self):
+        self.savedBlockLight = self.BlockLight.copy()
+        self.savedSkyLight = self.SkyLight.copy()
+        self.dirty = False
+
+
+class World(object):
+
+    '''A square of size x size chunks.'''
+
+    Height = height
+
+    def __init__(self, size):
+        self.size = size
+        self.materials = Materials()
+        self.chunks = {}
+        for cx in xrange(size):
+            for cz in xrange(size):
+                self.chunks[cx, cz] = Chunk(cx, cz)
+
+    def containsChunk(self, cx, cz):
+        return (cx, cz) in self.chunks
+
+    def getChunk(self, cx, cz):
+        return self.chunks[cx, cz]
+
+    def saveInPlace(self):
+        for chunk in self.chunks.itervalues():
+            if chunk.dirty:
+                chunk.save()
+
+    def dense(self, name):
+        '''Return one array of the world as a dense [x, z, y] array.'''
+        a = numpy.zeros((self.size * 16, self.size * 16, height), dtype=int)
+        for (cx, cz), chunk in self.chunks.iteritems():
+            a[cx * 16:cx * 16 + 16, cz * 16:cz * 16 + 16] = getattr(chunk,
+                                                                     name)
+        return a
+
+    def setDense(self, name, a):
+        '''Set one array of the world from a dense [x, z, y] array.'''
+        for (cx, cz), chunk in self.chunks.iteritems():
+            getattr(chunk, name)[:] = a[cx * 16:cx * 16 + 16,
+                                        cz * 16:cz * 16 + 16]
+
+
+def flood(light, absorb):
+    '''Spread light through the whole world until nothing changes.'''
+    while True:
+        best = numpy.zeros_like(light)
+        best[1:] = light[:-1]
+        best[:-1] = numpy.maximum(best[:-1], light[1:])
+        best[:, 1:] = numpy.maximum(best[:, 1:], light[:, :-1])
+        best[:, :-1] = numpy.maximum(best[:, :-1], light[:, 1:])
+        best[:, :, 1:] = numpy.maximum(best[:, :, 1:], light[:, :, :-1])
+        best[:, :, :-1] = numpy.maximum(best[:, :, :-1], light[:, :, 1:])
+        best -= absorb
+        grow = best > light
+        if not grow.any():
+            return light
+        light[grow] = best[grow]
+
+
+def fullLight(world):
+    '''Light a world from scratch. Returns (block light, skylight).'''
+    blocks = world.dense('Blocks')
+    emission = world.materials.lightEmission.astype(int)
+    absorption = world.materials.lightAbsorption.astype(int)
+    absorb = absorption[blocks]
+    blocklight = flood(emission[blocks], numpy.maximum(absorb, 1))
+    direct = 15 - numpy.cumsum(absorb[:, :, ::-1], axis=2)[:, :, ::-1]
+    skylight = flood(numpy.maximum(direct, 0), numpy.maximum(absorb, 1))
+    return (blocklight, skylight)
+
+
+def check(label, world, changes):
+    '''Light a world, make a list of (xs, ys, zs, block) changes to it,
+    relight around them, and compare what was saved with lighting the
+    changed world from scratch. Returns True if they match.'''
+    (blocklight, skylight) = fullLight(world)
+    world.setDense('BlockLight', blocklight)
+    world.setDense('SkyLight', skylight)
+    for chunk in world.chunks.itervalues():
+        chunk.save()
+
+    # Write the blocks the way a dungeon does, and mark their chunks.
+    blocks = world.dense('Blocks')
+    volume = lighting.LightVolume()
+    changed = set()
+    for (xs, ys, zs, block) in changes:
+        blocks[xs, zs, ys] = block
+        volume.add(xs, ys, zs)
+        changed |= set(zip(xs >> 4, zs >> 4))
+    world.setDense('Blocks', blocks)
+    for (cx, cz) in changed:
+        world.getChunk(cx, cz).chunkChanged()
+
+    relighter = Relighter(world, 0, lambda done, total: None, 'dungeon')
+    relighter.add(changed, volume)
+    world.saveInPlace()
+    relighter.flush()
+    world.saveInPlace()
+
+    (blocklight, skylight) = fullLight(world)
+    result = True
+    for (name, want) in (('BlockLight', blocklight), ('SkyLight', skylight)):
+        saved = world.dense('saved' + name)
+        wrong = (saved != want).sum()
+        print '%s %s: %d blocks differ' % (label, name, wrong)
+        result = result and wrong == 0
+    return result
+
+
+def box(x0, x1, y0, y1, z0, z1, block):
+    '''Return a change that fills a box with a block.'''
+    (xs, ys, zs) = [a.ravel() for a in numpy.mgrid[x0:x1, y0:y1, z0:z1]]
+    return (xs, ys, zs, block)
+
+ok = True
+
+# Rough ground with caves, water, leaves and a little glowstone. A room is
+# dug under it with a row of torches, a shaft up to the surface, and a small
+# ruin on top with a torch inside.
+world = World(8)
+rs = numpy.random.RandomState(1)
+blocks = numpy.zeros((128, 128, height), dtype=int)
+blocks[:, :, :40] = Stone
+blocks[rs.rand(*blocks.shape) < 0.02] = 0
+blocks[:, :, 38:40][rs.rand(128, 128, 2) < 0.1] = Water
+blocks[:, :, 40][rs.rand(128, 128) < 0.05] = Leaves
+blocks[rs.rand(*blocks.shape) < 0.001] = Glowstone
+world.setDense('Blocks', blocks)
+ok &= check('room', world, [
+    box(40, 80, 20, 26, 40, 80, 0),
+    box(50, 52, 26, 41, 50, 52, 0),
+    box(45, 46, 22, 23, 45, 75, Torch),
+    box(60, 70, 40, 45, 60, 70, Stone),
+    box(62, 68, 41, 44, 62, 68, 0),
+    box(64, 65, 41, 42, 64, 65, Torch),
+])
+
+# A pit open to the sky, with a tunnel dug sideways out of its wall. The
+# tunnel only gets skylight that spreads in from the pit.
+world = World(6)
+blocks = numpy.zeros((96, 96, height), dtype=int)
+blocks[:, :, :50] = Stone
+blocks[45:51, 45:51, 20:50] = 0
+world.setDense('Blocks', blocks)
+ok &= check('tunnel', world, [box(51, 70, 22, 25, 47, 49, 0)])
+
+if not ok:
+    print 'FAILED'
+    sys.exit(1)
+print 'OK'
@@ -26,6 +26,40 @@ import materials
 import items
 
 
+def paintingItem(painting_path, painting_file, mapid):
+    '''Return a map item NBT for a painting with the given map ID, named
+    and with lore from the painting's text file.'''
+    # Create map item tag
+    item = nbt.TAG_Compound()
+    item['id'] = nbt.TAG_String(items.byName('map').id)
+    item['Damage'] = nbt.TAG_Short(mapid)
+    item['Count'] = nbt.TAG_Byte(1)
+
+    # Fetch the lore text for this map
+    lorefile = open(
+        os.path.join(
+            painting_path,
+            painting_file +
+            '.txt'))
+    loredata = lorefile.read().splitlines()
+    lorefile.close()
+    # Create NBT tag
+    valid_characters = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ!\"#$%&\'()*+,-./:;<=>?@[\\]^_`{|}~ "
+    item['tag'] = nbt.TAG_Compound()
+    item['tag']['display'] = nbt.TAG_Compound()
+    item['tag']['display']['Name'] = nbt.TAG_String(
+        filter(
+            lambda x: x in valid_characters,
+            loredata.pop(0)))
+    item['tag']['display']['Lore'] = nbt.TAG_List()
+    # Slice at 5 lines of 50 chars each
+    for p in loredata[:5]:
+        line = filter(lambda x: x in valid_characters, p)
+        item['tag']['display']['Lore'].append(nbt.TAG_String(line[:50]))
+
+    return item
+
+
 class new:
 
     def __init__(self, mapstore, dir_paintings='paintings'):
@@ -114,57 +148,34 @@ class new:
         else:
             print 'No maps found for dungeon at ', loc
 
-    def add_painting(self, painting_file):
+    def painting_id(self, painting_file):
+        '''Return the map ID of a painting, copying it into the map store
+        if it isn't there yet.'''
         src = os.path.join(self.painting_path, painting_file + '.dat')
         painting_file_hash = hashlib.md5(open(src, 'r').read()).digest()
         # Look up file in hashtable
         if painting_file_hash in self.maphash:
-            mapid = self.maphash[painting_file_hash]
-        else:
-            # Initialize the map count if it doesn't exist.
-            if 'map' not in self.idcounts:
-                self.idcounts['map'] = nbt.TAG_Short(-1)
-            # Increment and return id
-            self.idcounts['map'].value += 1
-            mapid = self.idcounts['map'].value
-            # Copy the map to the data dir
-            dest = os.path.join(self.mapstore, 'map_%d.dat' % (mapid))
-            try:
-                shutil.copy(src, dest)
-            except:
-                sys.exit('Error when placing painting in map directory.')
-            self.maphash[painting_file_hash] = mapid   # Update hashtable
-            self.update_mapstore()
-
-        # Create map item tag
-        item = nbt.TAG_Compound()
-        item['id'] = nbt.TAG_String(items.byName('map').id)
-        item['Damage'] = nbt.TAG_Short(mapid)
-        item['Count'] = nbt.TAG_Byte(1)
-
-        # Fetch the lore text for this map
-        lorefile = open(
-            os.path.join(
-                self.painting_path,
-                painting_file +
-                '.txt'))
-        loredata = lorefile.read().splitlines()
-        lorefile.close()
-        # Create NBT tag
-        valid_characters = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ!\"#$%&\'()*+,-./:;<=>?@[\\]^_`{|}~ "
-        item['tag'] = nbt.TAG_Compound()
-        item['tag']['display'] = nbt.TAG_Compound()
-        item['tag']['display']['Name'] = nbt.TAG_String(
-            filter(
-                lambda x: x in valid_characters,
-                loredata.pop(0)))
-        item['tag']['display']['Lore'] = nbt.TAG_List()
-        # Slice at 5 lines of 50 chars each
-        for p in loredata[:5]:
-            line = filter(lambda x: x in valid_characters, p)
-            item['tag']['display']['Lore'].append(nbt.TAG_String(line[:50]))
+            return self.maphash[painting_file_hash]
+        # Initialize the map count if it doesn't exist.
+        if 'map' not in self.idcounts:
+            self.idcounts['map'] = nbt.TAG_Short(-1)
+        # Increment and return id
+        self.idcounts['map'].value += 1
+        mapid = self.idcounts['map'].value
+        # Copy the map to the data dir
+        dest = os.path.join(self.mapstore, 'map_%d.dat' % (mapid))
+        try:
+            shutil.copy(src, dest)
+        except:
+            sys.exit('Error when placing painting in map directory.')
+        self.maphash[painting_file_hash] = mapid   # Update hashtable
+        self.update_mapstore()
+        return mapid
 
-        return item
+    def add_painting(self, painting_file):
+        return paintingItem(self.painting_path,
+                            painting_file,
+                            self.painting_id(painting_file))
 
     def generate_map(self, dungeon, level):
         '''Generate a new map, save it to disk, flush the cache, and return a
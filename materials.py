@@ -6,6 +6,8 @@ import random
 import re
 import sys
 
+import numpy
+
 import perlin
 
 BLACK = '\033[0;30m'
@@ -107,12 +109,16 @@ class Material(object):
 # MetaMaterial class.
 class MetaMaterial(Material):
     _meta = True
+    # The materials this can turn into.
+    choices = ()
 
     def __init__(self):
         return
 
-    def update(self, x, y, z, maxx, maxy, maxz):
-        return
+    def choose(self, xs, ys, zs, maxx, maxy, maxz, rand):
+        '''Return the index in choices of the material each block becomes,
+        for arrays of dungeon coordinates. rand is a numpy RandomState.'''
+        return numpy.zeros(len(xs), dtype=int)
 
 
 # Config parser with default values.
@@ -182,22 +188,21 @@ for oname, obj in sys.modules[__name__].__dict__.items():
 
 
 # Meta materials
+def _mossy(pn, xs, ys, zs):
+    '''Mask of the blocks that are mossy.'''
+    return pn.noise3array(xs / 4.0, ys / 4.0, zs / 4.0) < 0
+
+
 class meta_class_mossycobble(MetaMaterial):
     name = 'meta_mossycobble'
     val = Cobblestone.val
     data = Cobblestone.data
     c = Cobblestone.c
     pn = perlin.SimplexNoise(256)
+    choices = (Cobblestone, MossStone)
 
-    def update(self, x, y, z, maxx, maxy, maxz):
-        if self.pn.noise3(x / 4.0, y / 4.0, z / 4.0) < 0:
-            self.val = MossStone.val
-            self.data = MossStone.data
-            self.c = MossStone.c
-        else:
-            self.val = Cobblestone.val
-            self.data = Cobblestone.data
-            self.c = Cobblestone.c
+    def choose(self, xs, ys, zs, maxx, maxy, maxz, rand):
+        return _mossy(self.pn, xs, ys, zs).astype(int)
 
 
 class meta_class_mossycobblewall(MetaMaterial):
@@ -206,16 +211,10 @@ class meta_class_mossycobblewall(MetaMaterial):
     data = CobblestoneWall.data
     c = CobblestoneWall.c
     pn = perlin.SimplexNoise(256)
+    choices = (CobblestoneWall, MossStoneWall)
 
-    def update(self, x, y, z, maxx, maxy, maxz):
-        if self.pn.noise3(x / 4.0, y / 4.0, z / 4.0) < 0:
-            self.val = MossStoneWall.val
-            self.data = MossStoneWall.data
-            self.c = MossStoneWall.c
-        else:
-            self.val = CobblestoneWall.val
-            self.data = CobblestoneWall.data
-            self.c = CobblestoneWall.c
+    def choose(self, xs, ys, zs, maxx, maxy, maxz, rand):
+        return _mossy(self.pn, xs, ys, zs).astype(int)
 
 
 class meta_class_mossystonebrick(MetaMaterial):
@@ -224,28 +223,14 @@ class meta_class_mossystonebrick(MetaMaterial):
     data = StoneBrick.data
     c = StoneBrick.c
     pn = perlin.SimplexNoise(256)
+    choices = (StoneBrick, MossyStoneBrick, CrackedStoneBrick,
+               ChiseledStoneBrick)
 
-    def update(self, x, y, z, maxx, maxy, maxz):
-        if random.randint(1, 100) < 7:
-            self.val = CrackedStoneBrick.val
-            self.data = CrackedStoneBrick.data
-            self.c = CrackedStoneBrick.c
-            return
-
-        if random.randint(0, 100) < 2:
-            self.val = ChiseledStoneBrick.val
-            self.data = ChiseledStoneBrick.data
-            self.c = ChiseledStoneBrick.c
-            return
-
-        if self.pn.noise3(x / 4.0, y / 4.0, z / 4.0) < 0:
-            self.val = MossyStoneBrick.val
-            self.data = MossyStoneBrick.data
-            self.c = MossyStoneBrick.c
-        else:
-            self.val = StoneBrick.val
-            self.data = StoneBrick.data
-            self.c = StoneBrick.c
+    def choose(self, xs, ys, zs, maxx, maxy, maxz, rand):
+        idx = _mossy(self.pn, xs, ys, zs).astype(int)
+        idx[rand.randint(0, 101, len(idx)) < 2] = 3
+        idx[rand.randint(1, 101, len(idx)) < 7] = 2
+        return idx
 
 
 class meta_class_decoratedsandstone(MetaMaterial):
@@ -253,28 +238,13 @@ class meta_class_decoratedsandstone(MetaMaterial):
     val = Sandstone.val
     data = Sandstone.data
     c = Sandstone.c
+    choices = (Sandstone, SmoothSandstone, ChiseledSandstone)
 
-    def update(self, x, y, z, maxx, maxy, maxz):
-        if random.randint(1, 100) < 10:
-            self.val = Sandstone.val
-            self.data = Sandstone.data
-            self.c = Sandstone.c
-            return
-
-        if random.randint(1, 100) < 10:
-            self.val = SmoothSandstone.val
-            self.data = SmoothSandstone.data
-            self.c = SmoothSandstone.c
-            return
-
-        if y % 5 == 0:
-            self.val = ChiseledSandstone.val
-            self.data = ChiseledSandstone.data
-            self.c = ChiseledSandstone.c
-        else:
-            self.val = Sandstone.val
-            self.data = Sandstone.data
-            self.c = Sandstone.c
+    def choose(self, xs, ys, zs, maxx, maxy, maxz, rand):
+        idx = numpy.where(ys % 5 == 0, 2, 0)
+        idx[rand.randint(1, 101, len(idx)) < 10] = 1
+        idx[rand.randint(1, 101, len(idx)) < 10] = 0
+        return idx
 
 
 class meta_class_decoratedredsandstone(MetaMaterial):
@@ -282,28 +252,13 @@ class meta_class_decoratedredsandstone(MetaMaterial):
     val = RedSandstone.val
     data = RedSandstone.data
     c = RedSandstone.c
+    choices = (RedSandstone, SmoothRedSandstone, ChiseledRedSandstone)
 
-    def update(self, x, y, z, maxx, maxy, maxz):
-        if random.randint(1, 100) < 10:
-            self.val = RedSandstone.val
-            self.data = RedSandstone.data
-            self.c = RedSandstone.c
-            return
-
-        if random.randint(1, 100) < 10:
-            self.val = SmoothRedSandstone.val
-            self.data = SmoothRedSandstone.data
-            self.c = SmoothRedSandstone.c
-            return
-
-        if y % 5 == 0:
-            self.val = ChiseledRedSandstone.val
-            self.data = ChiseledRedSandstone.data
-            self.c = ChiseledRedSandstone.c
-        else:
-            self.val = RedSandstone.val
-            self.data = RedSandstone.data
-            self.c = RedSandstone.c
+    def choose(self, xs, ys, zs, maxx, maxy, maxz, rand):
+        idx = numpy.where(ys % 5 == 0, 2, 0)
+        idx[rand.randint(1, 101, len(idx)) < 10] = 1
+        idx[rand.randint(1, 101, len(idx)) < 10] = 0
+        return idx
 
 
 class meta_class_stonedungeon(MetaMaterial):
@@ -312,58 +267,30 @@ class meta_class_stonedungeon(MetaMaterial):
     data = StoneBrick.data
     c = StoneBrick.c
     pn = perlin.SimplexNoise(256)
+    choices = (StoneBrick, MossyStoneBrick, Cobblestone, MossStone,
+               CrackedStoneBrick, ChiseledStoneBrick)
 
-    def update(self, x, y, z, maxx, maxy, maxz):
-        n = self.pn.noise3(x / 100.0, y / 100.0, z / 100.0)
-        n = n + (float(y) / float(maxy)) * 2
-
-        # Random broken stone brick in stone brick and cobble zones.
-        if n <= 1.5:
-            broken = .1 + (float(y) / float(maxy)) * .5
-            if random.randint(1, 100) < broken * 10 + 5:
-                self.val = CrackedStoneBrick.val
-                self.data = CrackedStoneBrick.data
-                self.c = CrackedStoneBrick.c
-                return
-
-        # Random circle stone in stone brick zones
-        if n <= 1.0:
-            if random.randint(0, 100) < 2:
-                self.val = ChiseledStoneBrick.val
-                self.data = ChiseledStoneBrick.data
-                self.c = ChiseledStoneBrick.c
-                return
-
-        # Deepest areas are mossy cobble
-        if (n > 1.5):
-            if self.pn.noise3(x / 4.0, y / 4.0, z / 4.0) < 0:
-                self.val = MossStone.val
-                self.data = MossStone.data
-                self.c = MossStone.c
-            else:
-                self.val = Cobblestone.val
-                self.data = Cobblestone.data
-                self.c = Cobblestone.c
-        # Deep areas are cobble
-        elif (n > 1.0):
-            self.val = Cobblestone.val
-            self.data = Cobblestone.data
-            self.c = Cobblestone.c
-        # lower areas as mossy brick
-        elif (n > 0.5):
-            if self.pn.noise3(x / 4.0, y / 4.0, z / 4.0) < 0:
-                self.val = MossyStoneBrick.val
-                self.data = MossyStoneBrick.data
-                self.c = MossyStoneBrick.c
-            else:
-                self.val = StoneBrick.val
-                self.data = StoneBrick.data
-                self.c = StoneBrick.c
+    def choose(self, xs, ys, zs, maxx, maxy, maxz, rand):
+        depth = ys / float(maxy)
+        n = self.pn.noise3array(xs / 100.0, ys / 100.0, zs / 100.0)
+        n = n + depth * 2
         # High areas are stone brick
-        else:
-            self.val = StoneBrick.val
-            self.data = StoneBrick.data
-            self.c = StoneBrick.c
+        idx = numpy.zeros(len(xs), dtype=int)
+        # lower areas as mossy brick, deep areas are cobble, and the
+        # deepest areas are mossy cobble.
+        mossy = (n > 0.5) & ((n <= 1.0) | (n > 1.5))
+        mossy[mossy] = _mossy(self.pn, xs[mossy], ys[mossy], zs[mossy])
+        idx[n > 1.0] = 2
+        idx[mossy] += 1
+        # Random circle stone in stone brick zones
+        circle = (n <= 1.0) & (rand.randint(0, 101, len(idx)) < 2)
+        idx[circle] = 5
+        # Random broken stone brick in stone brick and cobble zones.
+        broken = .1 + depth * .5
+        broken = ((n <= 1.5) &
+                  (rand.randint(1, 101, len(idx)) < broken * 10 + 5))
+        idx[broken] = 4
+        return idx
 
 
 meta_mossycobble = meta_class_mossycobble()
@@ -23,6 +23,13 @@ _vstring = '%%(prog)s %s' % (__version__)
 world = None
 cache_path = None
 
+# Compact per-chunk record returned by region scans
+scan_dtype = numpy.dtype([('cx', numpy.int32),
+                          ('cz', numpy.int32),
+                          ('result', 'S1'),
+                          ('biome', numpy.int16),
+                          ('depth', numpy.int16)])
+
 
 def parseArgs():
     # Argument parsers
@@ -50,6 +57,43 @@ def parseArgs():
                               action='store_true',
                               dest='skiprelight',
                               help='Skip relighting the level')
+    parser_inter.add_argument('--relight-every',
+                              type=int,
+                              dest='relight_every',
+                              metavar='NUM',
+                              default=1,
+                              help='Relight the chunks of NUM dungeons at a \
+                              time, so chunks they share are only lit once. 0 \
+                              relights everything at the end of the run. \
+                              Default: 1')
+    parser_inter.add_argument('--lighting',
+                              dest='lighting',
+                              choices=['world', 'dungeon'],
+                              default='world',
+                              help='How to relight. world relights every changed \
+                              chunk from top to bottom. dungeon only relights \
+                              around the blocks each dungeon wrote. Default: \
+                              world')
+    parser_inter.add_argument('--commit-every',
+                              type=int,
+                              dest='commit_every',
+                              metavar='NUM',
+                              default=1,
+                              help='Save the world and caches after every NUM \
+                              dungeons instead of after each one. 0 saves once, at \
+                              the end of the run. Default: 1')
+    parser_inter.add_argument('--pipeline',
+                              action='store_true',
+                              dest='pipeline',
+                              help='Build each dungeon while the last one is written \
+                              and saved in the background. Only used when placing \
+                              more than one dungeon.')
+    parser_inter.add_argument('--parallel-generate',
+                              action='store_true',
+                              dest='parallel_generate',
+                              help='Build several dungeons at once in the worker pool, \
+                              and write them to the world in order. Only used when \
+                              placing more than one dungeon, without --html or --term.')
     parser_inter.add_argument('-t',
                               '--term',
                               type=int,
@@ -151,6 +195,31 @@ def parseArgs():
                               action='store_true',
                               dest='skiprelight',
                               help='Skip relighting the level')
+    parser_addth.add_argument('--relight-every',
+                              type=int,
+                              dest='relight_every',
+                              metavar='NUM',
+                              default=1,
+                              help='Relight the chunks of NUM dungeons at a \
+                              time, so chunks they share are only lit once. 0 \
+                              relights everything at the end of the run. \
+                              Default: 1')
+    parser_addth.add_argument('--lighting',
+                              dest='lighting',
+                              choices=['world', 'dungeon'],
+                              default='world',
+                              help='How to relight. world relights every changed \
+                              chunk from top to bottom. dungeon only relights \
+                              around the blocks each dungeon wrote. Default: \
+                              world')
+    parser_addth.add_argument('--commit-every',
+                              type=int,
+                              dest='commit_every',
+                              metavar='NUM',
+                              default=1,
+                              help='Save the world and caches after every NUM \
+                              dungeons instead of after each one. 0 saves once, at \
+                              the end of the run. Default: 1')
     parser_addth.add_argument('--debug',
                             action='store_true',
                             dest='debug',
@@ -224,6 +293,43 @@ def parseArgs():
                             action='store_true',
                             dest='skiprelight',
                             help='Skip relighting the level')
+    parser_add.add_argument('--relight-every',
+                            type=int,
+                            dest='relight_every',
+                            metavar='NUM',
+                            default=1,
+                            help='Relight the chunks of NUM dungeons at a \
+                            time, so chunks they share are only lit once. 0 \
+                            relights everything at the end of the run. \
+                            Default: 1')
+    parser_add.add_argument('--lighting',
+                            dest='lighting',
+                            choices=['world', 'dungeon'],
+                            default='world',
+                            help='How to relight. world relights every changed \
+                            chunk from top to bottom. dungeon only relights \
+                            around the blocks each dungeon wrote. Default: \
+                            world')
+    parser_add.add_argument('--commit-every',
+                            type=int,
+                            dest='commit_every',
+                            metavar='NUM',
+                            default=1,
+                            help='Save the world and caches after every NUM \
+                            dungeons instead of after each one. 0 saves once, at \
+                            the end of the run. Default: 1')
+    parser_add.add_argument('--pipeline',
+                            action='store_true',
+                            dest='pipeline',
+                            help='Build each dungeon while the last one is written \
+                            and saved in the background. Only used when placing \
+                            more than one dungeon.')
+    parser_add.add_argument('--parallel-generate',
+                            action='store_true',
+                            dest='parallel_generate',
+                            help='Build several dungeons at once in the worker pool, \
+                            and write them to the world in order. Only used when \
+                            placing more than one dungeon, without --html or --term.')
     parser_add.add_argument('-t',
                             '--term',
                             type=int,
@@ -446,6 +552,31 @@ def parseArgs():
                               action='store_true',
                               dest='skiprelight',
                               help='Skip relighting the level')
+    parser_regen.add_argument('--relight-every',
+                              type=int,
+                              dest='relight_every',
+                              metavar='NUM',
+                              default=1,
+                              help='Relight the chunks of NUM dungeons at a \
+                              time, so chunks they share are only lit once. 0 \
+                              relights everything at the end of the run. \
+                              Default: 1')
+    parser_regen.add_argument('--lighting',
+                              dest='lighting',
+                              choices=['world', 'dungeon'],
+                              default='world',
+                              help='How to relight. world relights every changed \
+                              chunk from top to bottom. dungeon only relights \
+                              around the blocks each dungeon wrote. Default: \
+                              world')
+    parser_regen.add_argument('--commit-every',
+                              type=int,
+                              dest='commit_every',
+                              metavar='NUM',
+                              default=1,
+                              help='Save the world and caches after every NUM \
+                              dungeons instead of after each one. 0 saves once, at \
+                              the end of the run. Default: 1')
     parser_regen.add_argument('--mapstore',
                               dest='mapstore',
                               metavar='PATH',
@@ -566,17 +697,10 @@ def classifyChunk(c):
             return cx, cz, 'S', biome_type, 0
 
     # Depths
-    min_depth = world.Height
-    max_depth = 0
-    for x in xrange(16):
-        for z in xrange(16):
-            y = chunk.HeightMap[x, z] - 1
-            while (y > 0 and
-                   chunk.Blocks[x, z, y] not in
-                   materials.heightmap_solids):
-                y = y - 1
-            min_depth = min(y, min_depth)
-            max_depth = max(y, max_depth)
+    depths = utils.findSurfaceHeights(chunk.Blocks,
+                                      chunk.HeightMap.astype(int) - 1)
+    min_depth = min(int(depths.min()), world.Height)
+    max_depth = max(int(depths.max()), 0)
 
     # Surface too close to the max height
     if max_depth > world.Height - 27:
@@ -628,41 +752,114 @@ def checkDInfo(c):
     return key, None, None
 
 
-def loadCaches(expand_fill_caves=False, genpoi=False):
-    '''Scan a world for dungeons and treasure hunts. Try to cache
-    the results and only look at chunks that have changed since the
-    last run.'''
-
-    global world
-    global cache_path
-    pm = pmeter.ProgressMeter()
+def regionBatches(chunks):
+    '''Group chunk coordinates by the region file that holds them. Each
+    batch is sorted so a worker reads its region file front to back.'''
+    regions = {}
+    for c in chunks:
+        regions.setdefault((c[0] >> 5, c[1] >> 5), []).append(c)
+    return [sorted(batch) for batch in regions.itervalues()]
+
+
+def classifyRegion(batch):
+    '''Classify a batch of chunks from one region file. Results come back as
+    a compact record array rather than one tuple per chunk.'''
+    results = numpy.zeros(len(batch), dtype=scan_dtype)
+    for i, c in enumerate(batch):
+        (cx, cz, result, biome, depth) = classifyChunk(c)
+        if biome is None:
+            biome = -1
+        results[i] = (cx, cz, result, biome, depth)
+    return results
+
+
+# Byte strings that appear in the raw NBT of any chunk checkDInfo() would
+# match.
+dinfo_signatures = ('[MCD]',
+                    'MCDungeon Data Library',
+                    'MCDungeon THunt Data Library')
+
+
+def checkDInfoRegion(batch):
+    '''Check a batch of chunks from one region file for dungeon and
+    treasure hunt signatures. Only the hits are returned. The raw chunk data
+    is searched first, and only chunks that contain a signature are loaded
+    and parsed.'''
+    found = []
+    path = os.path.join(os.path.dirname(world.filename),
+                        'region',
+                        'r.%d.%d.mca' % (batch[0][0] >> 5, batch[0][1] >> 5))
+    for c in utils.regionChunkMatches(path, batch, dinfo_signatures):
+        (key, d_type, entity) = checkDInfo(c)
+        if entity:
+            found.append((key, d_type, entity))
+    return found
+
+
+def scanRegions(func, batches):
+    '''Run func over each region batch and yield (batch, result) pairs as
+    they complete. Each batch is a single task, so a worker reads each region
+    file once instead of every worker touching every region.'''
+    # Handle this in the main thread if we aren't multiprocessing.
+    if args.workers is not None and args.workers < 2:
+        if args.debug:
+            print 'Working with a single process.'
+        for batch in batches:
+            yield batch, func(batch)
+    # Process regions in parallel.
+    else:
+        if args.debug:
+            print 'Working with multiple processes. workers =', args.workers
+        with cf.ProcessPoolExecutor(max_workers=args.workers) as executor:
+            scans = {executor.submit(func, b): b for b in batches}
+            for future in cf.as_completed(scans):
+                yield scans[future], future.result()
 
-    # Try to load the dungeon cache
-    dungeonCacheOld, mtime = utils.loadDungeonCache(cache_path)
-    dungeonCache = {}
 
-    # Try to load the treasure hunt cache
-    tHuntCacheOld, mtime = utils.loadTHuntCache(cache_path)
-    tHuntCache = {}
+def scanDungeons(dungeon_index, regions, dungeonCacheOld, tHuntCacheOld,
+                 mtime, genpoi=False):
+    '''Scan a world for dungeons and treasure hunts, only looking at chunks
+    that have changed since the last scan, and bring the caches and the
+    dungeon index up to date.'''
+    pm = pmeter.ProgressMeter()
 
-    count = world.chunkCount
+    # The region timestamp of every chunk at the time we last looked at it.
+    stamp_cache = utils.loadStampCache(cache_path, mtime)
+    scan_start = int(time.time())
 
     # Pass 1 will prefilter the chunks for ones that might be interesting.
     if genpoi is False:
         print 'Scanning world for existing dungeons and treasure hunts:'
-        pm.init(count, label='Pass 1:')
-
-    chunks = set()
-    for c in world.allChunks:
-        cx = c[0]
-        cz = c[1]
-        key = '%s,%s' % (cx * 16, cz * 16)
-        cmtime = world.worldFolder.getRegionForChunk(cx, cz).getTimestamp(cx, cz)
-        if (cmtime > mtime or key in dungeonCacheOld or key in tHuntCacheOld):
-            chunks.add(c)
-        count -= 1
-        if genpoi is False and count%200 == 0:
-            pm.update_left(count)
+        pm.init(len(regions), label='Pass 1:')
+
+    # Only look at chunks that changed since we last looked at them.
+    # Regions that have not been touched since then are skipped outright.
+    chunks = {}
+    cached = 0
+    rc = 0
+    for (cxs, czs, stamps, rmtime) in utils.regionChunks(regions,
+                                                         stamp_cache.mtime):
+        (stale, records, stamps) = utils.staleChunks(stamp_cache,
+                                                     cxs, czs,
+                                                     stamps, rmtime)
+        cached += int((~stale).sum())
+        chunks.update(zip(zip(cxs[stale].tolist(), czs[stale].tolist()),
+                          stamps[stale].tolist()))
+        rc += 1
+        if genpoi is False:
+            pm.update(rc)
+
+    # Known dungeons and hunts in chunks that have not changed are still
+    # there.
+    dungeonCache = {}
+    tHuntCache = {}
+    for (old, new) in ((dungeonCacheOld, dungeonCache),
+                       (tHuntCacheOld, tHuntCache)):
+        for key, entity in old.iteritems():
+            (x, z) = [int(v) for v in key.split(',')]
+            c = (x >> 4, z >> 4)
+            if c not in chunks and world.containsChunk(c[0], c[1]):
+                new[key] = entity
 
     # Pass 2 will evaluate the interesting chunks.
     count = world.chunkCount
@@ -670,45 +867,86 @@ def loadCaches(expand_fill_caves=False, genpoi=False):
         pm.set_complete()
         pm.init(count, label='Pass 2:')
 
-    # Handle this in the main thread if we aren't multiprocessing.
-    if args.workers is not None and args.workers < 2:
-        if args.debug:
-            print 'Working with a single process.'
-        for c in chunks:
-            (key, d_type, entity) = checkDInfo(c)
-            if entity:
-                if d_type == 'dungeon':
-                    dungeonCache[key] = entity
-                else:
-                    tHuntCache[key] = entity
+    start = time.time()
+    found = set()
+    for batch, hits in scanRegions(checkDInfoRegion, regionBatches(chunks)):
+        for (key, d_type, entity) in hits:
+            if d_type == 'dungeon':
+                dungeonCache[key] = entity
+            else:
+                tHuntCache[key] = entity
+            found.add(key)
 
-            count -= 1
-            if genpoi is False and count%200 == 0:
-                pm.update_left(count)
-    # Process chunks in parallel.
-    else:
-        if args.debug:
-            print 'Working with multiple processes. workers =', args.workers
-        with cf.ProcessPoolExecutor(max_workers = args.workers) as executor:
-            chunk_scans = {executor.submit(checkDInfo, c): c for c in chunks}
-            for future in cf.as_completed(chunk_scans):
-                (key, d_type, entity) = future.result()
-                if entity:
-                    if d_type == 'dungeon':
-                        dungeonCache[key] = entity
-                    else:
-                        tHuntCache[key] = entity
+        count -= len(batch)
+        if genpoi is False:
+            pm.update_left(count)
 
-                count -= 1
-                if genpoi is False and count%200 == 0:
-                    pm.update_left(count)
+    # Remember what we have looked at.
+    for c, stamp in chunks.iteritems():
+        stamp_cache.set(c, [' ', None, 0], stamp)
+    stamp_cache.mtime = scan_start
 
     if genpoi is False:
         pm.set_complete()
+        elapsed = max(time.time() - start, 0.001)
+        print '   Scanned %d chunks in %.2fs (%d chunks/sec)' % (
+            len(chunks), elapsed, len(chunks) / elapsed)
+        print ' Cache hit rate: %d/%d (%d%%)' % (
+            cached, cached + len(chunks),
+            100 * cached / max(cached + len(chunks), 1))
+
+    # Bring the index up to date. Only structures we found again, or have
+    # not seen before, need their data libraries decoded.
+    for key, info in dungeon_index.items():
+        if key not in dungeonCache and key not in tHuntCache:
+            dungeon_index.remove(key)
+    for (cache, kind, decode) in (
+        (dungeonCache, 'dungeon', utils.decodeDungeonInfo),
+        (tHuntCache, 'thunt', utils.decodeTHuntInfo),
+    ):
+        for key, entity in cache.iteritems():
+            if (
+                key in found or
+                key not in dungeon_index or
+                dungeon_index.kind(key) != kind
+            ):
+                dungeon_index.add(key, kind, decode(entity))
+    dungeon_index.mtime = scan_start
 
-    # Save the caches
+    # Save the caches. The index goes last, so it never claims a scan the
+    # other caches don't have.
     utils.saveDungeonCache(cache_path, dungeonCache)
     utils.saveTHuntCache(cache_path, tHuntCache)
+    stamp_cache.save()
+    utils.saveDungeonIndex(dungeon_index)
+
+
+def loadCaches(expand_fill_caves=False, genpoi=False):
+    '''Find the dungeons and treasure hunts in a world. These come from
+    the dungeon index, which is only refreshed by a scan if the world has
+    changed since it was last brought up to date.'''
+
+    global world
+    global cache_path
+
+    # Try to load the dungeon cache
+    dungeonCacheOld, dmtime = utils.loadDungeonCache(cache_path)
+
+    # Try to load the treasure hunt cache
+    tHuntCacheOld, tmtime = utils.loadTHuntCache(cache_path)
+    mtime = min(dmtime, tmtime)
+
+    dungeon_index = utils.loadDungeonIndex(cache_path)
+    regions = utils.listRegionFiles(world)
+    if (
+        mtime == 0 or
+        dungeon_index.mtime == 0 or
+        utils.regionsModifiedSince(regions, dungeon_index.mtime)
+    ):
+        scanDungeons(dungeon_index, regions, dungeonCacheOld, tHuntCacheOld,
+                     mtime, genpoi)
+    elif genpoi is False:
+        print 'World unchanged since the last scan. Using the dungeon index.'
 
     output = ''
     poiOutput = ''
@@ -729,8 +967,7 @@ def loadCaches(expand_fill_caves=False, genpoi=False):
     output += '+-----------+----------------+---------+-------+----+'\
               '-------------------------+\n'
 
-    for tileEntity in dungeonCache.values():
-        info = utils.decodeDungeonInfo(tileEntity)
+    for key, info in dungeon_index.items('dungeon'):
         try:
             (major, minor, patch) = info['version'].split('.')
         except KeyError:
@@ -811,8 +1048,7 @@ def loadCaches(expand_fill_caves=False, genpoi=False):
         output += '+-----------+----------------+---------+-------+----+'\
                   '-------------------------+\n'
 
-    for tileEntity in tHuntCache.values():
-        info = utils.decodeTHuntInfo(tileEntity)
+    for key, info in dungeon_index.items('thunt'):
         try:
             (major, minor, patch) = info['version'].split('.')
         except KeyError:
@@ -1234,6 +1470,15 @@ def main():
     if world is None:
         world = loadWorld(args.world)
 
+    # Roll back anything a stopped run wrote to the world but didn't save.
+    # Commands that only read the world leave it alone.
+    if (
+        args.command in ('add', 'addth', 'regenerate', 'delete') and
+        len(CommitJournal(cache_path).pending()) > 0
+    ):
+        recover(world, cache_path,
+                mapstore.new(cfg.mapstore, cfg.dir_paintings))
+
     # List mode
     if (args.command == 'list'):
         # List the known dungeons and exit
@@ -1364,12 +1609,8 @@ def main():
         # No dungeons. Exit.
         if len(dungeons) == 0 and len(tHunts) == 0:
             sys.exit()
-        # A list of existing dungeon positions for convenience.
-        existing = set()
-        for d in dungeons:
-            existing.add((d[0], d[1]))
-        for t in tHunts:
-            existing.add((t[0], t[1]))
+        # Everything we know about comes from the dungeon index.
+        dungeon_index = utils.loadDungeonIndex(cache_path)
         # Populate a list of dungeons to delete.
         # If --all was specified, populate the delete list will all known dungeons.
         # Otherwise just validate the -d options.
@@ -1381,17 +1622,16 @@ def main():
                 to_delete.append((t[0], t[1]))
         else:
             for d in args.dungeons:
-                if (d[0], d[1]) not in existing:
+                if '%s,%s' % (d[0], d[1]) not in dungeon_index:
                     sys.exit('Unable to locate dungeon/hunt at %d %d.' % (d[0], d[1]))
                 to_delete.append(d)
         # Build a list of chunks to delete from the dungeon info.
-        chunks = []
+        chunks = set()
         # We need to update the caches for the chunks we are affecting
         dcache, dmtime = utils.loadDungeonCache(cache_path)
         tcache, tmtime = utils.loadTHuntCache(cache_path)
         ms = mapstore.new(cfg.mapstore, cfg.dir_paintings)
         for d in to_delete:
-            p = [d[0] / 16, d[1] / 16]
             print 'Deleting dungeon/hunt at %d %d...' % (d[0], d[1])
             dkey = '%s,%s' % (d[0], d[1])
             ms.delete_maps(dkey)
@@ -1401,47 +1641,27 @@ def main():
                 del tcache[dkey]
             else:
                 print 'WARN: Object not in dungeon cache or thunt cache! ' + dkey
-            xsize = 0
-            zsize = 0
-            for e in dungeons:
-                if e[0] == d[0] and e[1] == d[1]:
-                    xsize = e[2]
-                    zsize = e[3]
-                    # Fill caves. Delete all chunks.
-                    if e[4]['fill_caves'] is True:
-                        p[0] -= 5
-                        p[1] -= 5
-                        xsize += 10
-                        zsize += 10
-                    for x in xrange(xsize):
-                        for z in xrange(zsize):
-                            chunks.append((p[0] + x, p[1] + z))
-                    break
-            for e in tHunts:
-                if e[0] == d[0] and e[1] == d[1]:
-                    xsize = 1
-                    zsize = 1
-                    for l in e[4]['landmarks']:
-                        chunks.append(((l.x+e[0])>>4,(l.z+e[1])>>4))
-                    chunks.append((p[0], p[1]))
-                    break
+            # The footprint includes the fill_caves area and any landmarks.
+            chunks.update(dungeon_index.footprintChunks(dkey))
+            dungeon_index.remove(dkey)
         # We need to update the caches for the chunks we are affecting
         ccache, cmtime = utils.loadChunkCache(cache_path)
         # Delete the chunks
         for c in chunks:
             if world.containsChunk(c[0], c[1]):
                 world.deleteChunk(c[0], c[1])
-                ckey = '%s,%s' % (c[0], c[1])
+                ckey = (c[0], c[1])
                 if ckey in ccache:
                     del ccache[ckey]
                 else:
-                    print 'WARN: Chunk not in chunk cache! ' + ckey
+                    print 'WARN: Chunk not in chunk cache! %s,%s' % ckey
         # Save the world.
         print "Saving..."
         world.saveInPlace()
         utils.saveDungeonCache(cache_path, dcache)
         utils.saveTHuntCache(cache_path, tcache)
         utils.saveChunkCache(cache_path, ccache)
+        utils.saveDungeonIndex(dungeon_index)
         sys.exit()
 
     # Regenerate mode
@@ -1488,6 +1708,15 @@ def main():
         cfg.fill_caves = False
         args.write = True
 
+        relighter = Relighter(world, args.relight_every,
+                              engine=args.lighting)
+        committer = Committer(world,
+                              cache_path,
+                              [(utils.saveDungeonCache, dungeon_cache),
+                               (utils.saveChunkCache, chunk_cache)],
+                              args.commit_every,
+                              relighter)
+
         # Now go through each dungeon
         for d in to_regen:
             # Delete the existing maps for this dungeon so they can be recycled.
@@ -1509,11 +1738,14 @@ def main():
                               chunk_cache,
                               dungeon_cache,
                               good_chunks,
-                              map_store)
+                              map_store,
+                              relighter=relighter,
+                              committer=committer)
             result = dungeon.generate(cache_path, __version__)
             if result is False:
                 print 'Failed to regenerate dungeon! Aborting!'
                 sys.ext(1)
+        committer.finish()
         sys.exit()
 
     if (args.command == 'add'):
@@ -1684,10 +1916,11 @@ def main():
             print '   ', cfg.min_levels
             print '   ', cfg.max_levels
 
+    # Load the chunk cache
+    chunk_cache, chunk_mtime = utils.loadChunkCache(cache_path)
+
     # Look for good chunks
     if (cfg.offset is None or cfg.offset is ''):
-        # Load the chunk cache
-        chunk_cache, chunk_mtime = utils.loadChunkCache(cache_path)
         cached = 0
         notcached = 1
 
@@ -1744,39 +1977,67 @@ def main():
         # Pass 1 will prefilter the chunks, weeding out the trivial cases. This
         # saves setup time when multiprocessing in pass 2.
         print 'Finding good chunks:'
+        scan_start = int(time.time())
         pm = pmeter.ProgressMeter()
-        pm.init(world.chunkCount, label='Pass 1:')
-        cc = 0
-        chunks = set()
+        chunks = {}
         if args.spawn is not None:
             sx = args.spawn[0] >> 4
             sz = args.spawn[1] >> 4
         else:
             sx = world.playerSpawnPosition()[0] >> 4
             sz = world.playerSpawnPosition()[2] >> 4
-        for c in world.allChunks:
-            cx = c[0]
-            cz = c[1]
-            key = '%s,%s' % (cx, cz)
-            # Far chunk
-            if (numpy.sqrt((cx - sx) * (cx - sx) + (cz - sz) * (cz - sz)) > cfg.max_dist):
-                chunk_stats['F']['count'] += 1
-                continue
-            # Near chunk
-            if (numpy.sqrt((cx - sx) * (cx - sx) + (cz - sz) * (cz - sz)) < cfg.min_dist):
-                chunk_stats['N']['count'] += 1
-                continue
-            # Cached chunk
-            if (
-                world.worldFolder.getRegionForChunk(cx, cz).getTimestamp(cx, cz) < chunk_mtime and
-                key in chunk_cache
-            ):
-                chunk_stats[chunk_cache[key][0]]['count'] += 1
-                if chunk_cache[key][0] == 'G':
-                    good_chunks[(cx, cz)] = chunk_cache[key][2]
-                cached += 1
-                continue
-            chunks.add(c)
+        # Only regions that overlap the min_dist..max_dist ring are opened.
+        regions, inner = utils.regionsInRing(utils.listRegionFiles(world),
+                                             sx, sz,
+                                             cfg.min_dist, cfg.max_dist)
+        pm.init(len(regions), label='Pass 1:')
+        rc = 0
+        near = 0
+        in_ring = 0
+        invalidated = 0
+        for (rx, rz, path) in inner:
+            try:
+                near += int(utils.readRegionHeader(path, False)[0].sum())
+            except (IOError, OSError):
+                pass
+        for (cxs, czs, stamps, rmtime) in utils.regionChunks(regions,
+                                                             chunk_mtime):
+            dx = cxs - sx
+            dz = czs - sz
+            dist = numpy.sqrt(dx * dx + dz * dz)
+            # Far chunks are counted as whatever is left over at the end.
+            far_chunks = dist > cfg.max_dist
+            near_chunks = ~far_chunks & (dist < cfg.min_dist)
+            near += int(near_chunks.sum())
+            ring = ~far_chunks & ~near_chunks
+            in_ring += int(ring.sum())
+            cxs = cxs[ring]
+            czs = czs[ring]
+            if stamps is not None:
+                stamps = stamps[ring]
+            # Cached chunks are trusted until their region timestamp moves
+            # past the one recorded when they were classified.
+            (stale, records, stamps) = utils.staleChunks(chunk_cache,
+                                                         cxs, czs,
+                                                         stamps, rmtime)
+            found = ~stale
+            invalidated += int((stale & (records['result'] != '')).sum())
+            cached += int(found.sum())
+            for result in chunk_stats.keys():
+                chunk_stats[result]['count'] += int(
+                    (records['result'][found] == result).sum())
+            good = found & (records['result'] == 'G')
+            good_chunks.update(zip(zip(cxs[good].tolist(),
+                                       czs[good].tolist()),
+                                   records['depth'][good].tolist()))
+            # Everything else needs a scan. Remember the timestamp each
+            # chunk had when we looked at it.
+            chunks.update(zip(zip(cxs[stale].tolist(), czs[stale].tolist()),
+                              stamps[stale].tolist()))
+            rc += 1
+            pm.update(rc)
+        chunk_stats['N']['count'] = near
+        chunk_stats['F']['count'] = max(world.chunkCount - near - in_ring, 0)
         pm.set_complete()
 
         # Pass 2 will do the heavy lifting on the interesting chunks.
@@ -1786,12 +2047,17 @@ def main():
         chunk_min = None
         chunk_max = None
 
-        # Handle this in the main thread if we aren't multiprocessing.
-        if args.workers is not None and args.workers < 2:
-            if args.debug:
-                print 'Working with a single process.'
-            for c in chunks:
-                (cx, cz, result, biome, depth) = classifyChunk(c)
+        start = time.time()
+        for batch, results in scanRegions(classifyRegion,
+                                          regionBatches(chunks)):
+            for r in results:
+                cx = int(r['cx'])
+                cz = int(r['cz'])
+                result = str(r['result'])
+                biome = int(r['biome'])
+                if biome < 0:
+                    biome = None
+                depth = int(r['depth'])
 
                 # Chunk map stuff
                 if args.debug:
@@ -1806,105 +2072,49 @@ def main():
 
                 # Classify chunks
                 notcached += 1
-                key = '%s,%s' % (cx, cz)
+                key = (cx, cz)
                 chunk_stats[result]['count'] += 1
-                chunk_cache[key] = [result, biome, depth]
+                chunk_cache.set(key, [result, biome, depth], chunks[key])
 
                 if result == 'G':
                     good_chunks[(cx, cz)] = chunk_cache[key][2]
 
-                # Update progress.
-                cc += 1
-                if cc % 200 == 0:
-                    pm.update(cc)
-
-                # Save progress occasionally. 
+                # Checkpoint progress occasionally. 
                 if notcached % 10000 == 0:
-                    utils.saveChunkCache(cache_path, chunk_cache)
-        # Process chunks in parallel. 
-        else:
-            if args.debug:
-                print 'Working with multiple processes. workers =', args.workers
-            with cf.ProcessPoolExecutor(max_workers = args.workers) as executor:
-                chunk_scans = {executor.submit(classifyChunk, c): c for c in chunks}
-                for future in cf.as_completed(chunk_scans):
-                    (cx, cz, result, biome, depth) = future.result()
-
-                    # Chunk map stuff
-                    if args.debug:
-                        if chunk_min is None:
-                            chunk_min = (cx, cz)
-                        else:
-                            chunk_min = (min(cx, chunk_min[0]), min(cz, chunk_min[1]))
-                        if chunk_max is None:
-                            chunk_max = (cx, cz)
-                        else:
-                            chunk_max = (max(cx, chunk_max[0]), max(cz, chunk_max[1]))
-
-                    # Classify chunks
-                    notcached += 1
-                    key = '%s,%s' % (cx, cz)
-                    chunk_stats[result]['count'] += 1
-                    chunk_cache[key] = [result, biome, depth]
-
-                    if result == 'G':
-                        good_chunks[(cx, cz)] = chunk_cache[key][2]
-
-                    # Update progress.
-                    cc += 1
-                    if cc % 200 == 0:
-                        pm.update(cc)
-
-                    # Save progress occasionally. 
-                    if notcached % 10000 == 0:
-                        utils.saveChunkCache(cache_path, chunk_cache)
+                    chunk_cache.checkpoint()
+
+            # Update progress.
+            cc += len(batch)
+            pm.update(cc)
 
         utils.saveChunkCache(cache_path, chunk_cache)
         pm.set_complete()
+        elapsed = max(time.time() - start, 0.001)
+        print '   Scanned %d chunks in %.2fs (%d chunks/sec)' % (
+            len(chunks), elapsed, len(chunks) / elapsed)
 
         # Load caches
         old_dungeons, old_thunts = loadCaches(expand_fill_caves=True)
 
-        # Find old dungeons
-        for d in old_dungeons:
-            if args.debug:
+        # Find old dungeons and hunts. Any good chunk they cover is taken.
+        if args.debug:
+            for d in old_dungeons:
                 print 'old dungeon:', d
-            p = (d[0] / 16, d[1] / 16)
-            for x in xrange(int(d[2])):
-                for z in xrange(int(d[3])):
-                    if (p[0] + x, p[1] + z) in good_chunks:
-                        del(good_chunks[(p[0] + x, p[1] + z)])
-                        key = '%s,%s' % (p[0] + x, p[1] + z)
-                        chunk_cache[key] = ['S', -1, 0]
-                        chunk_stats['S']['count'] += 1
-                        chunk_stats['G']['count'] -= 1
-
-        # Find old hunts
-        for t in old_thunts:
-            if args.debug:
+            for t in old_thunts:
                 print 'old treasure hunt:', t
-            p = (t[0] / 16, t[1] / 16)
-            if (p[0], p[1]) in good_chunks:
-                del(good_chunks[(p[0], p[1])])
-                key = '%s,%s' % (p[0], p[1])
+        dungeon_index = utils.loadDungeonIndex(cache_path)
+        for key in good_chunks.keys():
+            if dungeon_index.at(key[0], key[1]):
+                del(good_chunks[key])
                 chunk_cache[key] = ['S', -1, 0]
                 chunk_stats['S']['count'] += 1
                 chunk_stats['G']['count'] -= 1
-            for l in t[4]['landmarks']:
-                cx = l.x >> 4
-                cz = l.z >> 4
-                if (cx, cz) in good_chunks:
-                    del(good_chunks[(cx, cz)])
-                    key = '%s,%s' % (cx, cz)
-                    chunk_cache[key] = ['S', -1, 0]
-                    chunk_stats['S']['count'] += 1
-                    chunk_stats['G']['count'] -= 1
 
         # Funky little chunk map
         if args.debug and chunk_min and chunk_max:
             for cz in xrange(chunk_min[1], chunk_max[1] + 1):
                 for cx in xrange(chunk_min[0], chunk_max[0] + 1):
-                    key = '%s,%s' % (cx, cz)
+                    key = (cx, cz)
                     if key in chunk_cache:
                         if chunk_cache[key][0] == 'I':
                             sys.stdout.write(materials.RED)
@@ -1927,7 +2137,10 @@ def main():
                         sys.stdout.write('  ')
                 print
 
-        # Re-cache the chunks and update mtime
+        # Re-cache the chunks and update mtime. Chunks far outside any
+        # max_dist we have used are dropped from the cache.
+        chunk_cache.evict(sx, sz, cfg.max_dist)
+        chunk_cache.mtime = scan_start
         utils.saveChunkCache(cache_path, chunk_cache)
 
         order = sorted(chunk_stats.items(), key=lambda x: x[1]['order'])
@@ -1935,12 +2148,58 @@ def main():
             print '   %s: %d' % (stat[1]['name'], stat[1]['count'])
         print ' Cache hit rate: %d/%d (%d%%)' % (cached, notcached + cached,
                                                  100 * cached / (notcached + cached))
+        print '    Invalidated: %d/%d (%d%%)' % (invalidated,
+                                              invalidated + cached,
+                                              100 * invalidated /
+                                              max(invalidated + cached, 1))
 
     # Load the dungeon cache for updates later.
     dungeon_cache, mtime = utils.loadDungeonCache(cache_path)
     thunt_cache, tmtime = utils.loadTHuntCache(cache_path)
     # Create a map store
     map_store = mapstore.new(cfg.mapstore, cfg.dir_paintings)
+    # Runs that place more than one dungeon share a placement plan, rather
+    # than searching all the good chunks again for every dungeon.
+    plan = None
+    if args.command == 'add' and args.number != 1:
+        plan = PlacementPlan(good_chunks,
+                             [(int(x) >> 4, int(z) >> 4) for (x, z) in
+                              [k.split(',') for k in dungeon_cache]],
+                             cfg.maximize_distance)
+
+    # Pipelined runs build each dungeon while the last one is written out,
+    # so the world is shared between two threads.
+    run_world = world
+    pipeline = None
+    if plan is not None and args.pipeline is True:
+        run_world = LockedWorld(world)
+        pipeline = Pipeline()
+    # Or several are built at once in worker processes. The output needs
+    # the rooms of each dungeon, which stay in the workers.
+    builder = None
+    if (
+        plan is not None and
+        args.parallel_generate is True and
+        (args.workers is None or args.workers > 1) and
+        args.html is None and
+        args.term is None
+    ):
+        run_world = world
+        pipeline = None
+        builder = ParallelBuilder(world, map_store, args.workers)
+
+    # Dirty chunks are handed to one relighter for the whole run, which
+    # relights them in batches of relight_every dungeons.
+    relighter = Relighter(run_world, args.relight_every,
+                          engine=args.lighting)
+    # Likewise, saves are made every commit_every dungeons.
+    if (args.command == 'addth'):
+        caches = [(utils.saveTHuntCache, thunt_cache)]
+    else:
+        caches = [(utils.saveDungeonCache, dungeon_cache)]
+    caches.append((utils.saveChunkCache, chunk_cache))
+    committer = Committer(run_world, cache_path, caches, args.commit_every,
+                          relighter)
 
     # Generate dungeons!
     count = 0
@@ -1963,7 +2222,9 @@ def main():
                           chunk_cache,
                           thunt_cache,
                           good_chunks,
-                          map_store)
+                          map_store,
+                          relighter,
+                          committer)
             result = thunt.generate(cache_path, __version__)
             del(thunt)
         else:
@@ -1973,16 +2234,29 @@ def main():
                 print '\n***** Placing dungeon {0} of {1} *****\n'.format(count + 1,
                                                                       args.number)
             dungeon = Dungeon(args,
-                          world,
+                          run_world,
                           chunk_cache,
                           dungeon_cache,
                           good_chunks,
-                          map_store)
-            result = dungeon.generate(cache_path, __version__)
+                          map_store,
+                          plan,
+                          relighter,
+                          committer)
+            if builder is not None:
+                result = builder.generate(dungeon, cache_path, __version__)
+            elif pipeline is not None:
+                result = pipeline.generate(dungeon, cache_path, __version__)
+            else:
+                result = dungeon.generate(cache_path, __version__)
             del(dungeon)
         if result:
             count += 1
 
+    if pipeline is not None:
+        pipeline.finish()
+    if builder is not None:
+        builder.finish()
+    committer.finish()
 
     if (count == 0):
         if (args.command == 'addth'):
@@ -2013,6 +2287,11 @@ if __name__ == "__main__":
     import cfg
     import loottable
     from dungeon import Dungeon
+    from placement import PlacementPlan
+    from relight import Relighter
+    from commitlog import CommitJournal, Committer, recover
+    from pipeline import LockedWorld, Pipeline
+    from parallel import ParallelBuilder
     from treasure_hunt import TreasureHunt
     import utils
     from utils import Vec
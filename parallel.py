@@ -0,0 +1,167 @@
+import collections
+import multiprocessing
+import os
+import platform
+import random
+import sys
+from cStringIO import StringIO
+
+import mapstore
+import pmeter
+from dungeon import Dungeon
+from utils import ChunkCopy
+from pymclevel.mclevelbase import ChunkNotPresent
+
+if platform.system() != 'Windows':
+    import concurrent.futures as cf
+
+# Multi-dungeon runs can build several dungeons at once in a pool of worker
+# processes. Once a dungeon has been located, building it only reads the
+# chunks under it, so the main process sends a worker copies of those
+# chunks, and the worker sends back the block buffer, tile entities and
+# entities. Everything that touches shared state, the map store, the world
+# and the caches, stays in the main process, and dungeons are written to the
+# world in the order they were located.
+
+# Dungeon attributes worked out by locate() that a worker needs.
+_located = ('position', 'xsize', 'zsize', 'levels', 'biome', 'dinfo')
+# Dungeon attributes a worker sends back once it is built.
+_built = ('blocks', 'tile_ents', 'ents', 'placed_items', 'chunk_edits',
+          'dinfo', 'dungeon_name', 'entrance_pos', 'key', 'cache_info')
+
+
+class WorldCopy(object):
+
+    '''Copies of the chunks under a dungeon, which stand in for the world
+    while it is built in a worker.'''
+
+    def __init__(self, world, chunks):
+        self.Height = world.Height
+        self.chunks = {}
+        for (cx, cz) in chunks:
+            if world.containsChunk(cx, cz):
+                self.chunks[(cx, cz)] = ChunkCopy(world.getChunk(cx, cz))
+
+    def containsChunk(self, cx, cz):
+        return (cx, cz) in self.chunks
+
+    def getChunk(self, cx, cz):
+        if (cx, cz) not in self.chunks:
+            raise ChunkNotPresent((cx, cz))
+        return self.chunks[(cx, cz)]
+
+
+class PaintingRequests(object):
+
+    '''Stands in for the map store while a dungeon is built in a worker.
+    Paintings get map ID 0, and each one is recorded so the main process
+    can give it a real map ID.'''
+
+    def __init__(self, painting_path):
+        self.painting_path = painting_path
+        self.requests = []
+
+    def add_painting(self, painting_file):
+        item = mapstore.paintingItem(self.painting_path, painting_file, 0)
+        self.requests.append((painting_file, item))
+        return item
+
+
+def _buildDungeon(spec):
+    '''Build a located dungeon in a worker process. Returns the built
+    attributes of the dungeon, including any chunks ruins drew into, the
+    paintings it asked for, and what it printed.'''
+    log = StringIO()
+    devnull = open(os.devnull, 'w')
+    stdout = sys.stdout
+    sys.stdout = log
+    try:
+        random.seed(spec['seed'])
+        paintings = PaintingRequests(spec['painting_path'])
+        dungeon = Dungeon(spec['args'],
+                          spec['world'],
+                          None,
+                          {},
+                          spec['good_chunks'],
+                          paintings)
+        dungeon.pm = pmeter.ProgressMeter(outstream=devnull)
+        for name in _located:
+            setattr(dungeon, name, spec[name])
+        dungeon.buildblocks(spec['version'])
+    finally:
+        sys.stdout = stdout
+        devnull.close()
+    built = dict((name, getattr(dungeon, name)) for name in _built)
+    # The painting items are pickled along with the tile entities that hold
+    # them, so the main process gets the same objects back in both.
+    return (built, paintings.requests, log.getvalue())
+
+
+class ParallelBuilder(object):
+
+    '''Builds dungeons in a pool of worker processes. generate() locates a
+    dungeon and hands it to a worker. Once every worker has a dungeon, the
+    oldest one is written to the world each time another is handed out, so
+    the main process writes one while the workers build the next ones.
+    Paintings and maps are added, meta materials resolved, and the dungeon
+    written in the main process, in the order the dungeons were located.
+    Chunks ruins drew into come back as the dungeon's chunk_edits, and are
+    only written to the world by write(), after it is journaled.'''
+
+    def __init__(self, world, map_store, workers=None):
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self.world = world
+        self.map_store = map_store
+        self.workers = workers
+        self.executor = cf.ProcessPoolExecutor(max_workers=workers)
+        self.queue = collections.deque()
+
+    def generate(self, dungeon, cache_path, version):
+        '''Locate a dungeon and start building it. It is written by a later
+        call, or by finish(). Returns False if there was nowhere to put
+        it.'''
+        if dungeon.locate() is False:
+            return False
+        dungeon.reservechunks()
+        cx = dungeon.position.x >> 4
+        cz = dungeon.position.z >> 4
+        # The largest ruins look at the chunks in a 4 x 4 area from the
+        # corner of the dungeon, even if it is smaller than that.
+        chunks = [(x, z)
+                  for x in xrange(cx, cx + max(dungeon.xsize, 4))
+                  for z in xrange(cz, cz + max(dungeon.zsize, 4))]
+        spec = {
+            'args': dungeon.args,
+            'world': WorldCopy(self.world, chunks),
+            'good_chunks': dungeon.good_chunks,
+            'painting_path': self.map_store.painting_path,
+            'seed': random.getrandbits(32),
+            'version': version,
+        }
+        for name in _located:
+            spec[name] = getattr(dungeon, name)
+        future = self.executor.submit(_buildDungeon, spec)
+        self.queue.append((dungeon, cache_path, future))
+        if len(self.queue) > self.workers:
+            self.writeNext()
+        return True
+
+    def writeNext(self):
+        '''Wait for the oldest dungeon to be built, and write it.'''
+        (dungeon, cache_path, future) = self.queue.popleft()
+        (built, paintings, log) = future.result()
+        print '\nBuilt the dungeon at', dungeon.position
+        sys.stdout.write(log)
+        for name, value in built.iteritems():
+            setattr(dungeon, name, value)
+        for (painting_file, item) in paintings:
+            item['Damage'].value = self.map_store.painting_id(painting_file)
+        dungeon.finishbuild()
+        dungeon.write(cache_path)
+
+    def finish(self):
+        '''Write every dungeon still being built, and stop the workers.'''
+        while len(self.queue) > 0:
+            self.writeNext()
+        self.executor.shutdown()
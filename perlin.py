@@ -8,6 +8,8 @@ __version__ = '$Id: perlin.py 521 2008-12-15 03:03:52Z casey.duncan $'
 from math import floor, fmod, sqrt
 from random import randint
 
+import numpy
+
 # 3D Gradient vectors
 _GRAD3 = ((1, 1, 0), (-1, 1, 0), (1, -1, 0), (-1, -1, 0),
           (1, 0, 1), (-1, 0, 1), (1, 0, -1), (-1, 0, -1),
@@ -37,6 +39,24 @@ _SIMPLEX = (
     (2, 0, 1, 3), (0, 0, 0, 0), (0, 0, 0, 0), (0, 0, 0, 0), (3, 0, 1, 2), (3, 0, 2, 1), (0, 0, 0, 0), (3, 1, 2, 0),
     (2, 1, 0, 3), (0, 0, 0, 0), (0, 0, 0, 0), (0, 0, 0, 0), (3, 1, 0, 2), (0, 0, 0, 0), (3, 2, 0, 1), (3, 2, 1, 0))
 
+# Noise over arrays is worked out this many points at a time, which keeps
+# the memory used by temporaries bounded for large fields.
+_batch = 1 << 16
+
+
+def _batched(func, arrays, *args):
+    """Call func on flat batches of the broadcast coordinate arrays, and
+    return the results in the broadcast shape."""
+    arrays = numpy.broadcast_arrays(*[numpy.asarray(a, dtype=float)
+                                      for a in arrays])
+    shape = arrays[0].shape
+    flat = [a.ravel() for a in arrays]
+    out = numpy.empty(flat[0].size)
+    for start in xrange(0, out.size, _batch):
+        out[start:start + _batch] = func(
+            *[a[start:start + _batch] for a in flat] + list(args))
+    return out.reshape(shape)
+
 # Simplex skew constants
 _F2 = 0.5 * (sqrt(3.0) - 1.0)
 _G2 = (3.0 - sqrt(3.0)) / 6.0
@@ -309,6 +329,122 @@ class SimplexNoise(BaseNoise):
 
         return noise * 32.0
 
+    def noise2array(self, xs, ys):
+        """2D Perlin simplex noise over arrays.
+
+        The coordinate arrays are broadcast together, and an array of the
+        same shape is returned, holding the noise2() value at each point.
+        """
+        return _batched(self._noise2array, (xs, ys))
+
+    def _noise2array(self, x, y):
+        # Skew input space to determine which simplex (triangle) we are in
+        s = (x + y) * _F2
+        i = numpy.floor(x + s)
+        j = numpy.floor(y + s)
+        t = (i + j) * _G2
+        x0 = x - (i - t)  # "Unskewed" distances from cell origin
+        y0 = y - (j - t)
+
+        # Lower triangle, XY order: (0,0)->(1,0)->(1,1)
+        # Upper triangle, YX order: (0,0)->(0,1)->(1,1)
+        i1 = (x0 > y0).astype(int)
+        j1 = 1 - i1
+
+        # Offsets for middle corner in (x,y) unskewed coords
+        x1 = x0 - i1 + _G2
+        y1 = y0 - j1 + _G2
+        # Offsets for last corner in (x,y) unskewed coords
+        x2 = x0 + _G2 * 2.0 - 1.0
+        y2 = y0 + _G2 * 2.0 - 1.0
+
+        # Determine hashed gradient indices of the three simplex corners
+        perm = numpy.array(self.permutation)
+        ii = i.astype(int) % self.period
+        jj = j.astype(int) % self.period
+        gi0 = perm[ii + perm[jj]] % 12
+        gi1 = perm[ii + i1 + perm[jj + j1]] % 12
+        gi2 = perm[ii + 1 + perm[jj + 1]] % 12
+
+        # Calculate the contribution from the three corners
+        grad = numpy.array(_GRAD3, dtype=float)
+        noise = numpy.zeros(x.shape)
+        for (gi, cx, cy) in ((gi0, x0, y0), (gi1, x1, y1), (gi2, x2, y2)):
+            tt = 0.5 - cx ** 2 - cy ** 2
+            g = grad[gi]
+            noise += numpy.where(
+                tt > 0, tt ** 4 * (g[..., 0] * cx + g[..., 1] * cy), 0.0)
+
+        return noise * 70.0  # scale noise to [-1, 1]
+
+    def noise3array(self, xs, ys, zs):
+        """3D Perlin simplex noise over arrays.
+
+        The coordinate arrays are broadcast together, and an array of the
+        same shape is returned, holding the noise3() value at each point.
+        """
+        return _batched(self._noise3array, (xs, ys, zs))
+
+    def _noise3array(self, x, y, z):
+        # Skew the input space to determine which simplex cell we're in
+        s = (x + y + z) * _F3
+        i = numpy.floor(x + s)
+        j = numpy.floor(y + s)
+        k = numpy.floor(z + s)
+        t = (i + j + k) * _G3
+        x0 = x - (i - t)  # "Unskewed" distances from cell origin
+        y0 = y - (j - t)
+        z0 = z - (k - t)
+
+        # Determine which simplex we are in. This is the same decision tree
+        # as noise3(), worked out for every point at once.
+        xy = x0 >= y0
+        yz = y0 >= z0
+        xz = x0 >= z0
+        i1 = (xy & (yz | xz)).astype(int)
+        j1 = (~xy & yz).astype(int)
+        k1 = ((xy & ~yz & ~xz) | (~xy & ~yz)).astype(int)
+        i2 = ((xy) | (~xy & yz & xz)).astype(int)
+        j2 = ((xy & yz) | ~xy).astype(int)
+        k2 = ((xy & ~yz) | (~xy & ~(yz & xz))).astype(int)
+
+        # Offsets for remaining corners
+        x1 = x0 - i1 + _G3
+        y1 = y0 - j1 + _G3
+        z1 = z0 - k1 + _G3
+        x2 = x0 - i2 + 2.0 * _G3
+        y2 = y0 - j2 + 2.0 * _G3
+        z2 = z0 - k2 + 2.0 * _G3
+        x3 = x0 - 1.0 + 3.0 * _G3
+        y3 = y0 - 1.0 + 3.0 * _G3
+        z3 = z0 - 1.0 + 3.0 * _G3
+
+        # Calculate the hashed gradient indices of the four simplex corners
+        perm = numpy.array(self.permutation)
+        ii = i.astype(int) % self.period
+        jj = j.astype(int) % self.period
+        kk = k.astype(int) % self.period
+        gi0 = perm[ii + perm[jj + perm[kk]]] % 12
+        gi1 = perm[ii + i1 + perm[jj + j1 + perm[kk + k1]]] % 12
+        gi2 = perm[ii + i2 + perm[jj + j2 + perm[kk + k2]]] % 12
+        gi3 = perm[ii + 1 + perm[jj + 1 + perm[kk + 1]]] % 12
+
+        # Calculate the contribution from the four corners
+        grad = numpy.array(_GRAD3, dtype=float)
+        noise = numpy.zeros(x.shape)
+        for (gi, cx, cy, cz) in ((gi0, x0, y0, z0),
+                                 (gi1, x1, y1, z1),
+                                 (gi2, x2, y2, z2),
+                                 (gi3, x3, y3, z3)):
+            tt = 0.6 - cx ** 2 - cy ** 2 - cz ** 2
+            g = grad[gi]
+            noise += numpy.where(
+                tt > 0,
+                tt ** 4 * (g[..., 0] * cx + g[..., 1] * cy + g[..., 2] * cz),
+                0.0)
+
+        return noise * 32.0
+
 
 def lerp(t, a, b):
     return a + t * (b - a)
@@ -373,3 +509,57 @@ class TileableNoise(BaseNoise):
                                   grad3(perm[BA + kk], x - 1, y, z - 1)),
                          lerp(fx, grad3(perm[AB + kk], x, y - 1, z - 1),
                               grad3(perm[BB + kk], x - 1, y - 1, z - 1))))
+
+    def noise3array(self, xs, ys, zs, repeat, base=0.0):
+        """Tileable 3D noise over arrays.
+
+        The coordinate arrays are broadcast together, and an array of the
+        same shape is returned, holding the noise3() value at each point.
+        """
+        return _batched(self._noise3array, (xs, ys, zs), repeat, base)
+
+    def _noise3array(self, x, y, z, repeat, base):
+        i = numpy.fmod(numpy.floor(x), repeat).astype(int)
+        j = numpy.fmod(numpy.floor(y), repeat).astype(int)
+        k = numpy.fmod(numpy.floor(z), repeat).astype(int)
+        ii = (i + 1) % repeat
+        jj = (j + 1) % repeat
+        kk = (k + 1) % repeat
+        if base:
+            i += base
+            j += base
+            k += base
+            ii += base
+            jj += base
+            kk += base
+
+        x = x - numpy.floor(x)
+        y = y - numpy.floor(y)
+        z = z - numpy.floor(z)
+        fx = x ** 3 * (x * (x * 6 - 15) + 10)
+        fy = y ** 3 * (y * (y * 6 - 15) + 10)
+        fz = z ** 3 * (z * (z * 6 - 15) + 10)
+
+        perm = numpy.array(self.permutation)
+        A = perm[i]
+        AA = perm[A + j]
+        AB = perm[A + jj]
+        B = perm[ii]
+        BA = perm[B + j]
+        BB = perm[B + jj]
+
+        grad = numpy.array(_GRAD3, dtype=float)
+
+        def grad3array(hash, x, y, z):
+            g = grad[hash % 16]
+            return x * g[..., 0] + y * g[..., 1] + z * g[..., 2]
+
+        return lerp(fz, lerp(fy, lerp(fx, grad3array(perm[AA + k], x, y, z),
+                                      grad3array(perm[BA + k], x - 1, y, z)),
+                             lerp(fx, grad3array(perm[AB + k], x, y - 1, z),
+                                  grad3array(perm[BB + k], x - 1, y - 1, z))),
+                    lerp(fy, lerp(fx, grad3array(perm[AA + kk], x, y, z - 1),
+                                  grad3array(perm[BA + kk], x - 1, y, z - 1)),
+                         lerp(fx, grad3array(perm[AB + kk], x, y - 1, z - 1),
+                              grad3array(perm[BB + kk], x - 1, y - 1,
+                                         z - 1))))
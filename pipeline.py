@@ -0,0 +1,122 @@
+import sys
+import threading
+import types
+
+# Multi-dungeon runs can build each dungeon while the one before it is
+# written to the world and saved by a background thread. Building is mostly
+# Python and NumPy work on the dungeon's own block buffer, while writing is
+# mostly chunk I/O, compression and saving, so the two overlap well. Only
+# one dungeon is written at a time. The next dungeon is located before the
+# last one starts writing, so placement does not wait for a settled world.
+# It is kept apart from dungeons still to be written by the placement plan,
+# which claims each footprint as it is chosen, and by reservechunks(), which
+# takes a built dungeon's chunks out of the shared good chunks.
+
+
+def _lockedIter(it, lock):
+    '''Step a generator with a lock held, releasing it between steps.'''
+    while True:
+        lock.acquire()
+        try:
+            try:
+                step = it.next()
+            except StopIteration:
+                return
+        finally:
+            lock.release()
+        yield step
+
+
+class LockedWorld(object):
+
+    '''A world whose methods all run with a lock held, so a dungeon being
+    built and a dungeon being written can share it. Chunks are handed out
+    as they are. The two dungeons never share chunks, so only the calls
+    into pymclevel itself need to take turns.'''
+
+    def __init__(self, world, lock=None):
+        if lock is None:
+            lock = threading.Lock()
+        self.__dict__['_world'] = world
+        self.__dict__['_lock'] = lock
+
+    def __getattr__(self, name):
+        attr = getattr(self._world, name)
+        if not callable(attr):
+            return attr
+        lock = self._lock
+
+        def call(*args, **kwargs):
+            lock.acquire()
+            try:
+                result = attr(*args, **kwargs)
+            finally:
+                lock.release()
+            if isinstance(result, types.GeneratorType):
+                return _lockedIter(result, lock)
+            return result
+        return call
+
+    def __setattr__(self, name, value):
+        setattr(self._world, name, value)
+
+
+class Pipeline(object):
+
+    '''Runs the stages of each dungeon so that building one overlaps with
+    writing the one before it. generate() locates a dungeon, starts the
+    write of the last one in the background, and then builds the new one.
+    Built dungeons reserve their chunks before they are handed over, so a
+    dungeon being placed can never land on one still being written.'''
+
+    def __init__(self):
+        self.ready = None
+        self.thread = None
+        self.error = None
+
+    def generate(self, dungeon, cache_path, version):
+        '''Locate and build a dungeon. It is written during the next call,
+        or by finish(). Returns False if there was nowhere to put it.'''
+        self.wait()
+        located = dungeon.locate()
+        self.start()
+        if located is False:
+            return False
+        dungeon.build(version)
+        dungeon.reservechunks()
+        self.ready = (dungeon, cache_path)
+        return True
+
+    def start(self):
+        '''Start writing the last built dungeon, if there is one.'''
+        if self.ready is None:
+            return
+        (dungeon, cache_path) = self.ready
+        self.ready = None
+        self.thread = threading.Thread(target=self._write,
+                                       args=(dungeon, cache_path))
+        self.thread.start()
+
+    def _write(self, dungeon, cache_path):
+        try:
+            dungeon.write(cache_path)
+        except BaseException:
+            # Handed back to the main thread by wait().
+            self.error = sys.exc_info()
+
+    def wait(self):
+        '''Wait for the write in progress. Anything it raised, including
+        sys.exit(), is raised again here.'''
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            (kind, value, tb) = self.error
+            self.error = None
+            raise kind, value, tb
+
+    def finish(self):
+        '''Write the last dungeon and wait for it.'''
+        self.wait()
+        self.start()
+        self.wait()
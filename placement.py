@@ -0,0 +1,259 @@
+import random
+
+import numpy
+
+# Dense grids over the good chunks for placing dungeons. Whether a rectangle
+# of chunks is entirely good comes from a summed-area table, and how deep
+# it is comes from a sliding window minimum over the chunk depths, so any
+# rectangle can be tested in constant time once a size has been chosen.
+
+
+def _slidingMin(a, n, axis):
+    '''Minimum over every window of n cells along an axis. The result is
+    n - 1 cells shorter along that axis. Windows are built up by doubling,
+    so this costs log(n) passes over the array.'''
+    a = numpy.swapaxes(a, 0, axis)
+    length = a.shape[0] - n + 1
+    if length <= 0:
+        return numpy.swapaxes(a[:0], 0, axis)
+    out = a
+    span = 1
+    while span * 2 <= n:
+        out = numpy.minimum(out[:-span], out[span:])
+        span *= 2
+    # out[i] is the minimum of a[i:i + span]. Two overlapping windows of
+    # span cover a window of n.
+    out = numpy.minimum(out[:length], out[n - span:n - span + length])
+    return numpy.swapaxes(out, 0, axis)
+
+
+def _longestRun(mask):
+    '''Return the longest run of True along the second axis of a mask.'''
+    if mask.size == 0:
+        return 0
+    idx = numpy.arange(1, mask.shape[1] + 1)
+    # The position just after the last False at or before each cell.
+    last = numpy.where(mask, 0, idx)
+    numpy.maximum.accumulate(last, axis=1, out=last)
+    return int((idx - last).max())
+
+
+def nearestDistances(x0, z0, width, length, points):
+    '''Return the distance from every chunk in a width x length grid, with
+    its corner at chunk (x0, z0), to the nearest of a list of (cx, cz)
+    points, which may lie outside the grid. This is an exact distance
+    transform done a line at a time, so its cost grows with the size of the
+    grid and the number of distinct point columns, not with every pairing
+    of chunks and points.'''
+    xs = numpy.arange(width) + x0
+    zs = numpy.arange(length) + z0
+    out = numpy.zeros((width, length)) + numpy.inf
+    if len(points) == 0 or width == 0 or length == 0:
+        return out
+    points = numpy.array(points, dtype=numpy.int64).reshape(-1, 2)
+    cols = numpy.unique(points[:, 1])
+    # Squared distance along x from each row to the nearest point in each
+    # point column.
+    g2 = numpy.zeros((width, len(cols)))
+    for i, c in enumerate(cols):
+        px = numpy.sort(points[points[:, 1] == c, 0])
+        j = numpy.searchsorted(px, xs)
+        left = px[numpy.maximum(j - 1, 0)]
+        right = px[numpy.minimum(j, len(px) - 1)]
+        g = numpy.minimum(numpy.abs(xs - left), numpy.abs(xs - right))
+        g2[:, i] = g * g
+    # For each row, the lower envelope of the parabolas
+    # g2[row, i] + (z - cols[i]) ** 2, built for all rows at once.
+    rows = numpy.arange(width)
+    cols = cols.astype(float)
+    v = numpy.zeros((width, len(cols)), dtype=int)
+    bounds = numpy.zeros((width, len(cols) + 1))
+    bounds[:, 0] = -numpy.inf
+    bounds[:, 1] = numpy.inf
+    k = numpy.zeros(width, dtype=int)
+
+    def intersect(r, i, q):
+        return (((g2[r, q] + cols[q] * cols[q]) -
+                 (g2[r, i] + cols[i] * cols[i])) /
+                (2 * (cols[q] - cols[i])))
+
+    for q in xrange(1, len(cols)):
+        s = intersect(rows, v[rows, k], q)
+        pop = s <= bounds[rows, k]
+        while pop.any():
+            k[pop] -= 1
+            s[pop] = intersect(rows[pop], v[pop, k[pop]], q)
+            pop = s <= bounds[rows, k]
+        k += 1
+        v[rows, k] = q
+        bounds[rows, k] = s
+        bounds[rows, k + 1] = numpy.inf
+    # Walk each envelope along z.
+    k = numpy.zeros(width, dtype=int)
+    for zi, z in enumerate(zs):
+        step = bounds[rows, k + 1] < z
+        while step.any():
+            k[step] += 1
+            step = bounds[rows, k + 1] < z
+        i = v[rows, k]
+        out[:, zi] = g2[rows, i] + (z - cols[i]) ** 2
+    return numpy.sqrt(out)
+
+
+class PlacementGrid(object):
+
+    '''A dense grid of good chunks and their depths. Grids are indexed
+    [x, z] from the chunk (x0, z0).'''
+
+    def __init__(self, good_chunks):
+        self.x0 = 0
+        self.z0 = 0
+        self.good = numpy.zeros((0, 0), dtype=bool)
+        self.depth = numpy.zeros((0, 0), dtype=numpy.int32)
+        if len(good_chunks) > 0:
+            keys = numpy.array(good_chunks.keys(), dtype=numpy.int64)
+            self.x0 = int(keys[:, 0].min())
+            self.z0 = int(keys[:, 1].min())
+            xs = keys[:, 0] - self.x0
+            zs = keys[:, 1] - self.z0
+            shape = (int(xs.max()) + 1, int(zs.max()) + 1)
+            self.good = numpy.zeros(shape, dtype=bool)
+            self.good[xs, zs] = True
+            self.depth = numpy.zeros(shape, dtype=numpy.int32) - 1
+            self.depth[xs, zs] = good_chunks.values()
+        # sat[x, z] is the number of good chunks in good[:x, :z].
+        self.sat = numpy.zeros((self.good.shape[0] + 1,
+                                self.good.shape[1] + 1),
+                               dtype=numpy.int32)
+        self.sat[1:, 1:] = self.good.cumsum(0).cumsum(1)
+
+    def goodCount(self, xsize, zsize):
+        '''Return the number of good chunks in every xsize x zsize
+        rectangle, indexed by the rectangle's corner.'''
+        sat = self.sat
+        return (sat[xsize:, zsize:] -
+                sat[:-xsize, zsize:] -
+                sat[xsize:, :-zsize] +
+                sat[:-xsize, :-zsize])
+
+    def minDepth(self, xsize, zsize):
+        '''Return the smallest depth in every xsize x zsize rectangle,
+        indexed by the rectangle's corner. Chunks that are not good have a
+        depth of -1.'''
+        return _slidingMin(_slidingMin(self.depth, xsize, 0), zsize, 1)
+
+    def fits(self, xsize, zsize, depth=0):
+        '''Return a mask of the corners where an xsize x zsize rectangle is
+        entirely good chunks, all at least depth deep.'''
+        (width, length) = self.good.shape
+        if xsize > width or zsize > length or xsize < 1 or zsize < 1:
+            return numpy.zeros((0, 0), dtype=bool)
+        mask = self.goodCount(xsize, zsize) == xsize * zsize
+        if depth > 0:
+            mask &= self.minDepth(xsize, zsize) >= depth
+        return mask
+
+    def corners(self, xsize, zsize, depth=0):
+        '''Return the set of chunks that can be the corner of an xsize x
+        zsize rectangle of good chunks, all at least depth deep.'''
+        xs, zs = numpy.nonzero(self.fits(xsize, zsize, depth))
+        return set(zip((xs + self.x0).tolist(), (zs + self.z0).tolist()))
+
+    def distances(self, points):
+        '''Return the distance from every chunk in the grid to the nearest
+        of a list of (cx, cz) points.'''
+        return nearestDistances(self.x0, self.z0,
+                                self.good.shape[0], self.good.shape[1],
+                                points)
+
+    def remove(self, cx, cz, xsize, zsize):
+        '''Remove an xsize x zsize rectangle of chunks with its corner at
+        (cx, cz) from the grid.'''
+        x0 = max(cx - self.x0, 0)
+        z0 = max(cz - self.z0, 0)
+        x1 = max(cx - self.x0 + xsize, 0)
+        z1 = max(cz - self.z0 + zsize, 0)
+        self.good[x0:x1, z0:z1] = False
+        self.depth[x0:x1, z0:z1] = -1
+        self.sat[1:, 1:] = self.good.cumsum(0).cumsum(1)
+
+    def maxLengths(self, xsizes, depths, min_length=1):
+        '''For a contiguous, ascending range of xsizes and a list of
+        ascending depths, return the longest zsize of a rectangle of good
+        chunks, all at least that deep, that fits anywhere in the grid. The
+        result is indexed [xsize, depth] by position in the lists. Lengths
+        shorter than min_length are not worked out, and may be left as 0.'''
+        lengths = numpy.zeros((len(xsizes), len(depths)), dtype=int)
+        if len(xsizes) == 0 or xsizes[0] > self.depth.shape[0]:
+            return lengths
+        # The smallest depth under each window of xsize chunks along x. Each
+        # wider window is the last one, one chunk further.
+        window = _slidingMin(self.depth, xsizes[0], 0)
+        for i, xsize in enumerate(xsizes):
+            if i > 0:
+                if xsize > self.depth.shape[0]:
+                    break
+                window = numpy.minimum(window[:-1], self.depth[xsize - 1:])
+            for j, depth in enumerate(depths):
+                lengths[i, j] = _longestRun(window >= max(depth, 0))
+                # Deeper rectangles can only be shorter.
+                if lengths[i, j] < min_length:
+                    break
+            # As can wider ones.
+            if lengths[i, 0] < min_length:
+                break
+        return lengths
+
+
+class PlacementPlan(object):
+
+    '''Placement state shared by every dungeon in a run that places more
+    than one. The grid is built once, and each placed dungeon claims its
+    footprint from it. Candidates are ordered by a random priority fixed
+    for each chunk when the plan is made or, with maximize_distance, by
+    their distance from the nearest dungeon, which is kept up to date as
+    dungeons are placed.'''
+
+    def __init__(self, good_chunks, dungeons=(), maximize_distance=False):
+        self.grid = PlacementGrid(good_chunks)
+        shape = self.grid.good.shape
+        rand = numpy.random.RandomState(random.getrandbits(32))
+        self.priority = rand.permutation(
+            shape[0] * shape[1]).reshape(shape)
+        self.maximize_distance = maximize_distance
+        self.dist = None
+        if maximize_distance and len(dungeons) > 0:
+            self.dist = self.grid.distances(dungeons)
+
+    def mark(self, cx, cz):
+        '''Record a dungeon at chunk (cx, cz) for maximize_distance.'''
+        if self.maximize_distance is False:
+            return
+        (width, length) = self.grid.good.shape
+        xs = numpy.arange(width)[:, numpy.newaxis] + self.grid.x0 - cx
+        zs = numpy.arange(length)[numpy.newaxis, :] + self.grid.z0 - cz
+        dist = numpy.sqrt(xs * xs + zs * zs)
+        if self.dist is None:
+            self.dist = dist
+        else:
+            numpy.minimum(self.dist, dist, out=self.dist)
+
+    def candidates(self, xsize, zsize, depth=0):
+        '''Return the corners where an xsize x zsize rectangle of good
+        chunks, all at least depth deep, will fit, in the order they should
+        be tried.'''
+        xs, zs = numpy.nonzero(self.grid.fits(xsize, zsize, depth))
+        if self.dist is None:
+            order = numpy.argsort(self.priority[xs, zs])
+        else:
+            # Furthest first. Ties are broken by priority.
+            order = numpy.lexsort((self.priority[xs, zs],
+                                   -self.dist[xs, zs]))
+        return zip((xs[order] + self.grid.x0).tolist(),
+                   (zs[order] + self.grid.z0).tolist())
+
+    def claim(self, cx, cz, xsize, zsize, position):
+        '''Take an xsize x zsize rectangle with its corner at (cx, cz) for
+        a dungeon at chunk position.'''
+        self.grid.remove(cx, cz, xsize, zsize)
+        self.mark(position[0], position[1])
@@ -0,0 +1,151 @@
+import time
+
+import lighting
+import pmeter
+
+
+class RelightMeter(object):
+
+    '''A progress callback for relighting that draws a progress bar. It is
+    called with (done, total), and starts a new bar whenever the total
+    changes, since pymclevel lights large sets of chunks in batches.'''
+
+    def __init__(self, label='Relighting chunks:'):
+        self.pm = pmeter.ProgressMeter()
+        self.label = label
+        self.total = None
+
+    def __call__(self, done, total):
+        if total != self.total:
+            if self.total is not None:
+                self.pm.set_complete()
+            self.total = total
+            self.pm.init(max(total, 1), label=self.label)
+        self.pm.update(min(max(done, 0), total))
+
+    def done(self):
+        if self.total is not None:
+            self.pm.set_complete()
+            self.total = None
+
+
+def relight(world, chunks, progress=None):
+    '''Relight a list of (cx, cz) chunk positions in a world. progress, if
+    given, is called with (done, total) as the lighting passes run.'''
+    if progress is None or not hasattr(world, 'generateLightsIter'):
+        world.generateLights(chunks)
+        return
+    for step in world.generateLightsIter(chunks):
+        # Steps are (done, total) or (done, total, status).
+        if isinstance(step, tuple) and len(step) >= 2:
+            progress(step[0], step[1])
+
+
+class Relighter(object):
+
+    '''Relights the chunks that dungeons change. Each dungeon adds its
+    changed chunks once they are written. With every=1 they are relit right
+    away, as they always were. With a larger every, the chunks of that many
+    dungeons are collected and relit together, so chunks shared by nearby
+    dungeons are lit once instead of once for each of them. With every=0
+    nothing is relit until flush() is called at the end of the run.
+
+    The engine is 'world' to have pymclevel relight every changed chunk
+    from top to bottom, or 'dungeon' to only relight around the blocks each
+    dungeon wrote, with lighting.relightVolume().'''
+
+    def __init__(self, world, every=1, progress=None, engine='world'):
+        self.world = world
+        self.every = every
+        self.progress = progress
+        self.engine = engine
+        self.pending = set()
+        self.volumes = []
+        self.waiting = 0
+        # Totals for the run. marked counts every chunk each dungeon
+        # changed, lit counts the chunks that were actually relit.
+        self.dungeons = 0
+        self.marked = 0
+        self.lit = 0
+        self.blocks = 0
+        self.batches = 0
+        self.seconds = 0.0
+
+    def add(self, chunks, volume=None):
+        '''Queue the chunks changed by one dungeon, and the LightVolume of
+        the blocks it wrote, if there is one. Returns True if they were relit
+        now.'''
+        chunks = set(chunks)
+        if self.engine == 'dungeon' and volume is not None:
+            self.volumes.append(volume)
+        else:
+            self.pending |= chunks
+        self.waiting += 1
+        self.dungeons += 1
+        self.marked += len(chunks)
+        if self.every > 0 and self.waiting >= self.every:
+            return self.flush()
+        return False
+
+    def flush(self):
+        '''Relight every queued chunk and volume. Returns True if there
+        were any.'''
+        chunks = sorted(self.pending)
+        volumes = self.volumes
+        waiting = self.waiting
+        self.pending = set()
+        self.volumes = []
+        self.waiting = 0
+        if len(volumes) > 0:
+            self.flushVolumes(volumes)
+        if len(chunks) == 0:
+            return len(volumes) > 0
+        if waiting > 1:
+            print 'Relighting {0} chunks from {1} dungeons...'.format(
+                len(chunks), waiting)
+        meter = self.progress
+        if meter is None:
+            meter = RelightMeter()
+        start = time.time()
+        relight(self.world, chunks, meter)
+        elapsed = time.time() - start
+        if self.progress is None:
+            meter.done()
+        self.lit += len(chunks)
+        self.batches += 1
+        self.seconds += elapsed
+        print 'Relit {0} chunks in {1:.2f}s'.format(len(chunks), elapsed)
+        return True
+
+    def flushVolumes(self, volumes):
+        '''Relight the blocks around each queued LightVolume.'''
+        meter = self.progress
+        if meter is None:
+            meter = RelightMeter('Relighting dungeon:')
+        for volume in volumes:
+            start = time.time()
+            count = lighting.relightVolume(self.world, volume, meter)
+            elapsed = time.time() - start
+            if self.progress is None:
+                meter.done()
+            self.blocks += count
+            self.batches += 1
+            self.seconds += elapsed
+            print 'Relit {0} blocks in {1:.2f}s'.format(count, elapsed)
+
+    def report(self):
+        '''Print the relighting totals for the run.'''
+        if self.batches == 0:
+            return
+        if self.blocks > 0:
+            print 'Relighting: {0} blocks around {1} dungeons, ' \
+                  '{2:.2f}s'.format(self.blocks, self.dungeons, self.seconds)
+            return
+        print 'Relighting: {0} chunks in {1} batches, {2:.2f}s'.format(
+            self.lit, self.batches, self.seconds)
+        saved = self.marked - self.lit
+        if saved > 0:
+            print '  {0} chunk relights for {1} dungeons were shared, ' \
+                  'about {2:.2f}s saved'.format(
+                      saved, self.dungeons,
+                      self.seconds * saved / max(self.lit, 1))
@@ -10,6 +10,7 @@ import items
 import loottable
 from utils import *
 import random
+import numpy
 import perlin
 import cave_factory
 
@@ -77,6 +78,17 @@ class Blank(object):
     def render(self):
         pass
 
+    def fill(self, func, material, *args):
+        '''Set every block func(*args) would visit to material. Cubes and
+        four walls are filled by the dungeon in one go.'''
+        if func is iterate_cube and len(args) == 2:
+            self.parent.fillcube(args[0], args[1], material)
+        elif func is iterate_four_walls:
+            self.parent.fillfourwalls(args[0], args[1], args[2], material)
+        else:
+            for x in func(*args):
+                self.parent.setblock(x, material)
+
     def testHall(self, side, size, a1, b1):
         ''' Test to see if a hall will fit. return false if not, else
         return a range of valid offsets'''
@@ -156,17 +168,15 @@ class Basic(Blank):
     def render(self):
         height = self.size.y * self.parent.room_height - 2
         # Air space
-        for x in self.air_func(self.c1.up(1), self.c3.up(height - 1)):
-            self.parent.setblock(x, materials.Air)
+        self.fill(self.air_func, materials.Air, self.c1.up(1),
+                  self.c3.up(height - 1))
         # Floor
-        for x in self.floor_func(self.c1, self.c3):
-            self.parent.setblock(x, materials._floor)
+        self.fill(self.floor_func, materials._floor, self.c1, self.c3)
         # Ceiling
-        for x in self.ceil_func(self.c1.up(height), self.c3.up(height)):
-            self.parent.setblock(x, materials._ceiling)
+        self.fill(self.ceil_func, materials._ceiling, self.c1.up(height),
+                  self.c3.up(height))
         # Walls
-        for x in self.wall_func(self.c1, self.c3, height):
-            self.parent.setblock(x, materials._wall)
+        self.fill(self.wall_func, materials._wall, self.c1, self.c3, height)
         # Subfloor
         sf1 = self.loc.trans(0,
                              self.size.y * self.parent.room_height - 1,
@@ -174,8 +184,7 @@ class Basic(Blank):
         sf2 = sf1.trans(self.size.x * self.parent.room_size - 1,
                         0,
                         self.size.z * self.parent.room_size - 1)
-        for x in iterate_plane(sf1, sf2):
-            self.parent.setblock(x, materials._subfloor)
+        self.parent.fillcube(sf1, sf2, materials._subfloor)
 
 
 class Basic2x2(Basic):
@@ -441,17 +450,14 @@ class GreatHallNS(Basic):
     def render(self):
         height = self.size.y * self.parent.room_height - 2
         # Air space
-        for x in self.air_func(self.c1, self.c3.up(height)):
-            self.parent.setblock(x, materials.Air)
+        self.fill(self.air_func, materials.Air, self.c1, self.c3.up(height))
         # Floor
-        for x in self.floor_func(self.c1, self.c3):
-            self.parent.setblock(x, materials._floor)
+        self.fill(self.floor_func, materials._floor, self.c1, self.c3)
         # Ceiling
-        for x in self.ceil_func(self.c1.up(height), self.c3.up(height)):
-            self.parent.setblock(x, materials._ceiling)
+        self.fill(self.ceil_func, materials._ceiling, self.c1.up(height),
+                  self.c3.up(height))
         # Walls
-        for x in self.wall_func(self.c1, self.c3, height):
-            self.parent.setblock(x, materials._wall)
+        self.fill(self.wall_func, materials._wall, self.c1, self.c3, height)
         # Subfloor
         sf1 = self.loc.trans(0,
                              self.size.y * self.parent.room_height - 1,
@@ -459,8 +465,7 @@ class GreatHallNS(Basic):
         sf2 = sf1.trans(self.size.x * self.parent.room_size - 1,
                         0,
                         self.size.z * self.parent.room_size - 1)
-        for x in iterate_plane(sf1, sf2):
-            self.parent.setblock(x, materials._subfloor)
+        self.parent.fillcube(sf1, sf2, materials._subfloor)
         # balcony
         mat = random.choice(
             ((materials.CobblestoneSlab,
@@ -472,18 +477,14 @@ class GreatHallNS(Basic):
                 (materials.OakWoodSlab,
                  materials.OakWoodPlanks,
                  materials.Fence)))
-        for p in iterate_four_walls(self.c1 + Vec(1, -6, 1),
-                                    self.c3 + Vec(-1, -6, -1), 0):
-            self.parent.setblock(p, mat[0])
-        for p in iterate_four_walls(self.c1 + Vec(2, -6, 2),
-                                    self.c3 + Vec(-2, -6, -2), 0):
-            self.parent.setblock(p, mat[0])
-        for p in iterate_four_walls(self.c1 + Vec(3, -6, 3),
-                                    self.c3 + Vec(-3, -6, -3), 0):
-            self.parent.setblock(p, mat[1])
-        for p in iterate_four_walls(self.c1 + Vec(3, -7, 3),
-                                    self.c3 + Vec(-3, -7, -3), 0):
-            self.parent.setblock(p, mat[2])
+        self.parent.fillfourwalls(self.c1 + Vec(1, -6, 1),
+                                  self.c3 + Vec(-1, -6, -1), 0, mat[0])
+        self.parent.fillfourwalls(self.c1 + Vec(2, -6, 2),
+                                  self.c3 + Vec(-2, -6, -2), 0, mat[0])
+        self.parent.fillfourwalls(self.c1 + Vec(3, -6, 3),
+                                  self.c3 + Vec(-3, -6, -3), 0, mat[1])
+        self.parent.fillfourwalls(self.c1 + Vec(3, -7, 3),
+                                  self.c3 + Vec(-3, -7, -3), 0, mat[2])
         # Columns
         mat = random.choice((
             (materials.StoneBrick, materials.ChiseledStoneBrick),
@@ -521,8 +522,8 @@ class GreatHallNS(Basic):
                     for y in xrange(random.randint(1, 2)):
                         self.parent.setblock(p, mat)
                         p = p.down(1)
-                    for q in iterate_cube(p + Vec(-1, 0, -1), p + Vec(1, 0, 1)):
-                        self.parent.setblock(q, mat)
+                    self.parent.fillcube(p + Vec(-1, 0, -1), p + Vec(1, 0, 1),
+                                         mat)
                     if (random.randint(1, 100) <= 33):
                         self.parent.setblock(p, materials.Torch, 5)
                     self.parent.setblock(p.down(1), materials.Fence)
@@ -719,9 +720,9 @@ class CellBlock(Basic2x2):
                               self.c3 - Vec(10, 1, 10)):
             self.parent.setblock(p, materials._floor)
             self.parent.setblock(p.down(1), materials.Air, lock=True)
-        for p in iterate_four_walls(self.c1 + Vec(10, -1, 10),
-                                    self.c3 - Vec(10, 1, 10), 0):
-            self.parent.setblock(p, materials.StoneSlab)
+        self.parent.fillfourwalls(self.c1 + Vec(10, -1, 10),
+                                  self.c3 - Vec(10, 1, 10), 0,
+                                  materials.StoneSlab)
         # Redstone triggers under the plates
         # Build a lookup table for the combo lock
         # True == on (plate depressed)
@@ -804,9 +805,9 @@ class CellBlock(Basic2x2):
         self.parent.addplaceditem(note, max_lev=max_lev)
 
         # Inner bus
-        for p in iterate_four_walls(self.c1 + Vec(9, 1, 9),
-                                    self.c3 - Vec(9, -1, 9), 0):
-            self.parent.setblock(p, materials.RedstoneWire, 15, lock=True)
+        self.parent.fillfourwalls(self.c1 + Vec(9, 1, 9),
+                                  self.c3 - Vec(9, -1, 9), 0,
+                                  materials.RedstoneWire, 15, lock=True)
         self.parent.setblock(self.c1 + Vec(10, 1, 18),
                              materials.RedstoneRepeaterOff, 1, lock=True)
         self.parent.setblock(self.c3 - Vec(10, -1, 18),
@@ -1482,24 +1483,21 @@ class PitWithArchers(Basic2x2):
         # We start with the basics...
         Basic2x2.render(self)
         # Clear out an air space.
-        for p in iterate_cube(self.c1 + Vec(1, 0, 1),
-                              self.c3 + Vec(-1, pit_depth, -1)):
-            self.parent.setblock(p, materials.Air)
+        self.parent.fillcube(self.c1 + Vec(1, 0, 1),
+                             self.c3 + Vec(-1, pit_depth, -1), materials.Air)
         # Lava!
-        for p in iterate_cube(self.c1.down(pit_depth + 1),
-                              self.c3.down(pit_depth + 1)):
-            self.parent.setblock(p, materials.Lava)
+        self.parent.fillcube(self.c1.down(pit_depth + 1),
+                             self.c3.down(pit_depth + 1), materials.Lava)
         # Build a bridge around the edge
-        for p in iterate_four_walls(self.c1 + Vec(1, 0, 1),
-                                    self.c3 + Vec(-1, 0, -1), 0):
-            self.parent.setblock(p, materials.OakWoodSlab)
+        self.parent.fillfourwalls(self.c1 + Vec(1, 0, 1),
+                                  self.c3 + Vec(-1, 0, -1), 0,
+                                  materials.OakWoodSlab)
         # Make some island areas
         cave = cave_factory.new(22, 22)
         cave.gen_map()
         for p in cave.iterate_map(cave_factory.FLOOR):
             pp = Vec(p[0], 0, p[1]) + self.c1 + Vec(3, 1, 3)
-            for x in iterate_cube(pp, pp.down(pit_depth)):
-                self.parent.setblock(x, materials._floor)
+            self.parent.fillcube(pp, pp.down(pit_depth), materials._floor)
         # Some tasteful recessed lighting
         for p in iterate_cube(self.c1 + Vec(14, -4, 14),
                               self.c3 - Vec(14, 4, 14)):
@@ -1947,8 +1945,12 @@ class Arena(Basic2x2):
             sb(o + p, materials.Lava)
 
         pn = perlin.SimplexNoise(256)
-        for p in iterate_cylinder(Vec(10, sy, 10), Vec(sx - 11, sy, sz - 11)):
-            n = pn.noise3(p.x / 4.0, p.y / 4.0, p.z / 4.0)
+        points = list(iterate_cylinder(Vec(10, sy, 10),
+                                       Vec(sx - 11, sy, sz - 11)))
+        xs = numpy.array([p.x for p in points])
+        zs = numpy.array([p.z for p in points])
+        noise = pn.noise3array(xs / 4.0, sy / 4.0, zs / 4.0)
+        for (p, n) in zip(points, noise):
             if (n > 0):
                 sb(o + p, materials.Sand)
             else:
@@ -2444,8 +2446,7 @@ class SandstoneCavern(Blank):
         sf2 = sf1.trans(self.size.x * self.parent.room_size - 1,
                         0,
                         self.size.z * self.parent.room_size - 1)
-        for x in iterate_plane(sf1, sf2):
-            self.parent.setblock(x, self._subfloor)
+        self.parent.fillcube(sf1, sf2, self._subfloor)
 
 
 class SandstoneCavernLarge(SandstoneCavern):
@@ -2737,8 +2738,7 @@ class Diamond(Blank):
         sf2 = sf1.trans(self.size.x * self.parent.room_size - 1,
                         0,
                         self.size.z * self.parent.room_size - 1)
-        for x in iterate_plane(sf1, sf2):
-            self.parent.setblock(x, materials._subfloor)
+        self.parent.fillcube(sf1, sf2, materials._subfloor)
 
 
 class Alcove(Diamond):
@@ -2933,13 +2933,11 @@ class Pit(Blank):
 
         height = self.parent.room_height - 2
         # Air space
-        for x in self.air_func(self.c1.down(1), self.c3.up(4)):
-            self.parent.setblock(x, materials.Air)
+        self.fill(self.air_func, materials.Air, self.c1.down(1), self.c3.up(4))
         # Lava
         if (self.lava is True):
-            for x in self.floor_func(self.c1.trans(0, 1, 0),
-                                     self.c3.trans(0, 1, 0)):
-                self.parent.setblock(x, materials.Lava)
+            self.fill(self.floor_func, materials.Lava, self.c1.trans(0, 1, 0),
+                      self.c3.trans(0, 1, 0))
 
             # For lava floors, make little ledges at entrances to help ensure
             # these can be traversed without building. 
@@ -3001,9 +2999,12 @@ class Pit(Blank):
                                          materials.meta_mossycobble)
 
             r = random.randint(1, 1000)
-            for x in self.floor_func(self.c1.trans(0, 1, 0),
-                                     self.c3.trans(0, 1, 0)):
-                n = (pn.noise3(x.x / 4.0, r / 4.0, x.z / 4.0) + 1.0) / 2.0
+            points = list(self.floor_func(self.c1.trans(0, 1, 0),
+                                          self.c3.trans(0, 1, 0)))
+            xs = numpy.array([x.x for x in points])
+            zs = numpy.array([x.z for x in points])
+            noise = (pn.noise3array(xs / 4.0, r / 4.0, zs / 4.0) + 1.0) / 2.0
+            for (x, n) in zip(points, noise):
                 if (n > 0.7):
                     self.parent.setblock(x.up(1), materials.CobblestoneSlab)
                     if (self.parent.getblock(x.trans(1, 0, 0)) is
@@ -3026,16 +3027,15 @@ class Pit(Blank):
                     self.parent.setblock(x, materials.Air)
 
         # Ceiling
-        for x in self.ceil_func(self.c1.up(4), self.c3.up(4)):
-            self.parent.setblock(x, materials._ceiling)
+        self.fill(self.ceil_func, materials._ceiling, self.c1.up(4),
+                  self.c3.up(4))
         # Floor with no subfloor if this is a sand pit
         if (self.sandpit):
-            for x in self.floor_func(self.c1.trans(0, 0, 0),
-                                     self.c3.trans(0, 0, 0)):
-                self.parent.setblock(x, materials._floor)
+            self.fill(self.floor_func, materials._floor,
+                      self.c1.trans(0, 0, 0), self.c3.trans(0, 0, 0))
         # Walls
-        for x in self.wall_func(self.c1.down(1), self.c3.down(1), height + 1):
-            self.parent.setblock(x, materials._wall)
+        self.fill(self.wall_func, materials._wall, self.c1.down(1),
+                  self.c3.down(1), height + 1)
 
 
 class CircularPit(Pit):
@@ -3112,8 +3112,7 @@ class PitMid(Blank):
     def render(self):
         height = self.parent.room_height - 2
         # Air space
-        for x in self.air_func(self.c1.down(1), self.c3.up(4)):
-            self.parent.setblock(x, materials.Air)
+        self.fill(self.air_func, materials.Air, self.c1.down(1), self.c3.up(4))
         # Skeleton balconies! (for circular pit rooms only)
         corner = 1 if self.halls[0].size > 0 else 0
         corner += 2 if self.halls[1].size > 0 else 0
@@ -3155,8 +3154,8 @@ class PitMid(Blank):
             for p in iterate_disc(b1, b2):
                 self.parent.setblock(p, materials._floor)
         # Walls
-        for x in self.wall_func(self.c1.down(1), self.c3.down(1), height + 1):
-            self.parent.setblock(x, materials._wall)
+        self.fill(self.wall_func, materials._wall, self.c1.down(1),
+                  self.c3.down(1), height + 1)
         # Skeleton balconies!
         if balcony:
             self.parent.addspawner(b3, 'Skeleton')
@@ -3240,13 +3239,11 @@ class PitBottom(Blank):
         pn = perlin.SimplexNoise(256)
         height = self.parent.room_height - 2
         # Air space
-        for x in self.air_func(self.c1.down(1), self.c3.up(4)):
-            self.parent.setblock(x, materials.Air)
+        self.fill(self.air_func, materials.Air, self.c1.down(1), self.c3.up(4))
         # Lava
         if (self.floor == 'lava'):
-            for x in self.floor_func(self.c1.trans(0, 1, 0),
-                                     self.c3.trans(0, 1, 0)):
-                self.parent.setblock(x, materials.Lava)
+            self.fill(self.floor_func, materials.Lava, self.c1.trans(0, 1, 0),
+                      self.c3.trans(0, 1, 0))
 
             # For lava floors, make little ledges at entrances to help ensure
             # these can be traversed without building. 
@@ -3308,9 +3305,12 @@ class PitBottom(Blank):
                                          materials.meta_mossycobble)
 
             r = random.randint(1, 1000)
-            for x in self.floor_func(self.c1.trans(0, 1, 0),
-                                     self.c3.trans(0, 1, 0)):
-                n = (pn.noise3(x.x / 4.0, r / 4.0, x.z / 4.0) + 1.0) / 2.0
+            points = list(self.floor_func(self.c1.trans(0, 1, 0),
+                                          self.c3.trans(0, 1, 0)))
+            xs = numpy.array([x.x for x in points])
+            zs = numpy.array([x.z for x in points])
+            noise = (pn.noise3array(xs / 4.0, r / 4.0, zs / 4.0) + 1.0) / 2.0
+            for (x, n) in zip(points, noise):
                 if (n > 0.7):
                     self.parent.setblock(x.up(1), materials.CobblestoneSlab)
                     if (self.parent.getblock(x.trans(1, 0, 0)) is
@@ -3341,8 +3341,8 @@ class PitBottom(Blank):
             for x in self.floor_func(self.c1.trans(2, -1, 2),
                                      self.c3.trans(-2, -1, -2)):
                 if ((x.x + x.z) % 2 == 0):
-                    for p in iterate_cube(x, x.up(random.randint(0, 2))):
-                        self.parent.setblock(p, materials.Cactus)
+                    self.parent.fillcube(x, x.up(random.randint(0, 2)),
+                                         materials.Cactus)
         # Floor
         else:
             for x in self.floor_func(self.c1.trans(0, 0, 0),
@@ -3350,8 +3350,8 @@ class PitBottom(Blank):
                 self.parent.setblock(x, materials._floor)
                 self.parent.setblock(x.down(1), materials._subfloor)
         # Walls
-        for x in self.wall_func(self.c1.down(1), self.c3.down(1), height + 1):
-            self.parent.setblock(x, materials._wall)
+        self.fill(self.wall_func, materials._wall, self.c1.down(1),
+                  self.c3.down(1), height + 1)
 
 
 class CircularPitBottom(PitBottom):
@@ -3478,23 +3478,20 @@ class Corridor(Blank):
         c3 = self.loc + Vec(x2, self.parent.room_height - 2, z2)
         c4 = self.loc + Vec(x1, self.parent.room_height - 2, z2)
         # Air space
-        for x in iterate_cube(c1.up(1), c3.up(3)):
-            self.parent.setblock(x, materials.Air)
+        self.parent.fillcube(c1.up(1), c3.up(3), materials.Air)
         # Floor
-        for x in iterate_cube(c1, c3):
-            self.parent.setblock(x, materials._floor)
+        self.parent.fillcube(c1, c3, materials._floor)
         # Ceiling
-        for x in iterate_cube(c1.up(4), c3.up(4)):
-            self.parent.setblock(x, materials._ceiling)
+        self.parent.fillcube(c1.up(4), c3.up(4), materials._ceiling)
         # Walls
-        for x in iterate_four_walls(c1, c3, self.parent.room_height - 2):
-            self.parent.setblock(x, materials._wall)
+        self.parent.fillfourwalls(c1, c3, self.parent.room_height - 2,
+                                  materials._wall)
         # Subfloor
-        for x in iterate_plane(self.loc.down(self.parent.room_height - 1),
-                               self.loc.trans(self.parent.room_size - 1,
-                                              self.parent.room_height - 1,
-                                              self.parent.room_size - 1)):
-            self.parent.setblock(x, materials._subfloor)
+        self.parent.fillcube(self.loc.down(self.parent.room_height - 1),
+                             self.loc.trans(self.parent.room_size - 1,
+                                            self.parent.room_height - 1,
+                                            self.parent.room_size - 1),
+                             materials._subfloor)
         # Cave-in
         if (numhalls == 1):
             ores = (
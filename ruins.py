@@ -4,6 +4,8 @@ import math
 import random
 import sys
 
+import numpy
+
 import cave_factory
 import cfg
 import items
@@ -12,6 +14,7 @@ import perlin
 from pymclevel import nbt
 from utils import (
     findChunkDepths,
+    findSurfaceHeights,
     get_entity_mob_tags,
     get_entity_other_tags,
     get_entity_item_tags,
@@ -192,7 +195,7 @@ class EvilRunestones(Blank):
         # This chunk
         cx = (self.parent.parent.position.x + self.parent.loc.x) >> 4
         cz = (self.parent.parent.position.z + self.parent.loc.z) >> 4
-        chunk = self.parent.parent.world.getChunk(cx, cz)
+        chunk = self.parent.parent.editchunk(cx, cz)
         # dungeon y
         dy = self.parent.parent.position.y
         # Noise function
@@ -208,16 +211,15 @@ class EvilRunestones(Blank):
         for x in xrange(16):
             for z in xrange(16):
                 runes[x, z] = random.randint(height / 2, height)
+        # Noise for the Netherrack and SoulSand
+        (xs, zs) = numpy.mgrid[0:16, 0:16]
+        noise = (pn.noise3array(xs / 4.0, 0, zs / 4.0) + 1.0) / 2.0
         # Iterate over the chunk
         for x in xrange(16):
             for z in xrange(16):
                 # find the height at this block
-                y = chunk.HeightMap[z, x]
-                while (
-                    y > 0 and
-                    chunk.Blocks[x, z, y] not in materials.heightmap_solids
-                ):
-                    y = y - 1
+                y = int(findSurfaceHeights(chunk.Blocks[x, z],
+                                           chunk.HeightMap[z, x]))
                 q = Vec(x, y, z)
                 # create a chest
                 if (x == 2 and z == 2):
@@ -246,7 +248,7 @@ class EvilRunestones(Blank):
                     if chunk.Blocks[r.x, r.z, r.y] != materials.Obsidian.val:
                         sb(r, materials.Air)
                 d = ((Vec2f(q.x, q.z) - Vec2f(7, 7)).mag()) / 16
-                n = (pn.noise3(q.x / 4.0, 0, q.z / 4.0) + 1.0) / 2.0
+                n = noise[x, z]
                 if (n >= d + .20):
                     sb(q, materials.Netherrack)
                     # Netherrack might be on fire!
@@ -399,9 +401,9 @@ class StepPyramid(Blank):
                     self.parent.loc.z + 5)
         # Walls and airspace of the pyramid
         for y in xrange(29):
-            for p in iterate_cube(c1.trans(y + 1, -y, y + 1),
-                                  c3.trans(-y - 1, -y, -y - 1)):
-                self.parent.parent.setblock(p, materials.Air)
+            self.parent.parent.fillcube(c1.trans(y + 1, -y, y + 1),
+                                        c3.trans(-y - 1, -y, -y - 1),
+                                        materials.Air)
             for p in iterate_four_walls(c1.trans(y, -y, y),
                                         c3.trans(-y, -y, -y), 0):
                 self.parent.parent.setblock(p, mat_ext)
@@ -412,14 +414,15 @@ class StepPyramid(Blank):
                 ):
                     self.parent.parent.setblock(p.up(1), mat_ext)
         # Floor. From pyramid base to just above ceiling.
-        for p in iterate_four_walls(c1,
-                                    c3, c1.y):
-            self.parent.parent.setblock(p, mat_ext, hide=True)
+        self.parent.parent.fillfourwalls(c1, c3, c1.y, mat_ext, hide=True)
         # Cover the floor with stuff
         pn = perlin.SimplexNoise(256)
-        for p in iterate_cube(c1, c3):
+        points = list(iterate_cube(c1, c3))
+        noise = (pn.noise3array([p.x / 4.0 for p in points],
+                                [p.y / 4.0 for p in points],
+                                [p.z / 4.0 for p in points]) + 1.0) / 2.0
+        for (p, n) in zip(points, noise):
             d = ((Vec2f(p.x, p.z) - Vec2f(c1.x + 32, c1.z + 32)).mag()) / 64
-            n = (pn.noise3(p.x / 4.0, p.y / 4.0, p.z / 4.0) + 1.0) / 2.0
             if (n >= d + .20):
                 self.parent.parent.setblock(p, mat_floor)
             elif (n >= d + .10):
@@ -447,10 +450,12 @@ class StepPyramid(Blank):
                     self.parent.parent.setblock(cp, materials.Spawner)
                     self.parent.parent.addspawner(cp, tier=0)
             height = 5
-            for j in wfunc(pp1, pp2, 0):
-                depth = (pn.noise3(j.x / 4.0,
-                                   0,
-                                   j.z / 4.0) + 1.0) / 2.0 * height
+            walls = list(wfunc(pp1, pp2, 0))
+            xs = numpy.array([j.x for j in walls])
+            zs = numpy.array([j.z for j in walls])
+            depths = (pn.noise3array(xs / 4.0, 0, zs / 4.0) + 1.0) / 2.0 * \
+                height
+            for (j, depth) in zip(walls, depths):
                 for x in iterate_cube(j, j.up(depth)):
                     if (
                         x in self.parent.parent.blocks and
@@ -461,13 +466,13 @@ class StepPyramid(Blank):
         # Clean up the stairwell shaft. Clear the air, make a half step around
         # it, extend the walls, and redraw the stairs.
         self.parent.parent.entrance.height = abs(-c1.y - 2) + 2
-        for p in iterate_cube(start, start.trans(5, -c1.y - 1, 5)):
-            self.parent.parent.setblock(p, materials.Air)
-        for p in iterate_four_walls(Vec(start.x, -1, start.z),
-                                    Vec(start.x + 5, -1, start.z + 5), -c1.y - 2):
-            self.parent.parent.setblock(p, materials._wall)
-        for p in iterate_four_walls(start, start.trans(5, 0, 5), 0):
-            self.parent.parent.setblock(p, materials.StoneSlab)
+        self.parent.parent.fillcube(start, start.trans(5, -c1.y - 1, 5),
+                                    materials.Air)
+        self.parent.parent.fillfourwalls(Vec(start.x, -1, start.z),
+                                         Vec(start.x + 5, -1, start.z + 5),
+                                         -c1.y - 2, materials._wall)
+        self.parent.parent.fillfourwalls(start, start.trans(5, 0, 5), 0,
+                                         materials.StoneSlab)
         mat = materials.OakWoodSlab
         if random.randint(1, 100) <= 50:
             mat = materials.StoneSlab
@@ -507,9 +512,8 @@ class StepPyramid(Blank):
                                                 mat_block, 0)
             # At entry level, draw a platform floor.
             if (self.ent_n == y):
-                for p in iterate_cube(c1.trans(y + 1, -y, 30),
-                                      c1.trans(y + 8, -y, 33)):
-                    self.parent.parent.setblock(p, mat_block)
+                self.parent.parent.fillcube(c1.trans(y + 1, -y, 30),
+                                            c1.trans(y + 8, -y, 33), mat_block)
             # Above the entry platform, draw some walls
             if (y > self.ent_n and y < self.ent_n + 4):
                 p = c1.trans(y, -y, 30)
@@ -531,9 +535,8 @@ class StepPyramid(Blank):
                 self.parent.parent.setblock(p.trans(1, 1, 0), mat_block)
                 self.parent.parent.setblock(p.trans(0, 1, 0), mat_block)
                 self.parent.parent.setblock(p.trans(0, 2, 0), mat_block)
-                for p in iterate_cube(c1.trans(y - 3, -y, 30),
-                                      c1.trans(y + 1, -y, 33)):
-                    self.parent.parent.setblock(p, mat_block)
+                self.parent.parent.fillcube(c1.trans(y - 3, -y, 30),
+                                            c1.trans(y + 1, -y, 33), mat_block)
 
             # South Side
             self.parent.parent.setblock(c1.trans(63 - y, -y - 1, 29), mat_slab)
@@ -556,9 +559,9 @@ class StepPyramid(Blank):
                     self.parent.parent.setblock(p.trans(-7, 0, 0),
                                                 mat_block, 0)
             if (self.ent_s == y):
-                for p in iterate_cube(c1.trans(63 - y - 1, -y, 30),
-                                      c1.trans(63 - y - 8, -y, 33)):
-                    self.parent.parent.setblock(p, mat_block)
+                self.parent.parent.fillcube(c1.trans(63 - y - 1, -y, 30),
+                                            c1.trans(63 - y - 8, -y, 33),
+                                            mat_block)
             if (y > self.ent_s and y < self.ent_s + 4):
                 p = c1.trans(63 - y, -y, 30)
                 self.parent.parent.setblock(p, mat_block)
@@ -578,9 +581,9 @@ class StepPyramid(Blank):
                 self.parent.parent.setblock(p.trans(-1, 1, 0), mat_block)
                 self.parent.parent.setblock(p.trans(0, 1, 0), mat_block)
                 self.parent.parent.setblock(p.trans(0, 2, 0), mat_block)
-                for p in iterate_cube(c1.trans(63 - y + 3, -y, 30),
-                                      c1.trans(63 - y - 1, -y, 33)):
-                    self.parent.parent.setblock(p, mat_block)
+                self.parent.parent.fillcube(c1.trans(63 - y + 3, -y, 30),
+                                            c1.trans(63 - y - 1, -y, 33),
+                                            mat_block)
 
             # West Side
             self.parent.parent.setblock(c1.trans(29, -y - 1, y), mat_slab)
@@ -602,9 +605,8 @@ class StepPyramid(Blank):
                     self.parent.parent.setblock(p.trans(0, 0, 7),
                                                 mat_block, 0)
             if (self.ent_w == y):
-                for p in iterate_cube(c1.trans(30, -y, y + 1),
-                                      c1.trans(33, -y, y + 8)):
-                    self.parent.parent.setblock(p, mat_block)
+                self.parent.parent.fillcube(c1.trans(30, -y, y + 1),
+                                            c1.trans(33, -y, y + 8), mat_block)
             if (y > self.ent_w and y < self.ent_w + 4):
                 p = c1.trans(30, -y, y)
                 self.parent.parent.setblock(p, mat_block)
@@ -624,9 +626,8 @@ class StepPyramid(Blank):
                 self.parent.parent.setblock(p.trans(0, 1, 1), mat_block)
                 self.parent.parent.setblock(p.trans(0, 1, 0), mat_block)
                 self.parent.parent.setblock(p.trans(0, 2, 0), mat_block)
-                for p in iterate_cube(c1.trans(30, -y, y - 3),
-                                      c1.trans(33, -y, y + 1)):
-                    self.parent.parent.setblock(p, mat_block)
+                self.parent.parent.fillcube(c1.trans(30, -y, y - 3),
+                                            c1.trans(33, -y, y + 1), mat_block)
 
             # East Side
             self.parent.parent.setblock(c1.trans(29, -y - 1, 63 - y), mat_slab)
@@ -649,9 +650,9 @@ class StepPyramid(Blank):
                     self.parent.parent.setblock(p.trans(0, 0, -7),
                                                 mat_block, 0)
             if (self.ent_e == y):
-                for p in iterate_cube(c1.trans(30, -y, 63 - y - 1),
-                                      c1.trans(33, -y, 63 - y - 8)):
-                    self.parent.parent.setblock(p, mat_block)
+                self.parent.parent.fillcube(c1.trans(30, -y, 63 - y - 1),
+                                            c1.trans(33, -y, 63 - y - 8),
+                                            mat_block)
             if (y > self.ent_e and y < self.ent_e + 4):
                 p = c1.trans(30, -y, 63 - y)
                 self.parent.parent.setblock(p, mat_block)
@@ -671,9 +672,9 @@ class StepPyramid(Blank):
                 self.parent.parent.setblock(p.trans(0, 1, -1), mat_block)
                 self.parent.parent.setblock(p.trans(0, 1, 0), mat_block)
                 self.parent.parent.setblock(p.trans(0, 2, 0), mat_block)
-                for p in iterate_cube(c1.trans(30, -y, 63 - y + 3),
-                                      c1.trans(33, -y, 63 - y - 1)):
-                    self.parent.parent.setblock(p, mat_block)
+                self.parent.parent.fillcube(c1.trans(30, -y, 63 - y + 3),
+                                            c1.trans(33, -y, 63 - y - 1),
+                                            mat_block)
 
         # Topper
         # Deserts have a fancy glass tipped pyramid
@@ -687,22 +688,19 @@ class StepPyramid(Blank):
             else:
                 topperglass = materials.Glass
             for y in xrange(29, 33):
-                for p in iterate_cube(c1.trans(y, -y, y),
-                                      c3.trans(-y, -y, -y)):
-                    self.parent.parent.setblock(p, materials.Air)
-                for p in iterate_four_walls(c1.trans(y - 1, -y, y - 1),
-                                            c3.trans(-y + 1, -y, -y + 1), 0):
-                    self.parent.parent.setblock(p, topperglass)
-            for p in iterate_cube(c1.trans(29, -28, 29),
-                                  c3.trans(-29, -28, -29)):
-                self.parent.parent.setblock(p, mat_block)
-            for p in iterate_cube(c1.trans(32, -31, 32),
-                                  c3.trans(-32, -28, -32)):
-                self.parent.parent.setblock(p, materials.Air)
+                self.parent.parent.fillcube(c1.trans(y, -y, y),
+                                            c3.trans(-y, -y, -y),
+                                            materials.Air)
+                self.parent.parent.fillfourwalls(c1.trans(y - 1, -y, y - 1),
+                                                 c3.trans(-y + 1, -y, -y + 1),
+                                                 0, topperglass)
+            self.parent.parent.fillcube(c1.trans(29, -28, 29),
+                                        c3.trans(-29, -28, -29), mat_block)
+            self.parent.parent.fillcube(c1.trans(32, -31, 32),
+                                        c3.trans(-32, -28, -32), materials.Air)
             # holes in the glass
-            for p in iterate_cube(c1.trans(32, -30, 28),
-                                  c3.trans(-32, -29, -28)):
-                self.parent.parent.setblock(p, materials.Air)
+            self.parent.parent.fillcube(c1.trans(32, -30, 28),
+                                        c3.trans(-32, -29, -28), materials.Air)
             for p in iterate_cube(c1.trans(28, -30, 32),
                                   c3.trans(-28, -29, -32)):
                 self.parent.parent.setblock(p, materials.Air)
@@ -754,15 +752,13 @@ class StepPyramid(Blank):
             self.parent.parent.setblock(c3.trans(-29, -31, -29),
                                         materials.StoneBrickStairs, 1)
             # Roof
-            for p in iterate_cube(c1.trans(29, -32, 29),
-                                  c3.trans(-29, -32, -29)):
-                self.parent.parent.setblock(p, materials.ChiseledStoneBrick)
-            for p in iterate_cube(c1.trans(29, -28, 29),
-                                  c3.trans(-29, -28, -29)):
-                self.parent.parent.setblock(p, mat_floor)
-            for p in iterate_cube(c1.trans(32, -32, 32),
-                                  c3.trans(-32, -28, -32)):
-                self.parent.parent.setblock(p, materials.Air)
+            self.parent.parent.fillcube(c1.trans(29, -32, 29),
+                                        c3.trans(-29, -32, -29),
+                                        materials.ChiseledStoneBrick)
+            self.parent.parent.fillcube(c1.trans(29, -28, 29),
+                                        c3.trans(-29, -28, -29), mat_floor)
+            self.parent.parent.fillcube(c1.trans(32, -32, 32),
+                                        c3.trans(-32, -28, -32), materials.Air)
         # Other toppers
         else:
             # Supports
@@ -775,15 +771,12 @@ class StepPyramid(Blank):
             self.parent.parent.setblock(c3.trans(-29, -29, -29), mat_block)
             self.parent.parent.setblock(c3.trans(-29, -30, -29), mat_block)
             # Roof
-            for p in iterate_cube(c1.trans(28, -31, 28),
-                                  c3.trans(-28, -31, -28)):
-                self.parent.parent.setblock(p, mat_slab)
-            for p in iterate_cube(c1.trans(29, -28, 29),
-                                  c3.trans(-29, -28, -29)):
-                self.parent.parent.setblock(p, mat_block)
-            for p in iterate_cube(c1.trans(32, -31, 32),
-                                  c3.trans(-32, -28, -32)):
-                self.parent.parent.setblock(p, materials.Air)
+            self.parent.parent.fillcube(c1.trans(28, -31, 28),
+                                        c3.trans(-28, -31, -28), mat_slab)
+            self.parent.parent.fillcube(c1.trans(29, -28, 29),
+                                        c3.trans(-29, -28, -29), mat_block)
+            self.parent.parent.fillcube(c1.trans(32, -31, 32),
+                                        c3.trans(-32, -28, -32), materials.Air)
         # Supply chest
         p = c1.trans(30, -29, 30)
         self.parent.parent.setblock(p, materials.Chest)
@@ -916,43 +909,43 @@ class RoundTowerEntrance(Blank):
                                             materials.Air)
         # Chest level openings
         # W/E
-        for p in iterate_cube(Vec(b1.x + 3, clev, b1.z),
-                              Vec(b1.x + 4, clev - 2, b1.z + 7)):
-            self.parent.parent.setblock(p, materials.Air)
+        self.parent.parent.fillcube(Vec(b1.x + 3, clev, b1.z),
+                                    Vec(b1.x + 4, clev - 2, b1.z + 7),
+                                    materials.Air)
         # N/S
-        for p in iterate_cube(Vec(b1.x, clev, b1.z + 3),
-                              Vec(b1.x + 7, clev - 2, b1.z + 4)):
-            self.parent.parent.setblock(p, materials.Air)
+        self.parent.parent.fillcube(Vec(b1.x, clev, b1.z + 3),
+                                    Vec(b1.x + 7, clev - 2, b1.z + 4),
+                                    materials.Air)
         # Ground level openings
         # W side
-        for p in iterate_cube(wstart.trans(2, 0, 0), wstart.trans(3, -2, -4)):
-            self.parent.parent.setblock(p, materials.Air)
+        self.parent.parent.fillcube(wstart.trans(2, 0, 0),
+                                    wstart.trans(3, -2, -4), materials.Air)
         # E side
-        for p in iterate_cube(wstart.trans(2, 0, 5), wstart.trans(3, -2, 9)):
-            self.parent.parent.setblock(p, materials.Air)
+        self.parent.parent.fillcube(wstart.trans(2, 0, 5),
+                                    wstart.trans(3, -2, 9), materials.Air)
         # N side
-        for p in iterate_cube(wstart.trans(0, 0, 2), wstart.trans(-4, -2, 3)):
-            self.parent.parent.setblock(p, materials.Air)
+        self.parent.parent.fillcube(wstart.trans(0, 0, 2),
+                                    wstart.trans(-4, -2, 3), materials.Air)
         # S side
-        for p in iterate_cube(wstart.trans(5, 0, 2), wstart.trans(9, -2, 3)):
-            self.parent.parent.setblock(p, materials.Air)
+        self.parent.parent.fillcube(wstart.trans(5, 0, 2),
+                                    wstart.trans(9, -2, 3), materials.Air)
         # Clear air space inside the stairwell shaft
-        for p in iterate_cube(Vec(wstart.x + 1, elev + 1, wstart.z + 1),
-                              Vec(wstart.x + 4, blev - 2, wstart.z + 4)):
-            self.parent.parent.setblock(p, materials.Air)
+        self.parent.parent.fillcube(Vec(wstart.x + 1, elev + 1, wstart.z + 1),
+                                    Vec(wstart.x + 4, blev - 2, wstart.z + 4),
+                                    materials.Air)
         # Internal columns
-        for p in iterate_cube(Vec(b1.x + 1, elev, b1.z + 1),
-                              Vec(b1.x + 1, clev, b1.z + 1)):
-            self.parent.parent.setblock(p, materials.StoneDoubleSlab)
-        for p in iterate_cube(Vec(b2.x - 1, elev, b2.z + 1),
-                              Vec(b2.x - 1, clev, b2.z + 1)):
-            self.parent.parent.setblock(p, materials.StoneDoubleSlab)
-        for p in iterate_cube(Vec(b3.x - 1, elev, b3.z - 1),
-                              Vec(b3.x - 1, clev, b3.z - 1)):
-            self.parent.parent.setblock(p, materials.StoneDoubleSlab)
-        for p in iterate_cube(Vec(b4.x + 1, elev, b4.z - 1),
-                              Vec(b4.x + 1, clev, b4.z - 1)):
-            self.parent.parent.setblock(p, materials.StoneDoubleSlab)
+        self.parent.parent.fillcube(Vec(b1.x + 1, elev, b1.z + 1),
+                                    Vec(b1.x + 1, clev, b1.z + 1),
+                                    materials.StoneDoubleSlab)
+        self.parent.parent.fillcube(Vec(b2.x - 1, elev, b2.z + 1),
+                                    Vec(b2.x - 1, clev, b2.z + 1),
+                                    materials.StoneDoubleSlab)
+        self.parent.parent.fillcube(Vec(b3.x - 1, elev, b3.z - 1),
+                                    Vec(b3.x - 1, clev, b3.z - 1),
+                                    materials.StoneDoubleSlab)
+        self.parent.parent.fillcube(Vec(b4.x + 1, elev, b4.z - 1),
+                                    Vec(b4.x + 1, clev, b4.z - 1),
+                                    materials.StoneDoubleSlab)
         # (re)draw the staircase
         self.parent.parent.entrance.height = abs(room_floor - elev - 1)
         mat = materials.OakWoodSlab
@@ -1096,12 +1089,10 @@ class SquareTowerEntrance(Blank):
         c4 = c1.trans(0, 0, 9)
         # Chest level battlements
         #    This is the solid outer wall right under the battlements
-        for p in iterate_cube(c1, c3):
-            self.parent.parent.setblock(p, self._mat)
+        self.parent.parent.fillcube(c1, c3, self._mat)
         #    The "floor" This extends to the ground to make the base thicker.
-        for p in iterate_cube(c1.trans(1, 1, 1),
-                              Vec(c3.x - 1, elev, c3.z - 1)):
-            self.parent.parent.setblock(p, self._mat)
+        self.parent.parent.fillcube(c1.trans(1, 1, 1),
+                                    Vec(c3.x - 1, elev, c3.z - 1), self._mat)
         #    Place the battlement blocks on the wall
         for p in iterate_cube(Vec(0, -1, 0), Vec(4, -1, 4)):
             if (((p.x + p.z) & 1) == 0):
@@ -1113,13 +1104,11 @@ class SquareTowerEntrance(Blank):
                 self.parent.parent.setblock(c4.trans(p.x, p.y, -p.z),
                                             self._mat)
         #     Carve out a walkway
-        for p in iterate_cube(c1.trans(1, 0, 1),
-                              c3.trans(-1, -10, -1)):
-            self.parent.parent.setblock(p, materials.Air)
+        self.parent.parent.fillcube(c1.trans(1, 0, 1), c3.trans(-1, -10, -1),
+                                    materials.Air)
         # Battlements (top of the tower)
         #    This is the solid outer wall right under the battlements
-        for p in iterate_cube(b1, b3):
-            self.parent.parent.setblock(p, self._mat)
+        self.parent.parent.fillcube(b1, b3, self._mat)
         #    Place the battlement blocks on the wall
         for p in iterate_cube(Vec(0, -1, 0), Vec(2, -1, 2)):
             if (((p.x + p.z) & 1) == 0):
@@ -1131,41 +1120,39 @@ class SquareTowerEntrance(Blank):
                 self.parent.parent.setblock(b4.trans(p.x, p.y, -p.z),
                                             self._mat)
         # Clear air space inside the tower
-        for p in iterate_cube(Vec(wstart.x, elev, wstart.z),
-                              Vec(wstart.x + 5, blev - 2, wstart.z + 5)):
-            self.parent.parent.setblock(p, materials.Air)
+        self.parent.parent.fillcube(Vec(wstart.x, elev, wstart.z),
+                                    Vec(wstart.x + 5, blev - 2, wstart.z + 5),
+                                    materials.Air)
         # Walls
-        for p in iterate_four_walls(Vec(wstart.x, elev, wstart.z),
-                                    Vec(wstart.x + 5, elev, wstart.z + 5),
-                                    elev - blev - 1):
-            self.parent.parent.setblock(p, self._mat)
+        self.parent.parent.fillfourwalls(Vec(wstart.x, elev, wstart.z),
+                                         Vec(wstart.x + 5, elev, wstart.z + 5),
+                                         elev - blev - 1, self._mat)
         # Chest level openings
         # W side
-        for p in iterate_cube(c1.trans(3, 0, 2), c1.trans(6, -3, 2)):
-            self.parent.parent.setblock(p, materials.Air)
+        self.parent.parent.fillcube(c1.trans(3, 0, 2), c1.trans(6, -3, 2),
+                                    materials.Air)
         # E side
-        for p in iterate_cube(c1.trans(3, 0, 7), c1.trans(6, -3, 7)):
-            self.parent.parent.setblock(p, materials.Air)
+        self.parent.parent.fillcube(c1.trans(3, 0, 7), c1.trans(6, -3, 7),
+                                    materials.Air)
         # N side
-        for p in iterate_cube(c1.trans(2, 0, 3), c1.trans(2, -3, 6)):
-            self.parent.parent.setblock(p, materials.Air)
+        self.parent.parent.fillcube(c1.trans(2, 0, 3), c1.trans(2, -3, 6),
+                                    materials.Air)
         # S side
-        for p in iterate_cube(c1.trans(7, 0, 3), c1.trans(7, -3, 6)):
-            self.parent.parent.setblock(p, materials.Air)
+        self.parent.parent.fillcube(c1.trans(7, 0, 3), c1.trans(7, -3, 6),
+                                    materials.Air)
         # Ground level openings
         # W side
-        for p in iterate_cube(wstart.trans(2, 0, 0),
-                              wstart.trans(3, -3, -1)):
-            self.parent.parent.setblock(p, materials.Air)
+        self.parent.parent.fillcube(wstart.trans(2, 0, 0),
+                                    wstart.trans(3, -3, -1), materials.Air)
         # E side
-        for p in iterate_cube(wstart.trans(2, 0, 5), wstart.trans(3, -3, 6)):
-            self.parent.parent.setblock(p, materials.Air)
+        self.parent.parent.fillcube(wstart.trans(2, 0, 5),
+                                    wstart.trans(3, -3, 6), materials.Air)
         # N side
-        for p in iterate_cube(wstart.trans(0, 0, 2), wstart.trans(-1, -3, 3)):
-            self.parent.parent.setblock(p, materials.Air)
+        self.parent.parent.fillcube(wstart.trans(0, 0, 2),
+                                    wstart.trans(-1, -3, 3), materials.Air)
         # S side
-        for p in iterate_cube(wstart.trans(5, 0, 2), wstart.trans(6, -3, 3)):
-            self.parent.parent.setblock(p, materials.Air)
+        self.parent.parent.fillcube(wstart.trans(5, 0, 2),
+                                    wstart.trans(6, -3, 3), materials.Air)
         # (re)draw the staircase
         self.parent.parent.entrance.height = abs(room_floor - elev - 1)
         mat = materials.OakWoodSlab
@@ -1431,18 +1418,15 @@ class RuinedFane(Blank):
                             4 - self.parent.parent.room_size * movedZ)
 
         # clear the inside
-        for p in iterate_cube(start.trans(1, 0, 1),
-                              start.trans(22, -9, 38)):
-            self.parent.parent.setblock(p, materials.Air)
-        for p in iterate_cube(start.trans(8, -9, 1),
-                              start.trans(15, -15, 38)):
-            self.parent.parent.setblock(p, materials.Air)
-        for p in iterate_cube(start.trans(0, 1, 0),
-                              start.trans(23, self.parent.loc.y - start.y, 39)):
-            self.parent.parent.setblock(p, soil)
-        for p in iterate_cube(start.trans(0, 0, 0),
-                              start.trans(23, 0, 39)):
-            self.parent.parent.setblock(p, topsoil)
+        self.parent.parent.fillcube(start.trans(1, 0, 1),
+                                    start.trans(22, -9, 38), materials.Air)
+        self.parent.parent.fillcube(start.trans(8, -9, 1),
+                                    start.trans(15, -15, 38), materials.Air)
+        self.parent.parent.fillcube(start.trans(0, 1, 0),
+                                    start.trans(23, self.parent.loc.y - start.y, 39),
+                                    soil)
+        self.parent.parent.fillcube(start.trans(0, 0, 0),
+                                    start.trans(23, 0, 39), topsoil)
 
         # make four corner towers
         locs = [
@@ -1454,11 +1438,9 @@ class RuinedFane(Blank):
 
         for loc in locs:
             # level one
-            for p in iterate_cube(loc, loc.trans(7, 0, 7)):
-                self.parent.parent.setblock(p, floor)
+            self.parent.parent.fillcube(loc, loc.trans(7, 0, 7), floor)
 
-            for p in iterate_four_walls(loc, loc.trans(7, 0, 7), 10):
-                self.parent.parent.setblock(p, wall)
+            self.parent.parent.fillfourwalls(loc, loc.trans(7, 0, 7), 10, wall)
 
             for p in iterate_cube(loc.down(3), loc.up(10)):
                 self.parent.parent.setblock(p.trans(1, 0, -1), buttress)
@@ -1599,8 +1581,8 @@ class RuinedFane(Blank):
                 self.parent.parent.setblock(p.trans(5, 0, 2), wall)
                 self.parent.parent.setblock(p.trans(5, 0, 5), wall)
 
-            for p in iterate_cube(loc.trans(2, -31, 2), loc.trans(5, -31, 5)):
-                self.parent.parent.setblock(p, wall)
+            self.parent.parent.fillcube(loc.trans(2, -31, 2),
+                                        loc.trans(5, -31, 5), wall)
 
             # Randomly ruin
             if random.random() < .50:
@@ -1612,26 +1594,20 @@ class RuinedFane(Blank):
                            aggressive=True)
 
         # curtains
-        for p in iterate_cube(start.trans(1, 0, 8),
-                              start.trans(1, -9, 31)):
-            self.parent.parent.setblock(p, wall)
-        for p in iterate_cube(start.trans(22, 0, 8),
-                              start.trans(22, -9, 31)):
-            self.parent.parent.setblock(p, wall)
-        for p in iterate_cube(start.trans(8, 0, 1),
-                              start.trans(15, -15, 1)):
-            self.parent.parent.setblock(p, wall)
-        for p in iterate_cube(start.trans(8, 0, 38),
-                              start.trans(15, -15, 38)):
-            self.parent.parent.setblock(p, wall)
+        self.parent.parent.fillcube(start.trans(1, 0, 8),
+                                    start.trans(1, -9, 31), wall)
+        self.parent.parent.fillcube(start.trans(22, 0, 8),
+                                    start.trans(22, -9, 31), wall)
+        self.parent.parent.fillcube(start.trans(8, 0, 1),
+                                    start.trans(15, -15, 1), wall)
+        self.parent.parent.fillcube(start.trans(8, 0, 38),
+                                    start.trans(15, -15, 38), wall)
 
         # wing ceilings
-        for p in iterate_cube(start.trans(1, -10, 8),
-                              start.trans(7, -10, 31)):
-            self.parent.parent.setblock(p, wall)
-        for p in iterate_cube(start.trans(15, -10, 8),
-                              start.trans(22, -10, 31)):
-            self.parent.parent.setblock(p, wall)
+        self.parent.parent.fillcube(start.trans(1, -10, 8),
+                                    start.trans(7, -10, 31), wall)
+        self.parent.parent.fillcube(start.trans(15, -10, 8),
+                                    start.trans(22, -10, 31), wall)
 
         # tall ceiling
         for p in iterate_cube(start.trans(8, -15, 1),
@@ -1645,9 +1621,8 @@ class RuinedFane(Blank):
             self.parent.parent.setblock(p.trans(7, 0, 0), wall)
 
         # floors
-        for p in iterate_cube(start.trans(8, 0, 1),
-                              start.trans(15, 0, 38)):
-            self.parent.parent.setblock(p, floor)
+        self.parent.parent.fillcube(start.trans(8, 0, 1),
+                                    start.trans(15, 0, 38), floor)
         for p in iterate_cube(start.trans(1, 0, 8),
                               start.trans(7, 0, 31)):
             self.parent.parent.setblock(p, floor)
@@ -1664,12 +1639,10 @@ class RuinedFane(Blank):
                 self.parent.parent.setblock(p.up(1), stair, S)
 
         # raised altar
-        for p in iterate_cube(start.trans(8, -1, 2),
-                              start.trans(15, -1, 7)):
-            self.parent.parent.setblock(p, wall)
-        for p in iterate_cube(start.trans(7, -1, 8),
-                              start.trans(16, -1, 8)):
-            self.parent.parent.setblock(p, stair, N)
+        self.parent.parent.fillcube(start.trans(8, -1, 2),
+                                    start.trans(15, -1, 7), wall)
+        self.parent.parent.fillcube(start.trans(7, -1, 8),
+                                    start.trans(16, -1, 8), stair, N)
 
         mats = [
             materials.Air,       # 0
@@ -1763,18 +1736,16 @@ class RuinedFane(Blank):
 
         # extend the stair up
         estart = self.parent.loc.up(self.parent.parent.room_height - 3)
-        for p in iterate_cube(estart.trans(6, 0, 6), estart.trans(9, -6, 9)):
-            self.parent.parent.setblock(p, materials.Air)
+        self.parent.parent.fillcube(estart.trans(6, 0, 6),
+                                    estart.trans(9, -6, 9), materials.Air)
         mat = materials.StoneSlab
         for p in iterate_spiral(Vec(estart.x + 6, estart.y, estart.z + 6),
                                 Vec(estart.x + 6 + 4, estart.y, estart.z + 6 + 4),
                                 10):
             self.parent.parent.setblock(
                 Vec(p.x, p.y / 2, p.z), mat, mat.data + ((p.y & 1) ^ 1) * 8)
-        for p in iterate_four_walls(estart.trans(5, 0, 5),
-                                    estart.trans(10, 0, 10),
-                                    3):
-            self.parent.parent.setblock(p, wall)
+        self.parent.parent.fillfourwalls(estart.trans(5, 0, 5),
+                                         estart.trans(10, 0, 10), 3, wall)
 
 
 class Barrow(Blank):
@@ -2607,8 +2578,7 @@ class HouseFrame(Blank):
         start = self.loc.trans(3 + random.randint(0, 2),
                                -1,
                                3 + random.randint(0, 2))
-        for p in iterate_cube(start, start.trans(7, 0, 7)):
-            self.parent.parent.setblock(p, mat)
+        self.parent.parent.fillcube(start, start.trans(7, 0, 7), mat)
 
         # now draw the A frame
         start = start.trans(0, -1, 0)
@@ -2616,19 +2586,16 @@ class HouseFrame(Blank):
         # will the head be in the south (7) or north (0)
         head = random.randint(0, 1) * 7
 
-        for p in iterate_cube(start.trans(0, 0, head),
-                              start.trans(6, -3, head)):
-            self.parent.parent.setblock(p, mat)
+        self.parent.parent.fillcube(start.trans(0, 0, head),
+                                    start.trans(6, -3, head), mat)
 
-        for p in iterate_cube(start.trans(1, -4, head),
-                              start.trans(5, -4, head)):
-            self.parent.parent.setblock(p, mat)
+        self.parent.parent.fillcube(start.trans(1, -4, head),
+                                    start.trans(5, -4, head), mat)
         self.parent.parent.setblock(start.trans(0, -4, head), stair, E)
         self.parent.parent.setblock(start.trans(6, -4, head), stair, W)
 
-        for p in iterate_cube(start.trans(2, -5, head),
-                              start.trans(4, -5, head)):
-            self.parent.parent.setblock(p, mat)
+        self.parent.parent.fillcube(start.trans(2, -5, head),
+                                    start.trans(4, -5, head), mat)
         self.parent.parent.setblock(start.trans(1, -5, head), stair, E)
         self.parent.parent.setblock(start.trans(5, -5, head), stair, W)
 
@@ -2662,9 +2629,8 @@ class HouseFrame(Blank):
                 self.parent.parent.setblock(p.up(2), mat)
 
         # and the corner post opposite
-        for p in iterate_cube(start.trans(7, 0, 7 - head),
-                              start.trans(7, -3, 7 - head)):
-            self.parent.parent.setblock(p, mat)
+        self.parent.parent.fillcube(start.trans(7, 0, 7 - head),
+                                    start.trans(7, -3, 7 - head), mat)
 
         # and maybe some ancient pottery
         if (random.randint(1, 100) < 10):
@@ -2872,6 +2838,9 @@ class MazeEntrance(Blank):
         open_x_end = sc + 11
         open_z_end = sc + 11
 
+        (xs, zs) = numpy.mgrid[0:len(blocks), 0:len(blocks[0])]
+        noise = pn.noise2array(xs / 32.0, zs / 32.0)
+
         for i in xrange(len(blocks)):
             for j in xrange(len(blocks[0])):
                 if (
@@ -2884,7 +2853,7 @@ class MazeEntrance(Blank):
                     # than the edges
                     height = (
                         (
-                            pn.noise2(i / 32.0, j / 32.0) + 1.0
+                            noise[i, j] + 1.0
                         ) / 2.0 * self.parent.parent.room_height
                     ) * (
                         (16 * self._size) / (abs(j - (sc + 8)) + abs(i - (sc + 8)))
@@ -2951,9 +2920,11 @@ def ruinBlocks(p1, p2, height, dungeon, override=False, aggressive=False):
         cfg.ruin_ruins is False
     ):
         return
+    (xs, zs) = numpy.mgrid[p1.x:p2.x + 1, p1.z:p2.z + 1]
+    depths = (pn.noise3array(xs / 4.0, 0, zs / 4.0) + 1.0) / 2.0 * height
     for x in xrange(p1.x, p2.x + 1):
         for z in xrange(p1.z, p2.z + 1):
-            depth = (pn.noise3(x / 4.0, 0, z / 4.0) + 1.0) / 2.0 * height
+            depth = depths[x - p1.x, z - p1.z]
             for p in iterate_cube(Vec(x, p1.y - depth, z),
                                   Vec(x, p1.y - height, z)):
                 dungeon.delblock(p)
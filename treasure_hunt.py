@@ -4,7 +4,6 @@ import operator
 from pprint import pprint
 import random
 from random import *
-import logging
 
 import cfg
 import loottable
@@ -14,10 +13,13 @@ import pmeter
 import namegenerator
 import inventory
 from utils import *
+from blockbuffer import BlockBuffer
 from disjoint_set import DisjointSet
 from pymclevel import nbt
 
-from dungeon import Dungeon, RelightHandler, Block
+from dungeon import Dungeon
+from relight import Relighter
+from commitlog import Committer
 
 # The Treasure Hunt class is a subclass of Dungeon and uses the same 
 # utility functions.  However, unlike Dungeon, self.position only holds the
@@ -36,16 +38,23 @@ class TreasureHunt (Dungeon):
                  chunk_cache,
                  thunt_cache,
                  good_chunks,
-                 mapstore):
+                 mapstore,
+                 relighter=None,
+                 committer=None):
 
         self.world = world
         self.chunk_cache = chunk_cache
         self.thunt_cache = thunt_cache
         self.good_chunks = good_chunks
         self.mapstore = mapstore
+        if relighter is None:
+            relighter = Relighter(world)
+        self.relighter = relighter
+        self.committer = committer
+        self.write_seed = None
         self.inventory = inventory.new(mapstore)
         self.pm = pmeter.ProgressMeter()
-        self.blocks = {}
+        self.blocks = BlockBuffer()
         self.landmarks = []
         self.tile_ents = {}
         self.ents = []
@@ -153,33 +162,28 @@ class TreasureHunt (Dungeon):
             # all previous landmarks
             self.thunt_cache[key] = encodeTHuntInfo(self, version)
 
-            # copy results to the world
+            # copy results to the world. The journal has to know about it
+            # first, in case we stop before it is saved.
+            info = decodeTHuntInfo(self.thunt_cache[key])
+            if (self.args.write is True):
+                if self.committer is None:
+                    self.committer = Committer(
+                        self.world,
+                        cache_path,
+                        [(saveTHuntCache, self.thunt_cache),
+                         (saveChunkCache, self.chunk_cache)])
+                self.committer.applying(key, 'thunt', info)
             self.applychanges()
 
-            # Relight these chunks.
+            # Relight these chunks, or queue them to be relit along with
+            # the chunks of the next few treasure hunts.
             if (self.args.write is True and self.args.skiprelight is False):
-                # Super ugly, but does progress bars for lighting.
-                for handler in logging.root.handlers[:]:
-                    logging.root.removeHandler(handler)
-                h = RelightHandler()
-                logging.basicConfig(stream=h, level=logging.INFO)
-                self.world.generateLights()
-                h.done()
-                logging.getLogger().level = logging.CRITICAL
-                for handler in logging.root.handlers[:]:
-                    logging.root.removeHandler(handler)
+                self.relighter.add(self.changed_chunks, self.light_volume)
 
             # Saving here allows us to pick up where we left off if we stop.
+            # With a larger commit_every, several are saved together.
             if (self.args.write is True):
-                print "Saving..."
-                self.world.saveInPlace()
-                saveTHuntCache(cache_path, self.thunt_cache)
-                saveChunkCache(cache_path, self.chunk_cache)
-                # make sure commandBlockOutput is false.
-                root_tag = nbt.load(self.world.filename)
-                root_tag['Data']['GameRules'][
-                    'commandBlockOutput'].value = 'false'
-                root_tag.save(self.world.filename)
+                self.committer.add(key, 'thunt', info)
             else:
                 print "Skipping save! (--write disabled)"
 
@@ -266,23 +270,17 @@ class TreasureHunt (Dungeon):
             if d_chunks.issubset(all_chunks):
                 # is this chunk valid?  Check for too steep, water, lava
                 chunk = world.getChunk(p[0],p[1])
-                miny = 256
-                maxy = -256
-                hasliquid = False
-                for x in xrange(16):
-                    for z in xrange(16):
-                        y = chunk.HeightMap[x,z]
-                        #print '  check - x,z = y %d,%d = %d'%(x,z,y)
-                        while y>-64 and chunk.Blocks[x,z,y] not in heightmap_solids:
-                            mat = chunk.Blocks[x,z,y]
-                            if mat in (materials.Lava.val,
-                                       materials.Water.val,
-                                       materials.StillWater.val):
-                                hasliquid = True
-                            y = y - 1
-                        #print '  check - x,z = y %d,%d = %d'%(x,z,y)
-                        miny = min(miny,y)
-                        maxy = max(maxy,y)
+                heights = findSurfaceHeights(chunk.Blocks, chunk.HeightMap)
+                miny = int(heights.min())
+                maxy = int(heights.max())
+                # Look for liquids between the heightmap and the surface
+                ys = numpy.arange(chunk.Blocks.shape[2])
+                above = ((ys > heights[..., numpy.newaxis]) &
+                         (ys <= chunk.HeightMap[..., numpy.newaxis]))
+                liquids = ((chunk.Blocks == materials.Lava.val) |
+                           (chunk.Blocks == materials.Water.val) |
+                           (chunk.Blocks == materials.StillWater.val))
+                hasliquid = bool((liquids & above).any())
 
                 # avoid anywhere not flat enough
                 if (maxy - miny) > 4:
@@ -336,10 +334,8 @@ class TreasureHunt (Dungeon):
                 except:
                     self.steps -= count
                     break
-                y = chunk.HeightMap[8,8] - 1
-                while (y > -64 and
-                       chunk.Blocks[8, 8, y] not in heightmap_solids):
-                   y = y - 1
+                y = int(findSurfaceHeights(chunk.Blocks[8, 8],
+                                           chunk.HeightMap[8, 8] - 1))
                 pos.y = min(y, self.world.Height)
 				# print 'placed [%d,%d,%d]' % (pos.x, pos.y, pos.z)
                 lm = landmarks.pickLandmark( self, pos  ) 
@@ -9,9 +9,12 @@ import sys
 import time
 import uuid
 import yaml
+import zlib
 
 import numpy
 
+from chunkcache import ChunkCache, convertPickle
+from dungeonindex import DungeonIndex
 from materials import heightmap_solids
 from pymclevel import mclevel, nbt
 
@@ -89,7 +92,14 @@ class Vec(object):
         return self.x != b.x or self.y != b.y or self.z != b.z
 
     def __hash__(self):
-        return self.x + (self.y << 4) + (self.z << 8)
+        # Pack the coordinates into one integer, so no two blocks within a
+        # million blocks of the origin and 4096 high share a hash. The packed
+        # key is then folded onto itself, which can't add collisions, so the
+        # low bits that pick a dict slot depend on all three coordinates.
+        k = ((self.x & 0x1fffff) |
+             ((self.z & 0x1fffff) << 21) |
+             ((self.y & 0xfff) << 42))
+        return k ^ (k >> 21) ^ (k >> 42)
 
     def e(self, x):
         return Vec(self.x + x, self.y, self.z)
@@ -158,6 +168,18 @@ UP = Vec(0, 1, 0)
 DOWN = Vec(0, -1, 0)
 
 
+class ChunkCopy(object):
+
+    '''A copy of the parts of a chunk that are read while a dungeon is
+    built, which ruins can also draw straight into.'''
+
+    def __init__(self, chunk):
+        self.Blocks = chunk.Blocks.copy()
+        self.Data = chunk.Data.copy()
+        self.HeightMap = chunk.HeightMap.copy()
+        self.Biomes = chunk.Biomes.copy()
+
+
 class Vec2f(object):
 
     def __init__(self, x, z):
@@ -597,20 +619,37 @@ def spin(c=''):
     sys.stdout.flush()
 
 
+# Lookup table of heightmap solids, indexed by block id.
+heightmap_solids_lut = numpy.zeros(4096, dtype=bool)
+heightmap_solids_lut[list(heightmap_solids)] = True
+
+
+def findSurfaceHeights(blocks, start, floor=0):
+    '''Find the surface of one or more columns of blocks in one pass.
+    blocks is an array of columns with Y as the last axis, and start holds the
+    Y to begin searching from in each column. Each column is walked down from
+    start to the first heightmap solid above floor. Columns with no solid
+    return floor, and columns that start at or below floor return start.'''
+    blocks = numpy.asarray(blocks)
+    height = blocks.shape[-1]
+    start = numpy.minimum(numpy.asarray(start, dtype=int), height - 1)
+    ys = numpy.arange(height)
+    solids = (heightmap_solids_lut[blocks] &
+              (ys > floor) &
+              (ys <= start[..., numpy.newaxis]))
+    tops = height - 1 - numpy.argmax(solids[..., ::-1], axis=-1)
+    tops = numpy.where(solids.any(axis=-1), tops, floor)
+    return numpy.where(start > floor, tops, start)
+
+
 def findChunkDepth(p, world):
     try:
         chunk = world.getChunk(p.x, p.z)
     except:
         return 0
-    depth = world.Height
-    for x in xrange(16):
-        for z in xrange(16):
-            y = chunk.HeightMap[z, x] - 1
-            while (y > 0 and
-                   chunk.Blocks[x, z, y] not in heightmap_solids):
-                y = y - 1
-            depth = min(y, depth)
-    return depth
+    depths = findSurfaceHeights(chunk.Blocks,
+                                chunk.HeightMap.T.astype(int) - 1)
+    return min(int(depths.min()), world.Height)
 
 
 def findChunkDepths(p, world):
@@ -618,17 +657,9 @@ def findChunkDepths(p, world):
         chunk = world.getChunk(p.x, p.z)
     except:
         return 0
-    min_depth = world.Height
-    max_depth = 0
-    for x in xrange(16):
-        for z in xrange(16):
-            y = chunk.HeightMap[z, x] - 1
-            while (y > 0 and
-                   chunk.Blocks[x, z, y] not in heightmap_solids):
-                y = y - 1
-            min_depth = min(y, min_depth)
-            max_depth = max(y, max_depth)
-    return (min_depth, max_depth)
+    depths = findSurfaceHeights(chunk.Blocks,
+                                chunk.HeightMap.T.astype(int) - 1)
+    return (min(int(depths.min()), world.Height), max(int(depths.max()), 0))
 
 
 def enum(*sequential, **named):
@@ -652,6 +683,157 @@ def distribute(chunk, ymin, ymax, chance, material):
             viewd[i] = 0
 
 
+def listRegionFiles(world):
+    '''Return (rx, rz, path) for every region file in a world.'''
+    region_path = os.path.join(os.path.dirname(world.filename), 'region')
+    regions = []
+    if not os.path.isdir(region_path):
+        return regions
+    for f in os.listdir(region_path):
+        result = re.match('^r\.(-?\d+)\.(-?\d+)\.mca$', f)
+        if result:
+            regions.append((int(result.group(1)),
+                            int(result.group(2)),
+                            os.path.join(region_path, f)))
+    return regions
+
+
+def readRegionHeader(path, timestamps=True):
+    '''Read the 8 KiB header of a region file. Returns a 32x32 array flagging
+    the chunks present in the region and, if requested, a 32x32 array of
+    their timestamps. Both are indexed [z, x] within the region.'''
+    FILE = open(path, 'rb')
+    if timestamps:
+        header = FILE.read(8192)
+    else:
+        header = FILE.read(4096)
+    FILE.close()
+    present = numpy.zeros((32, 32), dtype=bool)
+    stamps = None
+    if len(header) >= 4096:
+        offsets = numpy.frombuffer(header[:4096], dtype='>u4')
+        present = (offsets != 0).reshape(32, 32)
+    if timestamps:
+        stamps = numpy.zeros((32, 32), dtype=numpy.uint32)
+        if len(header) >= 8192:
+            stamps = numpy.frombuffer(header[4096:8192],
+                                      dtype='>u4').reshape(32, 32)
+    return present, stamps
+
+
+def regionChunks(regions, mtime=0):
+    '''Yield (cxs, czs, stamps, rmtime) for the chunks in each region file,
+    reading each region header only once. rmtime is the region file mtime.
+    Regions whose file has not been modified since mtime yield None for
+    stamps, since every chunk in them is older than mtime.'''
+    for (rx, rz, path) in regions:
+        try:
+            rmtime = int(os.path.getmtime(path))
+            present, stamps = readRegionHeader(path,
+                                               timestamps=(rmtime >= mtime))
+        except (IOError, OSError):
+            continue
+        zs, xs = numpy.nonzero(present)
+        if stamps is not None:
+            stamps = stamps[zs, xs]
+        yield xs + (rx << 5), zs + (rz << 5), stamps, rmtime
+
+
+def regionsModifiedSince(regions, mtime):
+    '''Return True if any region file has been modified since mtime. Only
+    the file mtimes are checked; no region is opened.'''
+    for (rx, rz, path) in regions:
+        try:
+            if int(os.path.getmtime(path)) >= mtime:
+                return True
+        except (IOError, OSError):
+            return True
+    return False
+
+
+def staleChunks(cache, cxs, czs, stamps, rmtime):
+    '''Compare the region timestamps of a set of chunks against the ones
+    recorded in a ChunkCache when they were last scanned. Returns a mask of
+    the chunks that need a rescan, the cached records, and the timestamp to
+    record for each chunk. Without stamps the whole region is older than
+    the cache, so only chunks missing from the cache are stale, and the
+    region file mtime stands in for their timestamps.'''
+    found, records = cache.lookup(cxs, czs)
+    if stamps is None:
+        return ~found, records, numpy.zeros(len(cxs), dtype=int) + rmtime
+    return ~found | (stamps > records['stamp']), records, stamps
+
+
+def regionChunkMatches(path, chunks, signatures):
+    '''Search the raw, decompressed NBT of chunks in a region file for any
+    of the given byte strings without parsing them. Returns the chunks that
+    might hold one of the signatures. Chunks that can not be read here are
+    returned too, so the caller can fall back to a full check.'''
+    try:
+        FILE = open(path, 'rb')
+    except (IOError, OSError):
+        return list(chunks)
+    matches = []
+    try:
+        header = FILE.read(4096)
+        if len(header) < 4096:
+            return list(chunks)
+        locations = numpy.frombuffer(header, dtype='>u4')
+        for c in chunks:
+            loc = int(locations[(c[0] & 31) + (c[1] & 31) * 32])
+            if loc == 0:
+                continue
+            try:
+                FILE.seek((loc >> 8) * 4096)
+                length = int(numpy.frombuffer(FILE.read(4), dtype='>u4')[0])
+                compression = ord(FILE.read(1))
+                data = FILE.read(length - 1)
+                if compression == 1:
+                    data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+                elif compression == 2:
+                    data = zlib.decompress(data)
+                elif compression != 3:
+                    # Stored outside the region file. Let NBT deal with it.
+                    matches.append(c)
+                    continue
+            except (IOError, IndexError, TypeError, ValueError, zlib.error):
+                matches.append(c)
+                continue
+            for sig in signatures:
+                if sig in data:
+                    matches.append(c)
+                    break
+    finally:
+        FILE.close()
+    return matches
+
+
+def regionsInRing(regions, sx, sz, min_dist, max_dist):
+    '''Split region files by their distance from chunk (sx, sz). Returns
+    the regions that overlap the ring between min_dist and max_dist, and
+    the regions that lie entirely inside min_dist. Regions entirely outside
+    max_dist are dropped without being opened.'''
+    if len(regions) == 0:
+        return [], []
+    rxs = numpy.array([r[0] for r in regions]) << 5
+    rzs = numpy.array([r[1] for r in regions]) << 5
+    # Distance to the nearest and farthest chunk in each region.
+    ndx = numpy.clip(sx, rxs, rxs + 31) - sx
+    ndz = numpy.clip(sz, rzs, rzs + 31) - sz
+    fdx = numpy.maximum(abs(rxs - sx), abs(rxs + 31 - sx))
+    fdz = numpy.maximum(abs(rzs - sz), abs(rzs + 31 - sz))
+    nearest = numpy.sqrt(ndx * ndx + ndz * ndz)
+    farthest = numpy.sqrt(fdx * fdx + fdz * fdz)
+    ring = []
+    inner = []
+    for i, r in enumerate(regions):
+        if farthest[i] < min_dist and farthest[i] <= max_dist:
+            inner.append(r)
+        elif nearest[i] <= max_dist:
+            ring.append(r)
+    return ring, inner
+
+
 def loadDungeonCache(cache_path):
     '''Load the dungeon cache given a path'''
     global cache_version
@@ -837,27 +1019,23 @@ def saveTHuntCache(cache_path, tHuntCache):
 def loadChunkCache(cache_path):
     '''Load the chunk cache given a path'''
     global cache_version
-    # Load the chunk cache
-    chunkCache = {}
     chunkMTime = 0
+    path = os.path.join(cache_path, 'chunk_scan_cache.bin')
+    pickle_path = os.path.join(cache_path, 'chunk_scan_cache')
 
     # Try some basic versioning.
     if not os.path.exists(os.path.join(cache_path,
                                        'chunk_scan_version_' + cache_version)):
         print 'Chunk cache missing, or is an old version. Resetting...'
-        return chunkCache, chunkMTime
-
-    if os.path.exists(os.path.join(cache_path, 'chunk_scan_cache')):
-        try:
-            FILE = open(os.path.join(cache_path, 'chunk_scan_cache'), 'rb')
-            chunkCache = cPickle.load(FILE)
-            FILE.close()
-        except Exception as e:
-            print e
-            sys.exit('Failed to read the chunk_scan_cache file.'
-                     'Check permissions and try again.')
-    # Try to read the cache mtime
-    if os.path.exists(os.path.join(cache_path, 'chunk_scan_mtime')):
+        for f in (path, path + '.journal'):
+            if os.path.exists(f):
+                os.remove(f)
+        chunkCache = ChunkCache(path)
+        return chunkCache, chunkCache.mtime
+
+    # The old cache mtime is only needed to convert an old pickled cache. The
+    # new cache keeps its own.
+    if os.path.exists(pickle_path) and os.path.exists(os.path.join(cache_path, 'chunk_scan_mtime')):
         try:
             FILE = open(os.path.join(cache_path, 'chunk_scan_mtime'), 'rb')
             chunkMTime = cPickle.load(FILE)
@@ -866,28 +1044,67 @@ def loadChunkCache(cache_path):
             print e
             sys.exit('Failed to read the dungeon_scan_mtime file.'
                      'Check permissions and try again.')
-    return chunkCache, chunkMTime
+    try:
+        # One time conversion from the old pickled cache. Those chunks were
+        # trusted if they were older than the cache mtime.
+        if os.path.exists(pickle_path) and not os.path.exists(path):
+            print 'Converting the chunk cache to the new format...'
+            chunkCache = convertPickle(pickle_path, path,
+                                       max(chunkMTime - 1, 0))
+        else:
+            chunkCache = ChunkCache(path)
+    except Exception as e:
+        print e
+        sys.exit('Failed to read the chunk_scan_cache file.'
+                 'Check permissions and try again.')
+    return chunkCache, chunkCache.mtime
 
 
-def saveChunkCache(cache_path, chunkCache):
-    ''' save the chunk cache given a path and array'''
-    global cache_version
+def loadStampCache(cache_path, mtime):
+    '''Load the per chunk timestamps for the dungeon and treasure hunt scan.
+    These are only good for as long as the caches they describe, so they are
+    thrown away when those are reset.'''
+    path = os.path.join(cache_path, 'dungeon_scan_stamps.bin')
     try:
-        FILE = open(os.path.join(cache_path, 'chunk_scan_cache'), 'wb')
-        cPickle.dump(chunkCache, FILE, -1)
-        FILE.close()
+        if mtime == 0:
+            for f in (path, path + '.journal'):
+                if os.path.exists(f):
+                    os.remove(f)
+        return ChunkCache(path)
     except Exception as e:
         print e
-        sys.exit('Failed to write chunk_scan_cache.'
+        sys.exit('Failed to read the dungeon_scan_stamps file.'
                  'Check permissions and try again.')
-    chunkMTime = int(time.time())
+
+
+def loadDungeonIndex(cache_path):
+    '''Load the index of known dungeons and treasure hunts given a path'''
     try:
-        FILE = open(os.path.join(cache_path, 'chunk_scan_mtime'), 'wb')
-        cPickle.dump(chunkMTime, FILE, -1)
-        FILE.close()
+        return DungeonIndex(os.path.join(cache_path, 'dungeon_index'))
+    except Exception as e:
+        print e
+        sys.exit('Failed to read the dungeon_index file. '
+                 'Check permissions and try again.')
+
+
+def saveDungeonIndex(dungeonIndex):
+    '''Save the index of known dungeons and treasure hunts'''
+    try:
+        dungeonIndex.save()
     except Exception as e:
         print e
-        sys.exit('Failed to write chunk_scan_mtime.'
+        sys.exit('Failed to write dungeon_index. '
+                 'Check permissions and try again.')
+
+
+def saveChunkCache(cache_path, chunkCache):
+    ''' save the chunk cache given a path and cache'''
+    global cache_version
+    try:
+        chunkCache.save()
+    except Exception as e:
+        print e
+        sys.exit('Failed to write chunk_scan_cache.'
                  'Check permissions and try again.')
     try:
         for f in os.listdir(cache_path):
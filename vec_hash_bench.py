@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# Compare dict throughput for block coordinates with the old Vec hash and the
+# current one, over every block in a 10 x 10 x 8 dungeon.
+import time
+
+from utils import Vec
+
+xsize = 10
+zsize = 10
+levels = 8
+room_size = 16
+room_height = 6
+
+
+class OldVec(Vec):
+
+    def __hash__(self):
+        return self.x + (self.y << 4) + (self.z << 8)
+
+
+for cls in (OldVec, Vec):
+    keys = [cls(x, y, z)
+            for x in xrange(xsize * room_size)
+            for y in xrange(levels * room_height)
+            for z in xrange(zsize * room_size)]
+    start = time.time()
+    blocks = {}
+    for k in keys:
+        blocks[k] = True
+    fill = time.time() - start
+    start = time.time()
+    for k in keys:
+        blocks[k]
+    lookup = time.time() - start
+    print '%6s: %d blocks, %d distinct hashes' % (
+        cls.__name__, len(keys), len(set(hash(k) for k in keys)))
+    print '        fill %.2fs, lookup %.2fs (%d lookups/sec)' % (
+        fill, lookup, len(keys) / max(lookup, 0.001))